@@ -51,8 +51,8 @@ import vault
 
 import alter_path
 from lib import aws
-from lib.ssh import SSHConnection, vault_tunnel
-from lib.vault import Vault
+from lib.ssh import SSHConnection, vault_tunnel, run_all, format_results, FLEET_WORKERS
+from lib.vault import Vault, VaultCluster
 
 if __name__ == "__main__":
     def create_help(header, options):
@@ -62,6 +62,8 @@ if __name__ == "__main__":
 
     commands = ["ssh", "scp", "ssh-cmd", "ssh-tunnel", "ssh-all"]
     commands.extend(vault.COMMANDS.keys())
+    cluster_commands = ["vault-cluster-unseal", "vault-cluster-seal", "vault-cluster-status"]
+    commands.extend(cluster_commands)
     commands_help = create_help("command supports the following:", commands)
 
     parser = argparse.ArgumentParser(description = "Script creating SSH Tunnels and connecting to internal VMs",
@@ -89,6 +91,19 @@ if __name__ == "__main__":
                         metavar = "<file>",
                         default = os.environ.get("SSH_KEY"),
                         help = "SSH private key to use when connecting to AWS instances (default: SSH_KEY)")
+    parser.add_argument("--refresh",
+                        action = "store_true",
+                        help = "Repeat all AWS lookups instead of using the results saved by previous runs")
+    parser.add_argument("--parallel",
+                        metavar = "<count>",
+                        type = int,
+                        default = FLEET_WORKERS,
+                        help = "Maximum number of machines ssh-all runs the command on at once (default: {})".format(FLEET_WORKERS))
+    parser.add_argument("--timeout",
+                        metavar = "<seconds>",
+                        type = float,
+                        default = None,
+                        help = "Seconds before ssh-all stops waiting for the command on a machine (default: no timeout)")
     parser.add_argument("--bastion","-b",  help="Hostname of the EC2 bastion server to create SSH Tunnels on")
     parser.add_argument("internal", help="Hostname of the EC2 internal server to create the SSH Tunnels to")
     parser.add_argument("command",
@@ -114,6 +129,7 @@ if __name__ == "__main__":
         print("Error: SSH key '{}' does not exist".format(args.ssh_key))
         sys.exit(1)
 
+    aws.persist_lookup_cache(args.refresh)
     session = aws.create_session(args.aws_credentials)
 
     # This next step will make bastion work with 1.consul or 1.vault internal names.
@@ -145,11 +161,29 @@ if __name__ == "__main__":
         ssh.external_tunnel(*args.arguments)
     elif args.command in ("ssh-all",):
         addrs = aws.machine_lookup_all(session, args.internal, public_ip=False)
-        for addr in addrs:
-            print("{} at {}".format(args.internal, addr))
-            ssh = SSHConnection(args.ssh_key, addr, bastion)
-            ssh.cmd(*args.arguments)
-            print()
+        command = args.arguments[0] if len(args.arguments) > 0 else input("command: ")
+        targets = [(addr, args.port, args.user) for addr in addrs]
+        results = run_all(args.ssh_key, targets, bastion, command, args.parallel, args.timeout)
+        print()
+        print(format_results(results))
+        sys.exit(0 if all(r == 0 for r in results.values()) else 1)
+    elif args.command in cluster_commands:
+        ips = aws.machine_lookup_all(session, args.internal, public_ip=False)
+        cluster = VaultCluster([Vault(args.internal, ip) for ip in ips])
+        with vault_tunnel(args.ssh_key, bastion):
+            if args.command == "vault-cluster-unseal":
+                results = cluster.unseal()
+            elif args.command == "vault-cluster-seal":
+                results = cluster.seal()
+            else:
+                results = cluster.health()
+        print(VaultCluster.format_status(results))
+        if args.command != "vault-cluster-status":
+            try:
+                VaultCluster.check(results, sealed = args.command == "vault-cluster-seal")
+            except Exception as ex:
+                print(ex)
+                sys.exit(1)
     elif args.command in vault.COMMANDS:
         with vault_tunnel(args.ssh_key, bastion):
             vault.COMMANDS[args.command](Vault(args.internal, private), *args.arguments)
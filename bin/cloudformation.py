@@ -20,12 +20,16 @@ import argparse
 import sys
 import os
 import importlib
+import inspect
 import glob
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import alter_path
 from lib import exceptions
 from lib import aws
 from lib import utils
+from lib import template_cache
 from lib.cloudformation import CloudFormationConfiguration
 from lib.stepfunctions import heaviside
 
@@ -34,6 +38,9 @@ cur_dir = os.path.dirname(os.path.realpath(__file__))
 cf_dir = os.path.normpath(os.path.join(cur_dir, '..', 'cloud_formation'))
 sys.path.append(cf_dir) # Needed for importing CF configs
 
+# Actions that build templates, making enough lookups to use the Inventory
+INVENTORY_ACTIONS = ("create", "update", "generate", "diff")
+
 def call_config(session, domain, config, func_name):
     """Import 'configs.<config>' and then call the requested function with
     <session> and <domain>.
@@ -41,12 +48,183 @@ def call_config(session, domain, config, func_name):
     module = importlib.import_module("configs." + config)
 
     if func_name in module.__dict__:
-        module.__dict__[func_name](session, domain)
+        return module.__dict__[func_name](session, domain)
     elif func_name == 'delete':
-        CloudFormationConfiguration(config, domain).delete(session)
+        return CloudFormationConfiguration(config, domain).delete(session)
+    elif func_name == 'diff':
+        # Configs whose create() passes runtime inputs to create_config() define
+        # their own diff(), else the diff would be against the wrong inputs
+        if len(inspect.signature(module.create_config).parameters) > 2:
+            print("Configuration '{}' needs the inputs create() generates, cannot diff".format(config))
+            return False
+        return module.create_config(session, domain).diff(session)
     else:
         print("Configuration '{}' doesn't implement function '{}'".format(config, func_name))
 
+def load_dependencies(configs):
+    """Build the dependency graph for the given configs from each config's
+    DEPENDENCIES list.
+
+    Only dependencies that are part of configs are included, any others are
+    expected to already exist.
+
+    Args:
+        configs (list) : Names of the configs
+
+    Returns:
+        (dict) : Dictionary of config name and set of dependency config names
+    """
+    graph = {}
+    for config in configs:
+        module = importlib.import_module("configs." + config)
+        dependencies = getattr(module, 'DEPENDENCIES', [])
+        graph[config] = set(d for d in dependencies if d in configs)
+    return graph
+
+def call_configs(credentials, domain, configs, func_name, max_workers):
+    """Call the requested function for multiple configs, running configs
+    concurrently once all of their dependencies have finished.
+
+    When deleting, the dependency graph is reversed so a config is deleted
+    after all of the configs that depend upon it. If a config fails (raises
+    an exception or returns False), the configs that depend upon it are
+    skipped. The configs' create() functions raise if the stack fails to launch.
+    Prompts for user input hold utils.console_lock, so the prompts of configs
+    running at the same time are asked one after the other.
+
+    Args:
+        credentials (dict) : AWS credentials, each config gets its own Boto3
+                             session as sessions are not thread safe
+        domain (string) : Domain the configs are launched in
+        configs (list) : Names of the configs
+        func_name (string) : Name of the function to call
+        max_workers (int) : Maximum number of configs to run concurrently
+
+    Returns:
+        (bool) : If all of the configs succeeded
+
+    Raises:
+        Exception : The first exception raised by a config, after all of the
+                    running configs have finished
+    """
+    graph = load_dependencies(configs)
+    if func_name == 'delete':
+        graph = {c: set(d for d in configs if c in graph[d]) for c in configs}
+
+    def run(config):
+        session = aws.create_session(credentials)
+        return call_config(session, domain, config, func_name)
+
+    pending = list(configs)
+    running = {}
+    finished = set()
+    skipped = set()
+    errors = []
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            progress = False
+            for config in pending[:]:
+                if graph[config] & skipped:
+                    print("Skipping {} of {}, a dependency failed".format(func_name, config))
+                    skipped.add(config)
+                elif graph[config] <= finished:
+                    print("Starting {} of {}".format(func_name, config))
+                    running[executor.submit(run, config)] = config
+                else:
+                    continue
+
+                pending.remove(config)
+                progress = True
+
+            if len(running) == 0:
+                if progress:
+                    continue
+                raise Exception("Circular dependency between configs: {}".format(", ".join(pending)))
+
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                config = running.pop(future)
+                try:
+                    ret = future.result()
+                except Exception as ex:
+                    print("Error during {} of {}: {}".format(func_name, config, ex))
+                    errors.append(ex)
+                    ret = False
+
+                if ret == False:
+                    print("Failed {} of {}".format(func_name, config))
+                    skipped.add(config)
+                else:
+                    print("Finished {} of {}".format(func_name, config))
+                    finished.add(config)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return len(skipped) == 0
+
+def generate_config(credentials, domain, config):
+    """Generate the config's template, if it is out of date.
+
+    Run in a separate process by generate_configs().
+
+    Returns:
+        (bool) : If the template was generated, False if it was up to date
+    """
+    session = aws.create_session(credentials)
+    module = importlib.import_module("configs." + config)
+
+    key = template_cache.cache_key(config, domain, module)
+    stack_name = CloudFormationConfiguration(config, domain).stack_name
+    outputs = [os.path.join(template_cache.TEMPLATE_DIR, stack_name + ext)
+               for ext in (".template", ".arguments")]
+    if template_cache.is_fresh(session, config, domain, key, outputs):
+        return False
+
+    aws.lookup_cache.recording = []
+    call_config(session, domain, config, 'generate')
+    template_cache.save(config, domain, key, aws.lookup_cache.recording)
+    aws.lookup_cache.recording = None
+    return True
+
+def generate_configs(credentials, domain, configs, max_workers):
+    """Generate the templates for multiple configs, skipping the templates
+    that are up to date and generating the rest in parallel processes.
+
+    Configs that set GENERATE_CACHE = False are always generated, in this
+    process, as they may prompt the user.
+
+    Args:
+        credentials (dict) : AWS credentials
+        domain (string) : Domain the configs are generated for
+        configs (list) : Names of the configs
+        max_workers (int) : Maximum number of processes to use
+
+    Returns:
+        (bool) : If all of the configs were generated
+    """
+    cacheable = [c for c in configs
+                 if getattr(importlib.import_module("configs." + c), 'GENERATE_CACHE', True)]
+
+    ret = True
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        futures = {executor.submit(generate_config, credentials, domain, c): c for c in cacheable}
+
+        for config in configs:
+            if config not in cacheable:
+                print("Generating {}".format(config))
+                call_config(aws.create_session(credentials), domain, config, 'generate')
+
+        for future in futures:
+            config = futures[future]
+            try:
+                generated = future.result()
+                print("{} {}".format("Generated" if generated else "Up to date", config))
+            except Exception as ex:
+                print("Error generating {}: {}".format(config, ex))
+                ret = False
+    return ret
+
 if __name__ == '__main__':
     os.chdir(os.path.join(cur_dir, "..", "cloud_formation"))
 
@@ -57,8 +235,23 @@ if __name__ == '__main__':
 
     config_names = [x.split('/')[1].split('.')[0] for x in glob.glob("configs/*.py") if "__init__" not in x]
     config_help = create_help("config_name supports the following:", config_names)
+    config_help += create_help("config_name also supports:",
+                               ["all (every config that declares DEPENDENCIES)",
+                                "<config>,<config>,... (multiple configs)"])
+
+    def config_list(value):
+        """Parse the config_name argument into a list of config names."""
+        if value == "all":
+            return [c for c in sorted(config_names)
+                    if hasattr(importlib.import_module("configs." + c), 'DEPENDENCIES')]
 
-    actions = ["create", "update", "delete", "post-init", "pre-init", "generate"]
+        configs = value.split(',')
+        for config in configs:
+            if config not in config_names:
+                raise argparse.ArgumentTypeError("invalid config_name '{}'".format(config))
+        return configs
+
+    actions = ["create", "update", "delete", "post-init", "pre-init", "generate", "diff"]
     actions_help = create_help("action supports the following:", actions)
 
     scenarios = ["development", "production", "ha-development"]
@@ -84,15 +277,32 @@ if __name__ == '__main__':
     parser.add_argument("--disable-preview",
                         action = "store_true",
                         help = "Disable update previews change sets (default: enable)"),
+    parser.add_argument("--force-update",
+                        action = "store_true",
+                        help = "Update stacks even if the template and arguments haven't changed (default: skip)"),
+    parser.add_argument("--split-stack",
+                        action = "store_true",
+                        help = "Split a stack deployed without nested stacks once it is over the resource limit, replacing all of its resources (default: refuse)")
+    parser.add_argument("--parallel",
+                        metavar = "<count>",
+                        type = int,
+                        default = 4,
+                        help = "Maximum number of configs to run concurrently, when acting on multiple configs (default: 4)")
+    parser.add_argument("--lookup-stats",
+                        action = "store_true",
+                        help = "Print the AWS lookup cache hit / miss counts when finished")
+    parser.add_argument("--refresh",
+                        action = "store_true",
+                        help = "Repeat all AWS lookups instead of using the results saved by previous runs")
     parser.add_argument("action",
                         choices = actions,
                         metavar = "action",
                         help = "Action to execute")
     parser.add_argument("domain_name", help="Domain in which to execute the configuration (example: subnet.vpc.boss)")
     parser.add_argument("config_name",
-                        choices = config_names,
+                        type = config_list,
                         metavar = "config_name",
-                        help="Configuration to act upon (imported from configs/)")
+                        help="Configuration(s) to act upon (imported from configs/)")
 
     args = parser.parse_args()
 
@@ -104,12 +314,35 @@ if __name__ == '__main__':
     os.environ["AMI_VERSION"] = args.ami_version
     os.environ["SCENARIO"] = args.scenario
     os.environ["DISABLE_PREVIEW"] = str(args.disable_preview)
+    os.environ["FORCE_UPDATE"] = str(args.force_update)
+    os.environ["SPLIT_STACK"] = str(args.split_stack)
+
+    aws.persist_lookup_cache(args.refresh)
 
-    session = aws.create_session(args.aws_credentials)
+    credentials = json.load(args.aws_credentials)
+    session = aws.create_session(credentials)
+    if args.action in INVENTORY_ACTIONS:
+        # Answer the configs' lookups from a few bulk requests, made when
+        # the first lookup that can use them happens
+        aws.load_inventory(session, args.domain_name, lazy=True)
 
     try:
         func = args.action.replace('-','_')
-        ret = call_config(session, args.domain_name, args.config_name, func)
+        if len(args.config_name) == 1:
+            ret = call_config(session, args.domain_name, args.config_name[0], func)
+        else:
+            if func in ('create', 'update', 'post_init', 'generate'):
+                # Select the keypair once, instead of prompting from every config
+                keypair = aws.keypair_lookup(session)
+                if keypair is not None:
+                    os.environ["SSH_KEY"] = keypair
+
+            if func == 'generate':
+                ret = generate_configs(credentials, args.domain_name, args.config_name, args.parallel)
+            else:
+                # Updates prompt before being applied, so only run one at a time
+                workers = 1 if func == 'update' else args.parallel
+                ret = call_configs(credentials, args.domain_name, args.config_name, func, workers)
         if ret == False:
             sys.exit(1)
         else:
@@ -146,3 +379,7 @@ if __name__ == '__main__':
         print("Fix the problem, then run the following command:")
         print("\t" + utils.get_command("post-init"))
         sys.exit(2)
+    finally:
+        if args.lookup_stats:
+            print()
+            print(aws.lookup_cache)
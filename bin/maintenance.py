@@ -128,6 +128,9 @@ def create_parser():
                         default=False,
                         type=bool,
                         help="Skip, Are you sure? prompt")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="Repeat all AWS lookups instead of using the results saved by previous runs")
     parser.add_argument("cmd",
                         choices=CMDS,
                         help="returns maintenance on or off")
@@ -148,6 +151,7 @@ if __name__ == '__main__':
         print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
         sys.exit(1)
 
+    aws.persist_lookup_cache(args.refresh)
     session = aws.create_session(args.aws_credentials)
 
     if args.cmd == "on":
@@ -57,6 +57,9 @@ if __name__ == "__main__":
     parser.add_argument("--cmd", "-c",
                         default=None,
                         help="command to run in ssh, if you want to run a command.")
+    parser.add_argument("--refresh",
+                        action = "store_true",
+                        help = "Repeat all AWS lookups instead of using the results saved by previous runs")
     parser.add_argument("hostname", help="Hostname of the EC2 instance to create SSH Tunnels on")
     parser.add_argument("--user", "-u",
                         default=None,
@@ -81,6 +84,7 @@ if __name__ == "__main__":
         print("Error: SSH key '{}' does not exist".format(args.ssh_key))
         sys.exit(1)
 
+    aws.persist_lookup_cache(args.refresh)
     session = aws.create_session(args.aws_credentials)
     if args.private_ip:
         ip = args.hostname
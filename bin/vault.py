@@ -217,30 +217,58 @@ def vault_delete(vault, path = None):
 def vault_export(vault, output='-', path="secret/"):
     """A generic method for exporting data from Vault
 
-    Note: output data is Json encoded
+    Note: output data is newline delimited Json, one {"path": "", "data": {}}
+          object per line, written as the data is read
 
     Args:
         vault (Vault) : Vault connection to use
         output (string) : Output path to save the data ('-' for stdout)
         path (string) : Vault path to export data from
     """
-    rtn = vault.export(path)
-
     with open_(output, 'w') as fh:
-        json.dump(rtn, fh, indent=3, sort_keys=True)
+        for path, data in vault.iter_export(path):
+            fh.write(json.dumps({"path": path, "data": data}, sort_keys=True))
+            fh.write("\n")
+
+def read_export(fh):
+    """Read data exported by vault_export
+
+    Both newline delimited Json and the older single Json object of path
+    to data format are supported.
+
+    Args:
+        fh (file) : File to read from
+
+    Returns:
+        (generator) : Generator of (path, data) tuples
+    """
+    first = fh.readline()
+    try:
+        item = json.loads(first)
+        ndjson = isinstance(item, dict) and item.keys() == {"path", "data"}
+    except ValueError:
+        ndjson = False
+
+    if not ndjson:
+        yield from json.loads(first + fh.read()).items()
+        return
+
+    yield item["path"], item["data"]
+    for line in fh:
+        if len(line.strip()) > 0:
+            item = json.loads(line)
+            yield item["path"], item["data"]
 
 def vault_import(vault, input_='-'):
     """A generic method for importing data into Vault
 
-    Note: input data should be Json encoded
+    Note: input data should be Json encoded, as written by vault_export
 
     Args:
         input_ (string) : Input path to read data from ('-' for stdin)
     """
     with open_(input_) as fh:
-        exported = json.load(fh)
-
-    vault.import_(exported)
+        vault.import_(read_export(fh))
 
 COMMANDS = {
     "vault-init": vault_init,
@@ -12,13 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import glob
 import json
+import tempfile
 from lib.cloudformation import CloudFormationConfiguration, Ref, Arn, get_scenario, Arg
 from lib.userdata import UserData
 from lib.names import AWSNames
 from lib import aws
 from lib import constants as const
 from lib import stepfunctions as sfn
+from lib import zip
+
+# Configs that must be launched before this one
+DEPENDENCIES = ['core', 'redis', 'api', 'cachedb']
 
 keypair = None
 
@@ -98,15 +105,49 @@ def create_config(session, domain):
                                min=1,
                                max=1)
 
+    config.add_dynamo_table("IngestCheckpoint",
+                            names.ingest_checkpoint,
+                            attributes={'job_key': 'S'},
+                            key_schema={'job_key': 'HASH'},
+                            throughput=(5, 5))
+
     config.add_lambda("IngestLambda",
                       names.ingest_lambda,
                       aws.role_arn_lookup(session, 'IngestQueueUpload'),
-                      const.INGEST_LAMBDA,
-                      handler="index.handler",
-                      timeout=60 * 5)
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          generate_lambda_key(domain),
+                          "ingest_queue_upload.handler"),
+                      timeout=60 * 5,
+                      memory=512,
+                      runtime="python3.6",
+                      environment={'CHECKPOINT_TABLE': names.ingest_checkpoint},
+                      depends_on="IngestCheckpoint")
 
     config.add_lambda_permission("IngestLambdaExecute", Ref("IngestLambda"))
 
+    config.add_lambda("IngestSplitLambda",
+                      names.ingest_split_lambda,
+                      aws.role_arn_lookup(session, 'IngestQueueUpload'),
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          generate_lambda_key(domain),
+                          "ingest_queue_upload.split_handler"),
+                      timeout=60,
+                      runtime="python3.6",
+                      environment={'SHARD_COUNT': str(const.INGEST_SHARD_COUNT)})
+
+    config.add_lambda_permission("IngestSplitLambdaExecute", Ref("IngestSplitLambda"))
+
+    config.add_lambda("IngestCountLambda",
+                      names.ingest_count_lambda,
+                      aws.role_arn_lookup(session, 'IngestQueueUpload'),
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          generate_lambda_key(domain),
+                          "ingest_queue_upload.count_handler"),
+                      timeout=60,
+                      runtime="python3.6")
+
+    config.add_lambda_permission("IngestCountLambdaExecute", Ref("IngestCountLambda"))
+
     return config
 
 
@@ -118,13 +159,53 @@ def generate(session, domain):
 
 def create(session, domain):
     """Create the configuration, launch it, and initialize Vault"""
+    pre_init(session, domain)
+
     config = create_config(session, domain)
 
     success = config.create(session)
-    if success:
+    if not success:
+        raise Exception("Create Failed")
+    else:
         post_init(session, domain)
 
 
+def pre_init(session, domain):
+    """Package the ingest lambda and upload the .zip to S3.
+
+    The ingest lambda is too large to be inlined in the template, so the
+    Python files are zipped and referenced from the lambda S3 bucket.
+    """
+    tempname = tempfile.NamedTemporaryFile(delete=True)
+    zipname = tempname.name + '.zip'
+    tempname.close()
+
+    for file in glob.glob(os.path.join(const.INGEST_LAMBDA_DIR, '*.py')):
+        if file.endswith('.min.py'):
+            continue
+        zip.write_to_zip(file, zipname, arcname=os.path.basename(file))
+
+    print('Uploading ingest lambda to S3.')
+    bucket = aws.get_lambda_s3_bucket(session)
+    s3 = session.client('s3')
+    with open(zipname, 'rb') as fh:
+        s3.put_object(Bucket=bucket, Key=generate_lambda_key(domain), Body=fh)
+
+    os.remove(zipname)
+
+
+def generate_lambda_key(domain):
+    """Generate the S3 key name for the ingest lambda's zip file.
+
+    Args:
+        domain (str): Use the domain as part of the key.
+
+    Returns:
+        (str)
+    """
+    return 'ingest_populate.' + domain + '.zip'
+
+
 def post_init(session, domain):
     names = AWSNames(domain)
 
@@ -133,8 +214,8 @@ def post_init(session, domain):
     sfn.create(session, names.delete_experiment, domain, 'delete_experiment.hsd', 'StatesExecutionRole-us-east-1 ')
     sfn.create(session, names.delete_coord_frame, domain, 'delete_coordinate_frame.hsd', 'StatesExecutionRole-us-east-1 ')
     sfn.create(session, names.delete_collection, domain, 'delete_collection.hsd', 'StatesExecutionRole-us-east-1 ')
-    #sfn.create(session, names.populate_upload_queue, domain, 'populate_upload_queue.hsd',
-    #           'StatesExecutionRole-us-east-1 ')
+    sfn.create(session, names.populate_upload_queue, domain, 'populate_upload_queue.hsd',
+               'StatesExecutionRole-us-east-1 ', branches={'shard': const.INGEST_SHARD_COUNT})
     sfn.create(session, names.ingest_queue_populate, domain, 'ingest_queue_populate.hsd', 'StatesExecutionRole-us-east-1 ')
     sfn.create(session, names.ingest_queue_upload, domain, 'ingest_queue_upload.hsd', 'StatesExecutionRole-us-east-1 ')
     sfn.create(session, names.resolution_hierarchy, domain, 'resolution_hierarchy.hsd', 'StatesExecutionRole-us-east-1')
@@ -153,5 +234,6 @@ def delete(session, domain):
     sfn.delete(session, names.query_deletes)
     sfn.delete(session, names.ingest_queue_populate)
     sfn.delete(session, names.ingest_queue_upload)
+    sfn.delete(session, names.populate_upload_queue)
     sfn.delete(session, names.resolution_hierarchy)
     sfn.delete(session, names.downsample_volume)
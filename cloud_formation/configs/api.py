@@ -40,6 +40,13 @@ import sys
 from urllib.request import Request, urlopen
 from urllib.parse import urlencode
 
+# Configs that must be launched before this one
+DEPENDENCIES = ['core', 'redis']
+
+# generate() reads the database configuration from Vault, which isn't tracked
+# by lib/template_cache
+GENERATE_CACHE = False
+
 def create_config(session, domain, keypair=None, db_config={}):
     """
     Create the CloudFormationConfiguration object.
@@ -234,6 +241,22 @@ def generate(session, domain):
     config.generate()
 
 
+def diff(session, domain):
+    """Compare the deployed stack with the configuration, using the database
+    configuration saved in Vault when the stack was created"""
+    keypair = aws.keypair_lookup(session)
+
+    call = ExternalCalls(session, keypair, domain)
+
+    with call.vault() as vault:
+        db_config = vault.read(const.VAULT_ENDPOINT_DB)
+        if db_config is None:
+            raise Exception("{} not found in Vault, cannot diff".format(const.VAULT_ENDPOINT_DB))
+
+    config = create_config(session, domain, keypair, db_config)
+    return config.diff(session)
+
+
 def create(session, domain):
     """Configure Vault, create the configuration, and launch it"""
     keypair = aws.keypair_lookup(session)
@@ -307,8 +330,7 @@ def post_init(session, domain):
         print("Update KeyCloak Client Info")
         auth_url = "http://localhost:{}".format(auth_port)
         with KeyCloakClient(auth_url, **creds) as kc:
-            # DP TODO: make add_redirect_uri able to work multiple times without issue
-            kc.add_redirect_uri("BOSS","endpoint", uri + "/*")
+            kc.reconcile_clients("BOSS", {"endpoint": {"redirectUris": [uri + "/*"]}})
 
     # Get the boss admin's bearer token
     headers = {
@@ -38,6 +38,8 @@ from lib import constants as const
 from update_lambda_fcn import load_lambdas_on_s3
 import boto3
 
+# Configs that must be launched before this one
+DEPENDENCIES = ['core', 'redis', 'api']
 
 def create_config(session, domain, keypair=None, user_data=None):
     """
@@ -183,8 +185,8 @@ def generate(session, domain):
     config.generate()
 
 
-def create(session, domain):
-    """Create the configuration, and launch it"""
+def create_user_data(session, domain):
+    """Create the user data for the cache manager instance"""
     names = AWSNames(domain)
 
     user_data = UserData()
@@ -215,6 +217,22 @@ def create(session, domain):
     user_data["lambda"]["flush_function"] = names.multi_lambda
     user_data["lambda"]["page_in_function"] = names.multi_lambda
 
+    return user_data
+
+
+def diff(session, domain):
+    """Compare the deployed stack with the configuration create() launches"""
+    keypair = aws.keypair_lookup(session)
+    user_data = create_user_data(session, domain)
+
+    config = create_config(session, domain, keypair, user_data)
+    return config.diff(session)
+
+
+def create(session, domain):
+    """Create the configuration, and launch it"""
+    user_data = create_user_data(session, domain)
+
     keypair = aws.keypair_lookup(session)
 
     try:
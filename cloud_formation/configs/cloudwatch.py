@@ -30,6 +30,9 @@ from lib import constants as const
 
 import json
 
+# Configs that must be launched before this one
+DEPENDENCIES = ['core', 'api']
+
 def create_config(session, domain):
     """Create the CloudFormationConfiguration object.
     :arg session used to perform lookups
@@ -138,4 +141,4 @@ def create(session, domain):
     if success:
         print('success')
     else:
-        print('failed')
+        raise Exception("Create Failed")
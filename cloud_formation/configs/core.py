@@ -38,6 +38,9 @@ import json
 import time
 from concurrent.futures import ThreadPoolExecutor
 
+# Configs that must be launched before this one
+DEPENDENCIES = []
+
 keypair = None
 
 def create_asg_elb(config, key, hostname, ami, keypair, user_data, size, isubnets, esubnets, listeners, check, sgs=[], role = None, public=True, depends_on=None):
@@ -244,7 +247,9 @@ def create(session, domain):
     config = create_config(session, domain)
 
     success = config.create(session)
-    if success:
+    if not success:
+        raise Exception("Create Failed")
+    else:
         vpc_id = aws.vpc_id_lookup(session, domain)
         aws.rt_name_default(session, vpc_id, "default." + domain)
 
@@ -287,7 +292,7 @@ def post_init(session, domain, startup_wait=False):
             print("Could not initialize Vault")
             print("Call: {}".format(utils.get_command("post-init")))
             print("Before launching other stacks")
-            return
+            raise
 
         #Check and see if these secrets already exist before we overwrite them with new ones.
         # Write data into Vault
@@ -371,9 +376,10 @@ def update(session, domain):
     min_time = consul_update_timeout * consul_size
     max_time = min_time + 5 # add some time to allow the CF update to happen
 
-    print("Update command will take {} - {} minutes to finish".format(min_time, max_time))
-    print("Stack will be available during that time")
-    resp = input("Update? [N/y] ")
+    with utils.console_lock:
+        print("Update command will take {} - {} minutes to finish".format(min_time, max_time))
+        print("Stack will be available during that time")
+        resp = input("Update? [N/y] ")
     if len(resp) == 0 or resp[0] not in ('y', 'Y'):
         print("Canceled")
         return
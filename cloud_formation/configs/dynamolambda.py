@@ -70,6 +70,9 @@ VPC_DOMAIN =  'VPC_DOMAIN'
 # are way too high for DynamoDB tables for developers.
 DEV_STACK = 'DEV_STACK'
 
+# Configs that must be launched before this one
+DEPENDENCIES = ['core']
+
 def create_config(session, domain):
     """
     Create the CloudFormationConfiguration object.
@@ -14,9 +14,13 @@
 
 from lib import hosts
 from lib import aws
+from lib import utils
 from lib.cloudformation import CloudFormationConfiguration, Ref
 from lib.names import AWSNames
 
+# generate() prompts for the peer VPC, so it cannot be cached by lib/template_cache
+GENERATE_CACHE = False
+
 def create_config(session, domain, peer_domain):
     config = CloudFormationConfiguration('peer', domain)
 
@@ -55,19 +59,31 @@ def create_config(session, domain, peer_domain):
     return config
     
 def generate(session, domain):
-    peer_vpc = input("Peer VPC: ")
+    with utils.console_lock:
+        peer_vpc = input("Peer VPC: ")
 
     config = create_config(session, domain, peer_vpc)
     config.generate()
+
+def diff(session, domain):
+    with utils.console_lock:
+        peer_vpc = input("Peer VPC: ")
+
+    config = create_config(session, domain, peer_vpc)
+    return config.diff(session)
     
 def create(session, domain):
-    peer_vpc = input("Peer VPC: ")
+    with utils.console_lock:
+        peer_vpc = input("Peer VPC: ")
 
     config = create_config(session, domain, peer_vpc)
-    config.create(session)
+    success = config.create(session)
+    if not success:
+        raise Exception("Create Failed")
     
 def delete(session, domain):
-    peer_vpc = input("Peer VPC: ")
+    with utils.console_lock:
+        peer_vpc = input("Peer VPC: ")
 
     config = create_config(session, domain, peer_vpc)
     config.delete(session)
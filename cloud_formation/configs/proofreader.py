@@ -161,7 +161,7 @@ def post_init(session, domain):
 
     with KeyCloakClient(auth_url, **creds) as kc:
         print("Configuring KeyCloak")
-        kc.append_list_properties("BOSS", "endpoint", {"redirectUris": uri + "/*", "webOrigins": uri})
+        kc.reconcile_clients("BOSS", {"endpoint": {"redirectUris": [uri + "/*"], "webOrigins": [uri]}})
 
         print("Generating keycloak.json")
         client_install = kc.get_client_installation_url("BOSS", "endpoint")
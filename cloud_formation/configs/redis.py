@@ -30,6 +30,8 @@ from lib import aws
 from lib import constants as const
 from lib.cloudformation import get_scenario
 
+# Configs that must be launched before this one
+DEPENDENCIES = ['core']
 
 def create_config(session, domain, keypair=None):
     """
@@ -86,6 +88,14 @@ def generate(session, domain):
     config.generate()
 
 
+def diff(session, domain):
+    """Compare the deployed stack with the configuration"""
+    keypair = aws.keypair_lookup(session)
+
+    config = create_config(session, domain, keypair)
+    return config.diff(session)
+
+
 def create(session, domain):
     """
     Create the configuration and launches it
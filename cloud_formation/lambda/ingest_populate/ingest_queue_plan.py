@@ -0,0 +1,154 @@
+"""Plan the population of an ingest upload queue without creating any keys
+
+Computes the exact number of tiles, chunks and messages that
+ingest_queue_upload.handler will enqueue for a given set of arguments,
+along with the number of SQS requests and an estimate of the runtime.
+
+Can be run from the command line with a Json file containing the
+ingest_queue_upload.handler arguments:
+
+    python3 ingest_queue_plan.py [--shards K] [--concurrency N] args.json
+"""
+
+import sys
+import json
+import math
+import argparse
+
+import ingest_queue_upload as upload
+
+SQS_REQUEST_LATENCY = 0.05 # Seconds, average send_message_batch round trip
+
+def count_steps(args, v):
+    """Number of tile steps along the given axis"""
+    return len(range(args[v + '_start'], args[v + '_stop'], args[v + '_tile_size']))
+
+def count_z_tiles(args):
+    """Number of tiles created for each (t, y, x) chunk column
+
+    Every Z chunk has z_tile_size tiles, except the one containing
+    final_z_stop which is partial, and any chunks past final_z_stop which
+    have no tiles.
+
+    Returns:
+        tuple: (Number of Z chunks with tiles, Number of tiles)
+    """
+    start = args['z_start']
+    size = args['z_tile_size']
+    final = args['final_z_stop']
+    steps = count_steps(args, 'z')
+
+    # Z chunks where z + size <= final_z_stop
+    full = (final - size - start) // size + 1
+    full = min(max(full, 0), steps)
+
+    partial = 0
+    if full < steps:
+        partial = max(0, final - (start + full * size))
+
+    chunks = full + (1 if partial > 0 else 0)
+    return chunks, full * size + partial
+
+def max_key_length(args):
+    """Upper bound on the Json encoded length of a tile key"""
+    last = lambda v: max(args[v + '_start'], args[v + '_stop'] - 1)
+    fields = list(args['project_info']) + [
+        args['resolution'],
+        last('x') // args['x_tile_size'],
+        last('y') // args['y_tile_size'],
+        max(last('z'), args['final_z_stop']),
+        last('t'),
+    ]
+    base = '&'.join(map(str, fields))
+    return 2 + 32 + 1 + len(base) # quotes + md5 hex digest + '&'
+
+def plan(args, concurrency=None, latency=SQS_REQUEST_LATENCY):
+    """Compute the plan for populating the given tile space
+
+    Args:
+        args (dict): Same arguments as ingest_queue_upload.handler()
+        concurrency (None|int): Number of batches in flight, defaults to
+                                args['max_workers'] or SQS_MAX_WORKERS
+        latency (float): Average send_message_batch round trip, in seconds
+
+    Returns:
+        dict: {
+            'tiles': Number of tiles,
+            'chunks': Number of chunks,
+            'messages': Number of SQS messages (an upper bound if compact),
+            'requests': Number of send_message_batch calls, without retries,
+            'seconds': Estimated runtime,
+        }
+    """
+    if concurrency is None:
+        concurrency = args.get('max_workers', upload.SQS_MAX_WORKERS)
+
+    columns = count_steps(args, 't') * count_steps(args, 'y') * count_steps(args, 'x')
+    z_chunks, z_tiles = count_z_tiles(args)
+
+    tiles = columns * z_tiles
+    chunks = columns * z_chunks
+
+    if args.get('compact', False):
+        # Upper bound, as the actual packing depends on the length of each key
+        # Chunk keys have one more field than tile keys
+        per_tile = max_key_length(args) + 2
+        per_chunk = per_tile + 12
+
+        # Each message has the job id, may have unused space at the end, and
+        # may repeat the chunk key of the last chunk in the previous message
+        size = tiles * per_tile + chunks * per_chunk
+        capacity = upload.COMPACT_MESSAGE_BYTES - 64 - per_tile - 2 * per_chunk
+        messages = math.ceil(size / capacity)
+    else:
+        messages = tiles
+
+    requests = math.ceil(messages / upload.SQS_BATCH_SIZE)
+    seconds = math.ceil(requests / concurrency) * latency
+
+    return {
+        'tiles': tiles,
+        'chunks': chunks,
+        'messages': messages,
+        'requests': requests,
+        'seconds': seconds,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Plan the population of an ingest upload queue")
+    parser.add_argument("--shards",
+                        metavar = "<count>",
+                        type = int,
+                        default = 1,
+                        help = "Number of shards to split the tile space into (default: 1)")
+    parser.add_argument("--concurrency",
+                        metavar = "<workers>",
+                        type = int,
+                        default = None,
+                        help = "Number of SQS batches in flight (default: max_workers or {})".format(upload.SQS_MAX_WORKERS))
+    parser.add_argument("--latency",
+                        metavar = "<seconds>",
+                        type = float,
+                        default = SQS_REQUEST_LATENCY,
+                        help = "Average SQS request latency (default: {})".format(SQS_REQUEST_LATENCY))
+    parser.add_argument("file",
+                        type = argparse.FileType('r'),
+                        help = "Json file with the ingest_queue_upload.handler arguments")
+
+    args = parser.parse_args()
+    handler_args = json.load(args.file)
+
+    plans = [plan(shard, args.concurrency, args.latency)
+             for shard in upload.partition(handler_args, args.shards)]
+
+    fmt = "{:<8}{:>14}{:>12}{:>14}{:>12}{:>12}"
+    print(fmt.format("Shard", "Tiles", "Chunks", "Messages", "Requests", "Seconds"))
+    for i, p in enumerate(plans):
+        print(fmt.format(i, p['tiles'], p['chunks'], p['messages'], p['requests'], "{:.1f}".format(p['seconds'])))
+
+    if len(plans) > 1:
+        total = lambda k: sum(p[k] for p in plans)
+        print(fmt.format("Total", total('tiles'), total('chunks'), total('messages'), total('requests'),
+                         "{:.1f}".format(max(p['seconds'] for p in plans))))
+
+    sys.exit(0)
@@ -1,19 +1,46 @@
+import os
 import boto3
 import json
 import time
+import random
 import hashlib
+import threading
+from collections import OrderedDict
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 class FailedToSendMessages(Exception):
     pass
 
+class OutOfTime(Exception):
+    """Raised when the Lambda is about to time out, after the checkpoint is
+    saved, so Step Functions relaunches it to resume from the checkpoint"""
+    pass
+
 SQS_BATCH_SIZE = 10
-SQS_RETRY_TIMEOUT = 15
+SQS_RETRY_COUNT = 3
+SQS_RETRY_BACKOFF = 0.5 # Initial backoff, doubled for each retry
+SQS_RETRY_BACKOFF_MAX = 15
+SQS_MAX_WORKERS = 16 # Number of batches in flight at one time
+PROGRESS_INTERVAL = 30 # Seconds between progress messages
+SHARD_COUNT = 4 # Default number of shards, overridden by the SHARD_COUNT environment variable
+TIMEOUT_MARGIN = 30 # Seconds before the Lambda times out to stop sending batches
+SQS_MAX_BATCH_BYTES = 256 * 1024 # Limit on the total size of a send_message_batch call
+COMPACT_MESSAGE_BYTES = SQS_MAX_BATCH_BYTES // SQS_BATCH_SIZE # So a full batch stays under the limit
 
 def handler(args, context):
     """Populate the ingest upload SQS Queue with tile information
 
-    Note: This activity will clear the upload queue of any existing
-          messages
+    Note: If the CHECKPOINT_TABLE environment variable is set, the position
+          of the last committed batch is saved to that DynamoDB table and a
+          relaunched run will resume from that position. Batches that were
+          in flight when the previous run stopped are sent again, so the
+          queue may contain some duplicate messages. The returned count
+          includes the duplicates, so it matches the number of messages in
+          the queue.
+
+          If the Lambda is about to time out it stops sending, saves the
+          checkpoint, and raises OutOfTime so it can be relaunched.
 
     Args:
         args: {
@@ -40,65 +67,486 @@ def handler(args, context):
             'z_stop': 0
             'z_tile_size': 16,
             'final_z_stop': 0, The full extent of the Z dimension
+
+            'max_workers': 16, (Optional) Number of SQS batches to have in flight
+            'compact': False, (Optional) Use the compact message format
+                              See iter_compact_messages()
+            'dry_run': False, (Optional) Return the plan instead of
+                              populating the queue
         }
 
     Returns:
         int: Number of messages put into the queue
+        dict: If dry_run, the plan from ingest_queue_plan.plan()
     """
+    if args.get('dry_run', False):
+        # Imported here as ingest_queue_plan imports this module
+        from ingest_queue_plan import plan
+        return plan(args)
+
     print("Starting to populate upload queue")
 
-    queue = boto3.resource('sqs').Queue(args['upload_queue'])
+    max_workers = args.get('max_workers', SQS_MAX_WORKERS)
+    config = Config(max_pool_connections = max_workers)
+    client = boto3.client('sqs', config = config)
+
+    checkpoint = None
+    cursor = None
+    if os.environ.get('CHECKPOINT_TABLE'):
+        checkpoint = Checkpoint(os.environ['CHECKPOINT_TABLE'], args)
+        cursor = checkpoint.load()
+        if cursor is not None:
+            print("Resuming from {} with {} messages already sent".format(cursor, checkpoint.committed))
+
+    if args.get('compact', False):
+        msgs = iter_compact_messages(args, cursor)
+    else:
+        msgs = iter_messages(args, cursor)
+    out_of_time = None
+    if context is not None:
+        out_of_time = lambda: context.get_remaining_time_in_millis() < TIMEOUT_MARGIN * 1000
+    progress = enqueue(client, args['upload_queue'], msgs, max_workers, checkpoint, out_of_time)
+
+    print("Finished populating upload queue: {}".format(progress))
+
+    sent = progress.sent
+    if checkpoint is not None:
+        sent += checkpoint.committed
+        checkpoint.clear()
+    return sent
 
-    msgs = create_messages(args)
-    sent = 0
+class Checkpoint(object):
+    """Resume position for populating a tile space, stored in DynamoDB
 
-    while True:
-        batch = []
-        for i in range(SQS_BATCH_SIZE):
-            try:
-                batch.append({
-                    'Id': str(i),
-                    'MessageBody': next(msgs),
-                    'DelaySeconds': 0
-                })
-            except StopIteration:
-                break
+    The cursor is the (t, z, y, x, tile) position of the first message that
+    has not been committed. All messages before the cursor have been sent.
+    The sent count is the number of messages put into the queue by all runs,
+    including messages after the cursor that will be sent again.
+    """
+
+    def __init__(self, table, args):
+        """Constructor
+
+        Args:
+            table (str): Name of the DynamoDB table
+            args (dict): Same arguments as handler(), used to create the key
+                         for the job (and shard) being populated
+        """
+        self.table = boto3.resource('dynamodb').Table(table)
+        self.key = {'job_key': checkpoint_key(args)}
+        self.committed = 0 # Messages sent by previous runs
+
+    def load(self):
+        """Load the saved cursor
+
+        Returns:
+            list|None: The saved cursor or None if there is no checkpoint
+        """
+        resp = self.table.get_item(Key = self.key, ConsistentRead = True)
+        item = resp.get('Item')
+        if item is None:
+            return None
+
+        self.committed = int(item['sent'])
+        return [int(i) for i in item['cursor']]
+
+    def save(self, cursor, sent):
+        """Save the cursor
+
+        Args:
+            cursor (tuple): Position of the first uncommitted message
+            sent (int): Number of messages sent by this run
+        """
+        self.table.put_item(Item = {
+            'job_key': self.key['job_key'],
+            'cursor': list(cursor),
+            'sent': self.committed + sent,
+        })
+
+    def clear(self):
+        """Remove the checkpoint once the tile space is fully populated"""
+        self.table.delete_item(Key = self.key)
+
+def checkpoint_key(args):
+    """Create the checkpoint key for the job (and shard) described by args"""
+    fields = [args['job_id']]
+    for v in ('t', 'z', 'y', 'x'):
+        fields.extend([args[v + '_start'], args[v + '_stop']])
+    return '&'.join(map(str, fields))
+
+class Progress(object):
+    """Thread safe counters for the messages processed by enqueue()"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, sent=0, failed=0, retried=0):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+            self.retried += retried
+            self.requests += 1
+
+            now = time.time()
+            if now - self.last_report >= PROGRESS_INTERVAL:
+                self.last_report = now
+                print("Progress: {}".format(self))
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "{} sent, {} failed, {} retried, {} requests, {:.1f} msgs/sec".format(
+                    self.sent, self.failed, self.retried, self.requests, self.rate())
+
+def create_batches(msgs, size=SQS_BATCH_SIZE):
+    """Group the messages into send_message_batch entries
+
+    Args:
+        msgs (iter): Iterator of (position, message body) tuples
+        size (int): Maximum number of messages in a batch
 
+    Returns:
+        iter: Iterator of (position of first message, entries) tuples
+    """
+    batch = []
+    for position, msg in msgs:
         if len(batch) == 0:
-            break
-
-        retry = 3
-        while retry > 0:
-            resp = queue.send_messages(Entries=batch)
-            sent += len(resp['Successful'])
-
-            if 'Failed' in resp and len(resp['Failed']) > 0:
-                print("Batch failed to enqueue messages")
-                print("Retries left: {}".format(retry))
-                print("Boto3 send_messages response: {}".format(resp))
-                time.sleep(SQS_RETRY_TIMEOUT)
-
-                ids = [f['Id'] for f in resp['Failed']]
-                batch = [b for b in batch if b['Id'] in ids]
-                retry -= 1
-                if retry == 0:
-                    print("Exhausted retry count, stopping")
-                    raise FailedToSendMessages(batch) # SFN will relaunch the activity
-                continue
-            else:
-                break
+            start = position
 
-    return sent
+        batch.append({
+            'Id': str(len(batch)),
+            'MessageBody': msg,
+            'DelaySeconds': 0
+        })
+
+        if len(batch) == size:
+            yield start, batch
+            batch = []
+
+    if len(batch) > 0:
+        yield start, batch
+
+def send_batch(client, queue_url, batch, progress):
+    """Send a single batch of messages, retrying any failed messages
+
+    Args:
+        client: Boto3 SQS client
+        queue_url (str): URL of the queue to send the messages to
+        batch (list): List of send_message_batch entries
+        progress (Progress): Counters to update
+
+    Raises:
+        FailedToSendMessages: If the messages still fail after SQS_RETRY_COUNT attempts
+    """
+    backoff = SQS_RETRY_BACKOFF
+    retry = SQS_RETRY_COUNT
+    while True:
+        resp = client.send_message_batch(QueueUrl = queue_url, Entries = batch)
+        failed = resp.get('Failed', [])
+        progress.update(sent = len(resp.get('Successful', [])),
+                        failed = len(failed))
+
+        if len(failed) == 0:
+            return
+
+        retry -= 1
+        if retry == 0:
+            print("Exhausted retry count, stopping")
+            print("Boto3 send_message_batch response: {}".format(resp))
+            raise FailedToSendMessages(batch) # SFN will relaunch the activity
+
+        ids = [f['Id'] for f in failed]
+        batch = [b for b in batch if b['Id'] in ids]
+        progress.update(retried = len(batch))
+
+        # Full jitter, so throttled workers don't retry in lock step
+        time.sleep(random.uniform(0, backoff))
+        backoff = min(backoff * 2, SQS_RETRY_BACKOFF_MAX)
+
+def enqueue(client, queue_url, msgs, max_workers=SQS_MAX_WORKERS, checkpoint=None, out_of_time=None):
+    """Send all of the messages to the queue, keeping up to max_workers
+    batches in flight at one time
+
+    Messages are pulled from msgs as batches complete, so only about
+    max_workers batches are held in memory at one time. The checkpoint is
+    saved each time a batch is committed.
+
+    Args:
+        client: Boto3 SQS client
+        queue_url (str): URL of the queue to send the messages to
+        msgs (iter): Iterator of (position, message body) tuples
+        max_workers (int): Maximum number of batches in flight
+        checkpoint (None|Checkpoint): Where to save the position of the
+                                      first uncommitted batch
+        out_of_time (None|function): Function returning True when no more
+                                     batches should be started
+
+    Returns:
+        Progress: The final message counts
+
+    Raises:
+        FailedToSendMessages: If a batch could not be sent
+        OutOfTime: If out_of_time() returned True before all of the batches
+                   were sent
+    """
+    progress = Progress()
+    pending = {} # future: batch sequence number
+    inflight = OrderedDict() # sequence number: position of the batch
+    saved = None
+
+    def commit():
+        # Everything before the oldest inflight batch has been sent
+        nonlocal saved
+        if checkpoint is not None and len(inflight) > 0:
+            state = (next(iter(inflight.values())), progress.sent)
+            if state != saved:
+                checkpoint.save(*state)
+                saved = state
+
+    def check(done):
+        for future in done:
+            future.result() # Reraise any exception from the worker
+            del inflight[pending.pop(future)]
+        commit()
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        try:
+            for seq, (position, batch) in enumerate(create_batches(msgs)):
+                # Added before committing, so the checkpoint can move past
+                # the completed batches when nothing else is in flight
+                inflight[seq] = position
+
+                if len(pending) >= max_workers:
+                    done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                    check(done)
+
+                if out_of_time is not None and out_of_time():
+                    # The batch stays inflight, so it is the resume position
+                    raise OutOfTime("Stopped before {}".format(position))
+
+                future = executor.submit(send_batch, client, queue_url, batch, progress)
+                pending[future] = seq
+
+            done, _ = wait(pending)
+            check(done)
+        except Exception:
+            for future in pending:
+                future.cancel()
+
+            # Only commit the batches that were actually sent
+            wait(pending)
+            for future, seq in pending.items():
+                if not future.cancelled() and future.exception() is None:
+                    del inflight[seq]
+            commit()
+            raise
+
+    return progress
+
+def split_handler(args, context):
+    """Split the tile space into shards for populate_upload_queue.hsd
+
+    The number of shards is read from the SHARD_COUNT environment variable,
+    which is set to the number of parallel branches the step function was
+    created with.
+
+    Args:
+        args (dict): Same arguments as handler()
+
+    Returns:
+        list: List of SHARD_COUNT argument dictionaries, one per shard
+    """
+    return partition(args, int(os.environ.get('SHARD_COUNT', SHARD_COUNT)))
+
+def count_handler(args, context):
+    """Total the per shard message counts for populate_upload_queue.hsd
+
+    Args:
+        args (dict): Same arguments as handler(), plus
+            'counts': [0, ...], Number of messages each shard put into the queue
+
+    Returns:
+        dict: {
+            'arn': ARN, The upload queue
+            'count': 0, Total number of messages put into the queue
+        }, the input VerifyCount takes
+    """
+    return {
+        'arn': args['upload_queue'],
+        'count': sum(args['counts']),
+    }
+
+def partition(args, count):
+    """Split the tile space into disjoint, tile aligned sub-ranges
+
+    The axis with the most tiles is divided, so that the shards are close
+    to the same size. Each shard is a copy of args with the start / stop of
+    that axis narrowed. If there are fewer tiles than shards the extra
+    shards will have an empty range and produce no messages.
+
+    Note: final_z_stop is not changed, so the chunk keys generated for each
+          shard are the same as when enqueuing the full tile space
+
+    Args:
+        args (dict): Same arguments as handler()
+        count (int): Number of shards to create
 
-def create_messages(args):
+    Returns:
+        list: List of count argument dictionaries
+    """
+    steps = lambda v: len(range(args[v + '_start'], args[v + '_stop'], args[v + '_tile_size']))
+    axis = max(['t', 'z', 'y', 'x'], key = steps)
+
+    start = args[axis + '_start']
+    stop = args[axis + '_stop']
+    size = args[axis + '_tile_size']
+    total = steps(axis)
+
+    shards = []
+    for i in range(count):
+        shard = dict(args)
+        shard[axis + '_start'] = min(stop, start + (total * i // count) * size)
+        shard[axis + '_stop'] = min(stop, start + (total * (i + 1) // count) * size)
+        shards.append(shard)
+    return shards
+
+def create_messages(args, cursor=None):
     """Create all of the tile messages to be enqueued
 
     Args:
         args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position (t, z, y, x, tile) of the first message
+                            to create
 
     Returns:
         list: List of strings containing Json data
     """
+    for _, msg in iter_messages(args, cursor):
+        yield msg
+
+def iter_messages(args, cursor=None):
+    """Create all of the tile messages to be enqueued, with their positions
+
+    The part of the message that does not change between tiles is formatted
+    once and the Json encoded chunk key is reused for all of the tiles in
+    the chunk.
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position (t, z, y, x, tile) of the first message
+                            to create
+
+    Returns:
+        iter: Iterator of ((t, z, y, x, tile), Json data string) tuples
+    """
+    encode = json.encoder.encode_basestring_ascii
+
+    # Same format and field order as json.dumps() of the message dictionary
+    msg = json.dumps({
+        'job_id': args['job_id'],
+        'upload_queue_arn': args['upload_queue'],
+        'ingest_queue_arn': args['ingest_queue'],
+    })
+    msg = msg[:-1] + ', "chunk_key": '
+
+    last_chunk_key = None
+    for position, chunk_key, tile_key in iter_keys(args, cursor):
+        if chunk_key is not last_chunk_key:
+            last_chunk_key = chunk_key
+            chunk_msg = msg + encode(chunk_key) + ', "tile_key": '
+
+        yield position, chunk_msg + encode(tile_key) + '}'
+
+def iter_compact_messages(args, cursor=None, max_bytes=COMPACT_MESSAGE_BYTES):
+    """Create compact messages, each containing multiple tiles
+
+    The upload and ingest queue ARNs are not included, as the consumer can
+    get them from the job's configuration, and the tile keys are grouped by
+    chunk key:
+
+        {"j": job_id, "k": [[chunk_key, [tile_key, ...]], ...]}
+
+    Tiles are added to a message until it would be larger than max_bytes.
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position (t, z, y, x, tile) of the first tile
+                            to include
+        max_bytes (int): Maximum size of a message
+
+    Returns:
+        iter: Iterator of ((t, z, y, x, tile) of the first tile, Json data string) tuples
+    """
+    encode = json.encoder.encode_basestring_ascii
+
+    head = '{"j": ' + json.dumps(args['job_id']) + ', "k": ['
+
+    def build(groups):
+        chunks = ['[' + chunk + ', [' + ', '.join(tiles) + ']]' for chunk, tiles in groups]
+        return head + ', '.join(chunks) + ']}'
+
+    start = None
+    groups = []
+    size = len(head) + 2
+    last_chunk_key = None
+    for position, chunk_key, tile_key in iter_keys(args, cursor):
+        tile = encode(tile_key)
+
+        # Upper bound on the number of bytes the tile adds to the message
+        new_chunk = chunk_key is not last_chunk_key
+        extra = len(tile) + 2
+        if new_chunk:
+            extra += len(chunk_key) + 8
+
+        if len(groups) > 0 and size + extra > max_bytes:
+            yield start, build(groups)
+
+            groups = []
+            size = len(head) + 2
+            new_chunk = True
+            extra = len(tile) + len(chunk_key) + 10
+
+        if len(groups) == 0:
+            start = position
+
+        if new_chunk:
+            last_chunk_key = chunk_key
+            groups.append((encode(chunk_key), []))
+
+        groups[-1][1].append(tile)
+        size += extra
+
+    if len(groups) > 0:
+        yield start, build(groups)
+
+def iter_keys(args, cursor=None):
+    """Create the chunk and tile keys for all of the tiles to be enqueued
+
+    The parts of the keys that do not change between tiles are formatted
+    once, outside of the loops, and each chunk key is reused for all of the
+    tiles in the chunk.
+
+    Keys are created in (t, z, y, x, tile) order, so all of the tiles before
+    cursor can be skipped without creating their keys.
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (None|list): Position (t, z, y, x, tile) of the first tile
+                            to create keys for
+
+    Returns:
+        iter: Iterator of ((t, z, y, x, tile), chunk key, tile key) tuples
+    """
+    if cursor is not None:
+        cursor = tuple(cursor)
 
     tile_size = lambda v: args[v + "_tile_size"]
     range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
@@ -106,52 +554,45 @@ def create_messages(args):
     # DP NOTE: generic version of
     # BossBackend.encode_chunk_key and BossBackend.encode.tile_key
     # from ingest-client/ingestclient/core/backend.py
-    def hashed_key(*args):
-        base = '&'.join(map(str,args))
+    # Keys are formatted as '<md5 of base>&<base>' where base is the '&'
+    # joined key fields
+    def hashed_key(base):
+        return hashlib.md5(base.encode()).hexdigest() + '&' + base
 
-        md5 = hashlib.md5()
-        md5.update(base.encode())
-        digest = md5.hexdigest()
+    # Fields shared by the chunk and tile keys: 'col&exp&ch&res&'
+    prefix = '&'.join(map(str, list(args['project_info']) + [args['resolution']])) + '&'
 
-        return '&'.join([digest, base])
+    # (y, x, 'chunk_x&chunk_y&') for every chunk in a Z slice
+    xys = [(y, x, '{}&{}&'.format(int(x/tile_size('x')), int(y/tile_size('y'))))
+           for y in range_('y')
+           for x in range_('x')]
 
     for t in range_('t'):
+        if cursor is not None and t < cursor[0]:
+            continue
+
         for z in range_('z'):
-            for y in range_('y'):
-                for x in range_('x'):
-                    chunk_x = int(x/tile_size('x'))
-                    chunk_y = int(y/tile_size('y'))
-                    chunk_z = int(z/tile_size('z'))
-
-                    num_of_tiles = min(tile_size('z'), args['final_z_stop'] - z)
-
-                    chunk_key = hashed_key(num_of_tiles,
-                                           args['project_info'][0],
-                                           args['project_info'][1],
-                                           args['project_info'][2],
-                                           args['resolution'],
-                                           chunk_x,
-                                           chunk_y,
-                                           chunk_z,
-                                           t)
-
-                    for tile in range(z, z + num_of_tiles):
-                        tile_key = hashed_key(args['project_info'][0],
-                                              args['project_info'][1],
-                                              args['project_info'][2],
-                                              args['resolution'],
-                                              chunk_x,
-                                              chunk_y,
-                                              tile,
-                                              t)
-
-                        msg = {
-                            'job_id': args['job_id'],
-                            'upload_queue_arn': args['upload_queue'],
-                            'ingest_queue_arn': args['ingest_queue'],
-                            'chunk_key': chunk_key,
-                            'tile_key': tile_key,
-                        }
-
-                        yield json.dumps(msg)
+            if cursor is not None and (t, z) < cursor[:2]:
+                continue
+
+            num_of_tiles = min(tile_size('z'), args['final_z_stop'] - z)
+
+            chunk_prefix = str(num_of_tiles) + '&' + prefix
+            chunk_suffix = '{}&{}'.format(int(z/tile_size('z')), t)
+            tile_suffixes = ['{}&{}'.format(tile, t) for tile in range(z, z + num_of_tiles)]
+
+            for y, x, xy in xys:
+                if cursor is not None and (t, z, y, x) < cursor[:4]:
+                    continue
+
+                chunk_key = hashed_key(chunk_prefix + xy + chunk_suffix)
+                tile_prefix = prefix + xy
+
+                for tile, tile_suffix in zip(range(z, z + num_of_tiles), tile_suffixes):
+                    position = (t, z, y, x, tile)
+                    if cursor is not None:
+                        if position < cursor:
+                            continue
+                        cursor = None # Past the cursor, stop checking
 
+                    yield position, chunk_key, hashed_key(tile_prefix + tile_suffix)
@@ -26,13 +26,20 @@ Author:
 
 import os
 import time
+import atexit
 import json
 import re
 import sys
+import copy
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from boto3.session import Session
+from botocore.exceptions import ClientError
 
 from . import constants as const
 from . import hosts
+from . import utils
 
 def create_session(credentials):
     """Read the AWS from the credentials dictionary and then create a boto3
@@ -50,6 +57,513 @@ def create_session(credentials):
                       region_name = credentials.get('aws_region', const.REGION))
     return session
 
+LOOKUP_CACHE_TTL = 300 # seconds
+
+# Lookup specific TTLs, in seconds. Stable facts are kept for longer while
+# volatile ones, like instance IPs, expire quickly
+LOOKUP_TTLS = {
+    'vpc_id_lookup': 86400,
+    'subnet_id_lookup': 86400,
+    'azs_lookup': 86400,
+    'get_hosted_zone_id': 86400,
+    'get_account_id_from_session': 86400,
+    'role_arn_lookup': 86400,
+    'instance_profile_arn_lookup': 86400,
+    'ami_lookup': 3600,
+    'cert_arn_lookup': 3600,
+    'keypair_names': 3600,
+    'lambda_arn_lookup': 3600,
+    'machine_lookup': 60,
+    'machine_lookup_all': 60,
+    'rds_lookup': 3600, # The endpoint doesn't change for the life of the instance
+}
+
+# Lookups that are never saved to disk, because their results are changed by
+# other processes (bin/packer.py builds new AMIs) and would hide those changes
+LOOKUP_NOT_PERSISTED = {
+    'ami_lookup',
+}
+
+def _hashable(value):
+    """Convert the lists in a value loaded from Json back into tuples"""
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+def _negative(value):
+    """Determine if a lookup result means the resource was not found"""
+    if value is None or value is False:
+        return True
+    return isinstance(value, (list, tuple, dict)) and len(value) == 0
+
+class LookupCache(object):
+    """Memoizes the results of AWS lookups for the life of the process.
+
+    Entries are keyed by (access key, region, lookup name, arguments) so that
+    sessions for different accounts or regions never share results. Entries
+    expire after the TTL (or the lookup's TTL in LOOKUP_TTLS) and can be
+    explicitly invalidated after AWS resources are created, updated, or deleted.
+
+    Entries can be saved to and loaded from disk to share them between runs.
+    """
+
+    def __init__(self, ttl = LOOKUP_CACHE_TTL):
+        """Constructor
+
+        Args:
+            ttl (int|float) : Number of seconds an entry is valid for
+        """
+        self.ttl = ttl
+        self.entries = {}
+        self.inventories = {} # session key -> (expires, Inventory)
+        self.inventory_loaders = {} # session key -> function returning an Inventory
+        self.inventory_lock = threading.Lock() # Held while an Inventory is loaded
+        self.counts = {} # name -> [hits, misses]
+        self.recording = None # list of (name, args, kwargs, value) or None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def session_key(session):
+        """Identify the account and region a session is connected to
+
+        Args:
+            session (Session) : Active Boto3 session
+
+        Returns:
+            (tuple) : (access key, region name)
+        """
+        credentials = session.get_credentials()
+        access_key = None if credentials is None else credentials.access_key
+        return (access_key, session.region_name)
+
+    def get(self, key):
+        """Lookup a cached value, updating the hit / miss counters
+
+        Args:
+            key (tuple) : Cache key, key[2] is the name of the lookup
+
+        Returns:
+            (tuple) : (bool if the value was found, copy of the value)
+        """
+        with self.lock:
+            counts = self.counts.setdefault(key[2], [0, 0])
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                counts[0] += 1
+                return True, copy.deepcopy(entry[1])
+
+            counts[1] += 1
+            return False, None
+
+    def put(self, key, value):
+        """Cache a value until the TTL expires"""
+        ttl = LOOKUP_TTLS.get(key[2], self.ttl)
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, copy.deepcopy(value))
+
+    def load(self, path):
+        """Load the unexpired entries saved by save()
+
+        Args:
+            path (string) : File the entries were saved in
+        """
+        try:
+            with open(path, 'r') as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            return
+
+        # Json only has lists and dicts, restore the types lookups returned
+        types = {'tuple': _hashable, 'NoneDict': NoneDict}
+
+        now = time.time()
+        with self.lock:
+            for entry in entries:
+                try:
+                    key, expires, kind, value = entry
+                except (TypeError, ValueError): # Saved by an older version
+                    continue
+
+                if expires > now and key[2] not in LOOKUP_NOT_PERSISTED:
+                    if kind in types:
+                        value = types[kind](value)
+                    self.entries.setdefault(_hashable(key), (expires, value))
+
+    def save(self, path):
+        """Save the unexpired entries, so they can be loaded by another process
+
+        Lookups that didn't find anything (None, False, or empty) are not saved,
+        so a missing resource is looked up again by the next process. Lookups
+        in LOOKUP_NOT_PERSISTED are not saved either.
+
+        Args:
+            path (string) : File to save the entries in
+        """
+        now = time.time()
+        entries = []
+        with self.lock:
+            for key, (expires, value) in self.entries.items():
+                if expires <= now or _negative(value) or key[2] in LOOKUP_NOT_PERSISTED:
+                    continue
+                try:
+                    json.dumps(value)
+                except TypeError: # Only Json values can be saved
+                    continue
+                entries.append([key, expires, type(value).__name__, value])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as fh:
+            os.chmod(tmp, 0o600)
+            json.dump(entries, fh)
+        os.replace(tmp, path)
+
+    def record(self, name, args, kwargs, value):
+        """Record a lookup and its result, if recording has been started by
+        setting recording to a list"""
+        with self.lock:
+            if self.recording is not None:
+                self.recording.append((name, list(args), dict(kwargs), copy.deepcopy(value)))
+
+    def set_inventory(self, session, inventory):
+        """Cache an Inventory snapshot for the session until the TTL expires"""
+        with self.lock:
+            self.inventories[self.session_key(session)] = (time.time() + self.ttl, inventory)
+
+    def set_inventory_loader(self, session, loader):
+        """Load an Inventory snapshot for the session the first time it is used
+
+        Args:
+            session (Session) : Active Boto3 session
+            loader (function) : Function that returns the Inventory
+        """
+        with self.lock:
+            self.inventory_loaders[self.session_key(session)] = loader
+
+    def get_inventory(self, session):
+        """Get the cached Inventory snapshot for the session, loading it if
+        a loader was registered with set_inventory_loader()
+
+        Returns:
+            (Inventory|None) : Inventory or None if there is no valid snapshot
+        """
+        key = self.session_key(session)
+        def cached():
+            with self.lock:
+                entry = self.inventories.get(key)
+                if entry is not None and entry[0] > time.time():
+                    return entry[1], None
+                return None, self.inventory_loaders.get(key)
+
+        inventory, loader = cached()
+        if loader is None:
+            return inventory
+
+        # Only one thread loads the snapshot, the others wait for it
+        with self.inventory_lock:
+            inventory, loader = cached()
+            if loader is None:
+                return inventory
+
+            inventory = loader()
+            with self.lock:
+                self.inventory_loaders.pop(key, None)
+            self.set_inventory(session, inventory)
+            return inventory
+
+    def invalidate(self, session = None):
+        """Remove cached values and Inventory snapshots
+
+        Args:
+            session (Session|None) : Only remove values for the session's account
+                                     and region, or all values if None
+        """
+        with self.lock:
+            if session is None:
+                self.entries.clear()
+                self.inventories.clear()
+                self.inventory_loaders.clear()
+            else:
+                prefix = self.session_key(session)
+                for key in [k for k in self.entries if k[:2] == prefix]:
+                    del self.entries[key]
+                self.inventories.pop(prefix, None)
+                self.inventory_loaders.pop(prefix, None)
+
+    @property
+    def hits(self):
+        with self.lock:
+            return sum(c[0] for c in self.counts.values())
+
+    @property
+    def misses(self):
+        with self.lock:
+            return sum(c[1] for c in self.counts.values())
+
+    def __str__(self):
+        with self.lock:
+            lines = ["{:<35}{:>8}{:>8}".format("Lookup", "Hits", "Misses")]
+            for name in sorted(self.counts):
+                hits, misses = self.counts[name]
+                lines.append("{:<35}{:>8}{:>8}".format(name, hits, misses))
+            return "\n".join(lines)
+
+lookup_cache = LookupCache()
+
+def persist_lookup_cache(refresh = False, path = None):
+    """Share lookup_cache with other runs by loading the entries saved on disk
+    and saving the entries when the process exits.
+
+    Args:
+        refresh (bool) : Don't load the saved entries, repeating all lookups
+        path (string|None) : File the entries are saved in
+                             (default: constants.LOOKUP_CACHE_FILE)
+    """
+    if path is None:
+        path = const.LOOKUP_CACHE_FILE
+    if not refresh:
+        lookup_cache.load(path)
+    atexit.register(lookup_cache.save, path)
+
+def cached(func):
+    """Decorator that memoizes a lookup function in lookup_cache
+
+    The wrapped function must take a Boto3 session as the first argument.
+    Calls with a session of None are not cached.
+    """
+    @functools.wraps(func)
+    def wrapper(session, *args, **kwargs):
+        if session is None:
+            return func(session, *args, **kwargs)
+
+        key = (*LookupCache.session_key(session),
+               func.__name__,
+               args,
+               tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError: # Unhashable arguments cannot be cached
+            return func(session, *args, **kwargs)
+
+        found, value = lookup_cache.get(key)
+        if not found:
+            value = func(session, *args, **kwargs)
+            lookup_cache.put(key, value)
+        lookup_cache.record(func.__name__, args, kwargs, value)
+        return value
+    wrapper.cached = True
+    return wrapper
+
+def recorded(func):
+    """Decorator that records a lookup that is not cached in lookup_cache,
+    so the lookups a template depends on are all known to the template cache
+
+    The wrapped function must take a Boto3 session as the first argument.
+    """
+    @functools.wraps(func)
+    def wrapper(session, *args, **kwargs):
+        value = func(session, *args, **kwargs)
+        if session is not None:
+            lookup_cache.record(func.__name__, args, kwargs, value)
+        return value
+    return wrapper
+
+def _paginate(client, method, key, **kwargs):
+    """Iterate over all of the items returned by a describe / list call.
+
+    If the call supports pagination all pages are requested, else a single
+    request is made.
+
+    Args:
+        client (Client) : Boto3 client to make the call with
+        method (string) : Name of the client method to call
+        key (string) : Response key containing the list of items
+        kwargs : Arguments for the call
+
+    Returns:
+        (generator) : Generator of items
+    """
+    if client.can_paginate(method):
+        for page in client.get_paginator(method).paginate(**kwargs):
+            yield from page.get(key, [])
+    else:
+        yield from getattr(client, method)(**kwargs).get(key, [])
+
+def _name_tag(item):
+    tag = _find(item.get('Tags', []), lambda x: x['Key'] == 'Name')
+    return None if tag is None else tag['Value']
+
+INVENTORY_WORKERS = 7 # One per type of resource loaded
+
+class Inventory(object):
+    """Snapshot of the resources in an AWS account, indexed by name.
+
+    All of the EC2 instances, subnets, security groups and route tables in a VPC
+    and all of the ELBs, SQS queues and SNS topics in the region are loaded with
+    a few paginated bulk requests, made concurrently.
+
+    Once registered with load_inventory() the single item lookup functions are
+    answered from the snapshot. Names missing from the snapshot fall back to
+    querying AWS, so a stale snapshot never hides a new resource. If one of the
+    bulk requests fails, for example because the caller is not allowed to make
+    it, that type of resource is left empty and looked up one at a time.
+    """
+
+    def __init__(self, session, vpc_domain = None, max_workers = INVENTORY_WORKERS):
+        """Constructor
+
+        Args:
+            session (Session) : Active Boto3 session
+            vpc_domain (string|None) : Name of the VPC to load EC2 resources for
+                                       If None, EC2 resources for all VPCs are
+                                       loaded. If the VPC doesn't exist no EC2
+                                       resources are loaded
+            max_workers (int) : Number of requests to make concurrently
+        """
+        self.vpc_id = None if vpc_domain is None else vpc_id_lookup(session, vpc_domain)
+
+        # Boto3 sessions are not thread safe, clients are
+        ec2 = session.client('ec2')
+        elb = session.client('elb')
+        sqs = session.client('sqs')
+        sns = session.client('sns')
+
+        loaders = {
+            'elbs': lambda: list(_paginate(elb, 'describe_load_balancers', 'LoadBalancerDescriptions')),
+            'queues': lambda: list(_paginate(sqs, 'list_queues', 'QueueUrls')),
+            'topics': lambda: list(_paginate(sns, 'list_topics', 'Topics')),
+        }
+
+        if vpc_domain is None or self.vpc_id is not None:
+            filters = [] if self.vpc_id is None else [{"Name": "vpc-id", "Values": [self.vpc_id]}]
+            loaders.update({
+                'reservations': lambda: list(_paginate(ec2, 'describe_instances', 'Reservations', Filters=filters)),
+                'subnets': lambda: list(_paginate(ec2, 'describe_subnets', 'Subnets', Filters=filters)),
+                'sgs': lambda: list(_paginate(ec2, 'describe_security_groups', 'SecurityGroups', Filters=filters)),
+                'rts': lambda: list(_paginate(ec2, 'describe_route_tables', 'RouteTables', Filters=filters)),
+            })
+
+        def load(name):
+            try:
+                return loaders[name]()
+            except ClientError as ex:
+                print("Could not load {} for the inventory, looking them up individually: {}".format(name, ex))
+                return []
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = {k: executor.submit(load, k) for k in loaders}
+            results = {k: f.result() for k, f in futures.items()}
+
+        self.instances = {} # name -> [instance, ...] sorted by InstanceId
+        for reservation in results.get('reservations', []):
+            for instance in reservation['Instances']:
+                self.instances.setdefault(_name_tag(instance), []).append(instance)
+        for instances in self.instances.values():
+            instances.sort(key = lambda i: i['InstanceId'])
+
+        # Keep the first subnet / route table with a name, like describe_*()[0] does
+        self.subnets = {} # name -> id
+        for subnet in results.get('subnets', []):
+            self.subnets.setdefault(_name_tag(subnet), subnet['SubnetId'])
+
+        self.security_groups = {} # vpc id -> {name: id}
+        for sg in results.get('sgs', []):
+            self.security_groups.setdefault(sg['VpcId'], NoneDict())[_name_tag(sg)] = sg['GroupId']
+
+        self.route_tables = {} # (vpc id, name) -> id
+        for rt in results.get('rts', []):
+            self.route_tables.setdefault((rt['VpcId'], _name_tag(rt)), rt['RouteTableId'])
+
+        self.elbs = set(lb['LoadBalancerName'] for lb in results['elbs'])
+        self.queues = {url.split('/')[-1]: url for url in results['queues']}
+        self.topics = {t['TopicArn'].split(':')[-1]: t['TopicArn'] for t in results['topics']}
+
+    def running_instances(self, hostname):
+        """Get the running instances with the given name, sorted by InstanceId"""
+        return [i for i in self.instances.get(hostname, [])
+                if i['State']['Name'] == 'running']
+
+def load_inventory(session, vpc_domain = None, lazy = False):
+    """Load an Inventory snapshot and use it to answer lookups for the session.
+
+    The snapshot is discarded with the rest of the lookup_cache, when the TTL
+    expires or when resources are created, updated, or deleted.
+
+    Args:
+        session (Session|None) : Boto3 session used to lookup information in AWS
+                                 If session is None no lookup is performed
+        vpc_domain (string|None) : Name of the VPC to load EC2 resources for
+        lazy (bool) : Wait to load the snapshot until a lookup uses it
+
+    Returns:
+        (Inventory|None) : The loaded snapshot or None if session is None or
+                           lazy is True
+    """
+    if session is None:
+        return None
+
+    if lazy:
+        lookup_cache.set_inventory_loader(session, lambda: Inventory(session, vpc_domain))
+        return None
+
+    inventory = Inventory(session, vpc_domain)
+    lookup_cache.set_inventory(session, inventory)
+    return inventory
+
+def iter_instances(session, hostname = None, states = ("running",)):
+    """Iterate over the EC2 instances with the given name.
+
+    All instances in every reservation of every page of results are returned.
+    Pages are requested as the generator is consumed, so stopping early avoids
+    requesting the remaining pages.
+
+    Args:
+        session (Session) : Active Boto3 session
+        hostname (string|None) : Name of the EC2 instances or None for all instances
+        states (list|None) : Instance states to include or None for all states
+
+    Returns:
+        (generator) : Generator of instance dictionaries
+    """
+    filters = []
+    if hostname is not None:
+        filters.append({"Name":"tag:Name", "Values":[hostname]})
+    if states is not None:
+        filters.append({"Name":"instance-state-name", "Values":list(states)})
+
+    client = session.client('ec2')
+    for reservation in _paginate(client, 'describe_instances', 'Reservations', Filters=filters):
+        yield from reservation['Instances']
+
+def iter_security_groups(session, vpc_id):
+    """Iterate over all of the Security Groups in the given VPC.
+
+    Args:
+        session (Session) : Active Boto3 session
+        vpc_id (string) : VPC ID of the VPC to search in
+
+    Returns:
+        (generator) : Generator of security group dictionaries
+    """
+    client = session.client('ec2')
+    yield from _paginate(client, 'describe_security_groups', 'SecurityGroups',
+                         Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+
+def iter_images(session, name):
+    """Iterate over all of the AMIs with the given name.
+
+    Args:
+        session (Session) : Active Boto3 session
+        name (string) : AMI name, may contain '*' and '?' wildcards
+
+    Returns:
+        (generator) : Generator of image dictionaries
+    """
+    client = session.client('ec2')
+    yield from _paginate(client, 'describe_images', 'Images',
+                         Filters=[{"Name": "name", "Values": [name]}])
+
+@cached
 def machine_lookup_all(session, hostname, public_ip = True):
     """Lookup all of the IP addresses for a given AWS instance name.
 
@@ -65,21 +579,21 @@ def machine_lookup_all(session, hostname, public_ip = True):
     Returns:
         (list) : List of IP addresses
     """
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and hostname in inventory.instances:
+        items = inventory.running_instances(hostname)
+    else:
+        items = iter_instances(session, hostname)
 
     addresses = []
-    items = response['Reservations']
-    if len(items) > 0:
-        for i in items:
-            item = i['Instances'][0]
-            if 'PublicIpAddress' in item and public_ip:
-                addresses.append(item['PublicIpAddress'])
-            elif 'PrivateIpAddress' in item and not public_ip:
-                addresses.append(item['PrivateIpAddress'])
+    for item in items:
+        if 'PublicIpAddress' in item and public_ip:
+            addresses.append(item['PublicIpAddress'])
+        elif 'PrivateIpAddress' in item and not public_ip:
+            addresses.append(item['PrivateIpAddress'])
     return addresses
 
+@cached
 def machine_lookup(session, hostname, public_ip = True):
     """Lookup the IP addresses for a given AWS instance name.
 
@@ -107,22 +621,23 @@ def machine_lookup(session, hostname, public_ip = True):
     except:
         idx = 0
 
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and hostname in inventory.instances:
+        item = inventory.running_instances(hostname)
+    else:
+        item = list(iter_instances(session, hostname))
 
-    item = response['Reservations']
     if len(item) == 0:
         print("Could not find IP address for '{}'".format(hostname))
         return None
     else:
-        item.sort(key = lambda i: i['Instances'][0]["InstanceId"])
+        item.sort(key = lambda i: i["InstanceId"])
 
         if len(item) <= idx:
             print("Could not find IP address for '{}' index '{}'".format(hostname, idx))
             return None
         else:
-            item = item[idx]['Instances'][0]
+            item = item[idx]
             if 'PublicIpAddress' in item and public_ip:
                 return item['PublicIpAddress']
             elif 'PrivateIpAddress' in item and not public_ip:
@@ -131,6 +646,7 @@ def machine_lookup(session, hostname, public_ip = True):
                 print("Could not find IP address for '{}'".format(hostname))
                 return None
 
+@cached
 def rds_lookup(session, hostname):
     """Lookup the public DNS for a given AWS RDS instance name.
 
@@ -175,22 +691,21 @@ def asg_restart(session, hostname, timeout, callback=None):
     """Terminate all of the instances for an ASG, with the given timeout between
     each termination.
     """
-    client = session.client('ec2')
     resource = session.resource('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
 
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            id = instance['InstanceId']
-            print("Terminating {} instance {}".format(hostname, id))
-            resource.Instance(id).terminate()
-            print("Sleeping for {} minutes".format(timeout/60.0))
-            time.sleep(timeout)
+    # Collect the ids first, so the instances that are started as replacements
+    # are not terminated
+    ids = [instance['InstanceId'] for instance in iter_instances(session, hostname)]
+    for id in ids:
+        print("Terminating {} instance {}".format(hostname, id))
+        resource.Instance(id).terminate()
+        print("Sleeping for {} minutes".format(timeout/60.0))
+        time.sleep(timeout)
 
-            if callback is not None:
-                callback()
+        if callback is not None:
+            callback()
 
+@cached
 def asg_name_lookup(session, hostname):
     """Lookup the Group name for the ASG creating the EC2 instances with the given hostname
 
@@ -217,6 +732,7 @@ def asg_name_lookup(session, hostname):
                 return g['AutoScalingGroupName']
         return None
 
+@cached
 def vpc_id_lookup(session, vpc_domain):
     """Lookup the Id for the VPC with the given domain name.
 
@@ -239,6 +755,7 @@ def vpc_id_lookup(session, vpc_domain):
         return response['Vpcs'][0]['VpcId']
 
 
+@cached
 def subnet_id_lookup(session, subnet_domain):
     """Lookup the Id for the Subnet with the given domain name.
 
@@ -253,6 +770,10 @@ def subnet_id_lookup(session, subnet_domain):
     if session is None:
         return None
 
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and subnet_domain in inventory.subnets:
+        return inventory.subnets[subnet_domain]
+
     client = session.client('ec2')
     response = client.describe_subnets(Filters=[{"Name": "tag:Name", "Values": [subnet_domain]}])
     if len(response['Subnets']) == 0:
@@ -260,6 +781,7 @@ def subnet_id_lookup(session, subnet_domain):
     else:
         return response['Subnets'][0]['SubnetId']
 
+@cached
 def azs_lookup(session, lambda_compatible_only=False):
     """Lookup all of the Availablity Zones for the connected region.
 
@@ -289,6 +811,7 @@ def azs_lookup(session, lambda_compatible_only=False):
                 rtn.remove(az)
     return rtn
 
+@cached
 def ami_lookup(session, ami_name, version = None):
     """Lookup the Id for the AMI with the given name.
 
@@ -322,17 +845,14 @@ def ami_lookup(session, ami_name, version = None):
     else:
         ami_search = ami_name
 
-    client = session.client('ec2')
-    response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_search]}])
-    if len(response['Images']) == 0:
+    image = max(iter_images(session, ami_search), key=lambda x: x["CreationDate"], default=None)
+    if image is None:
         if specific:
             print("Could not locate AMI '{}', trying to find the latest '{}' AMI".format(ami_search, ami_name))
             return ami_lookup(session, ami_name, version = "latest")
         else:
             return None
     else:
-        response['Images'].sort(key=lambda x: x["CreationDate"], reverse=True)
-        image = response['Images'][0]
         ami = image['ImageId']
         tag = _find(image.get('Tags', []), lambda x: x["Key"] == "Commit")
         commit = None if tag is None else tag["Value"]
@@ -350,6 +870,7 @@ class NoneDict(dict):
         else:
             return super().__getitem__(key)
 
+@cached
 def sg_lookup_all(session, vpc_id):
     """Lookup the Ids for all of the VPC Security Groups.
 
@@ -366,21 +887,17 @@ def sg_lookup_all(session, vpc_id):
     if session is None:
         return NoneDict()
 
-    client = session.client('ec2')
-    response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and vpc_id in inventory.security_groups:
+        return NoneDict(inventory.security_groups[vpc_id])
 
-    if len(response['SecurityGroups']) == 0:
-        return NoneDict()
-    else:
-        sgs = NoneDict()
-        for sg in response['SecurityGroups']:
-            key = _find(sg.get('Tags', []), lambda x: x["Key"] == "Name")
-            if key:
-                key = key['Value']
-            sgs[key] = sg['GroupId']
+    sgs = NoneDict()
+    for sg in iter_security_groups(session, vpc_id):
+        sgs[_name_tag(sg)] = sg['GroupId']
 
-        return sgs
+    return sgs
 
+@cached
 def sg_lookup(session, vpc_id, group_name):
     """Lookup the Id for the VPC Security Group with the given name.
 
@@ -396,6 +913,10 @@ def sg_lookup(session, vpc_id, group_name):
     if session is None:
         return None
 
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and group_name in inventory.security_groups.get(vpc_id, {}):
+        return inventory.security_groups[vpc_id][group_name]
+
     client = session.client('ec2')
     response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
                                                         {"Name": "tag:Name", "Values": [group_name]}])
@@ -405,6 +926,7 @@ def sg_lookup(session, vpc_id, group_name):
     else:
         return response['SecurityGroups'][0]['GroupId']
 
+@cached
 def rt_lookup(session, vpc_id, rt_name):
     """Lookup the Id for the VPC Route Table with the given name.
 
@@ -420,6 +942,10 @@ def rt_lookup(session, vpc_id, rt_name):
     if session is None:
         return None
 
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and (vpc_id, rt_name) in inventory.route_tables:
+        return inventory.route_tables[(vpc_id, rt_name)]
+
     client = session.client('ec2')
     response = client.describe_route_tables(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
                                                      {"Name": "tag:Name", "Values": [rt_name]}])
@@ -466,6 +992,7 @@ def rt_name_default(session, vpc_id, new_rt_name):
     response = rt.create_tags(Tags=[{"Key": "Name", "Value": new_rt_name}])
 
 
+@cached
 def peering_lookup(session, from_id, to_id, owner_id=None):
     """Lookup the Id for the Peering Connection between the two VPCs.
 
@@ -508,6 +1035,21 @@ def peering_lookup(session, from_id, to_id, owner_id=None):
         return response['VpcPeeringConnections'][0]['VpcPeeringConnectionId']
 
 
+@cached
+def keypair_names(session):
+    """Lookup the names of the Key Pairs in the account.
+
+    Args:
+        session (Session) : Active Boto3 session
+
+    Returns:
+        (list) : List of Key Pair names
+    """
+    client = session.client('ec2')
+    response = client.describe_key_pairs()
+    return [kp['KeyName'] for kp in response['KeyPairs']]
+
+@recorded
 def keypair_lookup(session):
     """Lookup the names of valid Key Pair.
 
@@ -525,8 +1067,7 @@ def keypair_lookup(session):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_key_pairs()
+    names = keypair_names(session)
 
     # If SSH_KEY exists and points to a valid Key Pair, use it
     key = os.environ.get("SSH_KEY", None)  # reuse bastion.py env vars
@@ -534,26 +1075,27 @@ def keypair_lookup(session):
         kp_name = os.path.basename(key)
         if kp_name.endswith(".pem"):
             kp_name = kp_name[:-4]
-        for kp in response['KeyPairs']:
-            if kp["KeyName"] == kp_name:
-                return kp_name
-
-    print("Key Pairs")
-    for i in range(len(response['KeyPairs'])):
-        print("{}:  {}".format(i, response['KeyPairs'][i]['KeyName']))
-    if len(response['KeyPairs']) == 0:
-        return None
-    while True:
-        try:
-            idx = input("[0]: ")
-            idx = int(idx if len(idx) > 0 else "0")
-            return response['KeyPairs'][idx]['KeyName']
-        except KeyboardInterrupt:
-            sys.exit(1)
-        except:
-            print("Invalid Key Pair number, try again")
-
-
+        if kp_name in names:
+            return kp_name
+
+    with utils.console_lock:
+        print("Key Pairs")
+        for i in range(len(names)):
+            print("{}:  {}".format(i, names[i]))
+        if len(names) == 0:
+            return None
+        while True:
+            try:
+                idx = input("[0]: ")
+                idx = int(idx if len(idx) > 0 else "0")
+                return names[idx]
+            except KeyboardInterrupt:
+                sys.exit(1)
+            except:
+                print("Invalid Key Pair number, try again")
+
+
+@recorded
 def instanceid_lookup(session, hostname):
     """Look up instance id by hostname (instance name).
 
@@ -568,24 +1110,18 @@ def instanceid_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_instances(
-        Filters=[{"Name": "tag:Name", "Values": [hostname]}])
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and hostname in inventory.instances:
+        return inventory.instances[hostname][0]['InstanceId']
 
-    item = response['Reservations']
-    if len(item) == 0:
+    item = next(iter_instances(session, hostname, states = None), None)
+    if item is None:
         return None
     else:
-        item = item[0]['Instances']
-        if len(item) == 0:
-            return None
-        else:
-            item = item[0]
-            if 'InstanceId' in item:
-                return item['InstanceId']
-            return None
+        return item.get('InstanceId')
 
 
+@cached
 def cert_arn_lookup(session, domain_name):
     """Looks up the ARN for a SSL Certificate
 
@@ -646,6 +1182,7 @@ def instance_public_lookup(session, hostname):
             return None
 
 
+@recorded
 def cloudfront_public_lookup(session, hostname):
     """
     Lookup cloudfront public domain name which has hostname as the origin.
@@ -673,6 +1210,7 @@ def cloudfront_public_lookup(session, hostname):
     return None
 
 
+@recorded
 def elb_public_lookup(session, hostname):
     """Lookup the Public DNS name for a ELB
 
@@ -701,6 +1239,7 @@ def elb_public_lookup(session, hostname):
 
 # Should be something more like elb_check / elb_name_check, because
 # _lookup is normally used to return the ID of something
+@cached
 def lb_lookup(session, lb_name):
     """Look up ELB Id by name
 
@@ -717,6 +1256,10 @@ def lb_lookup(session, lb_name):
 
     lb_name = lb_name.replace('.', '-')
 
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and lb_name in inventory.elbs:
+        return True
+
     client = session.client('elb')
     response = client.describe_load_balancers()
 
@@ -726,6 +1269,7 @@ def lb_lookup(session, lb_name):
     return False
 
 
+@cached
 def sns_topic_lookup(session, topic_name):
     """Lookup up SNS topic ARN given a topic name
 
@@ -740,6 +1284,10 @@ def sns_topic_lookup(session, topic_name):
     if session is None:
         return None
 
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and topic_name in inventory.topics:
+        return inventory.topics[topic_name]
+
     client = session.client('sns')
     response = client.list_topics()
     topics_list = response['Topics']
@@ -766,6 +1314,7 @@ def sqs_delete_all(session, domain):
     for url in resp.get('QueueUrls', []):
         client.delete_queue(QueueUrl=url)
 
+@recorded
 def sqs_lookup_url(session, queue_name):
     """Lookup up SQS url given a name.
 
@@ -779,6 +1328,10 @@ def sqs_lookup_url(session, queue_name):
     Raises:
         (boto3.ClientError): If queue not found.
     """
+    inventory = lookup_cache.get_inventory(session)
+    if inventory is not None and queue_name in inventory.queues:
+        return inventory.queues[queue_name]
+
     client = session.client('sqs')
     resp = client.get_queue_url(QueueName=queue_name)
     return resp['QueueUrl']
@@ -809,6 +1362,7 @@ def request_cert(session, domain_name, validation_domain):
     ]
     response = client.request_certificate(DomainName=domain_name,
                                           DomainValidationOptions=validation_options)
+    lookup_cache.invalidate(session)
     return response
 
 def get_hosted_zone(session):
@@ -829,6 +1383,7 @@ def get_hosted_zone(session):
     else:
         return None
 
+@cached
 def get_hosted_zone_id(session, hosted_zone):
     """Look up Hosted Zone ID by DNS Name
 
@@ -848,8 +1403,13 @@ def get_hosted_zone_id(session, hosted_zone):
         DNSName=hosted_zone,
         MaxItems='1'
     )
-    if len(response['HostedZones']) >= 1:
-        full_id = response['HostedZones'][0]['Id']
+
+    # Zones are listed starting at DNSName, so the first zone is only the
+    # requested zone if the (fully qualified) names match
+    name = hosted_zone if hosted_zone.endswith('.') else hosted_zone + '.'
+    zone = _find(response['HostedZones'], lambda z: z['Name'] == name)
+    if zone is not None:
+        full_id = zone['Id']
         id_parts = full_id.split('/')
         return id_parts.pop()
     else:
@@ -1041,6 +1601,7 @@ def sns_create_topic(session, topic):
 
     client = session.client("sns")
     response = client.create_topic(Name=topic)
+    lookup_cache.invalidate(session)
     print(response)
     if response is None:
         return None
@@ -1076,6 +1637,7 @@ def policy_delete_all(session, domain, path="/"):
                     client.detach_role_policy(RoleName=role['RoleName'], PolicyArn=ARN)
             client.delete_policy(PolicyArn=ARN)
 
+@cached
 def role_arn_lookup(session, role_name):
     """
     Returns the arn associated the the role name.
@@ -1097,6 +1659,7 @@ def role_arn_lookup(session, role_name):
     else:
         return response['Role']['Arn']
 
+@cached
 def instance_profile_arn_lookup(session, instance_profile_name):
     """
     Returns the arn associated the the role name.
@@ -1119,6 +1682,7 @@ def instance_profile_arn_lookup(session, instance_profile_name):
         return response['InstanceProfile']['Arn']
 
 
+@recorded
 def s3_bucket_exists(session, name):
     """Test for existence of an S3 bucket.
 
@@ -1140,6 +1704,7 @@ def s3_bucket_exists(session, name):
 
     return False
 
+@cached
 def get_account_id_from_session(session):
     """
     gets the account id from the session using the iam client.  This method will work even
@@ -1208,6 +1773,7 @@ def get_lambda_server_key(session):
         raise NameError("Unknown session account used, {}, lambda_build_server for this session is unknown.".format(account))
 
 
+@cached
 def lambda_arn_lookup(session, lambda_name):
     """
     Returns the arn for a lambda given a lambda function name.
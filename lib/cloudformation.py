@@ -22,11 +22,22 @@ Author:
 import os
 import time
 import json
+import hashlib
 from botocore.exceptions import ClientError
 
 from . import hosts
 from . import aws
 from . import utils
+from . import template_diff
+from . import nested_stacks
+
+POLL_MIN_DELAY = 1 # seconds
+POLL_MAX_DELAY = 15 # seconds
+
+FINGERPRINT_TAG = "TemplateHash"
+
+TEMPLATE_BODY_LIMIT = 51200 # bytes, largest template that can be passed as TemplateBody
+TEMPLATE_S3_PREFIX = "cloudformation/"
 
 def get_scenario(var, default = None):
     """Handle getting the appropriate value from a variable using the SCENARIO
@@ -407,25 +418,170 @@ class CloudFormationConfiguration:
         if self.vpc_subnet is None:
             raise Exception("'{}' is not a valid stack domain".format(domain))
 
-    def _create_template(self, description="", indent=None):
+    def _create_template(self, description="", indent=None, template=None):
         """Create the JSON CloudFormation template from the resources that have
         be added to the object.
 
         Args:
             description (string) : Template description
+            template (None|dict) : Template to encode instead of the object's
+                                   resources
+
+        Returns:
+            (string) : The JSON formatted CloudFormation template, without any
+                       whitespace if indent is None
+        """
+        if template is None:
+            template = {"AWSTemplateFormatVersion" : "2010-09-09",
+                        "Description" : description,
+                        "Parameters": self.parameters,
+                        "Resources": self.resources}
+
+        separators = (',', ':') if indent is None else None
+        return json.dumps(template, indent=indent, separators=separators)
+
+    def _template_url(self, session, template, upload = True):
+        """Get the S3 URL of a template, uploading it if needed.
+
+        Templates are stored in the Lambda S3 bucket, under a key based on the
+        template's hash. If the key already exists the template is not uploaded
+        again.
+
+        Args:
+            session (Session) : Boto3 session used to upload the template
+            template (bytes) : Encoded template
+            upload (bool) : If False only compute the URL
+
+        Returns:
+            (string) : TemplateURL
+        """
+        bucket = aws.get_lambda_s3_bucket(session)
+        key = TEMPLATE_S3_PREFIX + hashlib.sha256(template).hexdigest() + ".template"
+
+        if upload:
+            client = session.client('s3')
+            try:
+                client.head_object(Bucket = bucket, Key = key)
+            except ClientError:
+                print("Uploading {} byte template to s3://{}/{}".format(len(template), bucket, key))
+                client.put_object(Bucket = bucket, Key = key, Body = template)
+
+        return "https://s3.amazonaws.com/{}/{}".format(bucket, key)
+
+    def _deployed_template(self, session):
+        """Get the template the stack was last created / updated with
+
+        Returns:
+            (dict|None) : Template or None if the stack doesn't exist
+        """
+        client = session.client('cloudformation')
+        try:
+            template = client.get_template(StackName = self.stack_name)['TemplateBody']
+        except ClientError:
+            return None
+
+        if isinstance(template, str): # JSON templates are already decoded by Boto3
+            template = json.loads(template)
+        return template
+
+    def _nested_template(self, session, upload = True):
+        """Get the template, split into nested stacks if it has more than
+        nested_stacks.STACK_RESOURCE_LIMIT resources.
+
+        Each child stack template is uploaded under a key based on its hash, so
+        only the child stacks whose resources changed have a new TemplateURL
+        and are updated by CloudFormation. If the stack is already split, the
+        resources are kept in the child stacks they were deployed in.
+
+        Splitting a stack that is deployed without nested stacks moves (and
+        replaces) all of its resources, so it is refused unless the SPLIT_STACK
+        environment variable is true.
+
+        Args:
+            session (Session) : Boto3 session used to upload the child templates
+            upload (bool) : If False only compute the child template URLs
+
+        Returns:
+            (dict) : Template
+
+        Raises:
+            Exception : If a stack deployed without nested stacks would be split
+        """
+        template = json.loads(self._create_template())
+        if len(self.resources) <= nested_stacks.STACK_RESOURCE_LIMIT:
+            return template
+
+        deployed = self._deployed_template(session)
+        previous = None if deployed is None else nested_stacks.layout(deployed)
+        if upload and deployed is not None and previous is None:
+            split = str(os.environ.get("SPLIT_STACK")).lower() in ('yes', 'true', 'y', 't')
+            if not split:
+                raise Exception("Stack '{}' has more than {} resources. Splitting it into nested stacks " \
+                                "replaces all of its resources, use --split-stack to split it anyway" \
+                                .format(self.stack_name, nested_stacks.STACK_RESOURCE_LIMIT))
+
+        def template_url(child):
+            return self._template_url(session, self._create_template(template=child).encode(), upload)
+
+        return nested_stacks.split_template(template, template_url, previous = previous)
+
+    def _template_args(self, session):
+        """Get the arguments used to pass the template to CloudFormation.
+
+        Templates larger than TEMPLATE_BODY_LIMIT are uploaded to S3 and
+        passed as a TemplateURL.
+
+        Args:
+            session (Session) : Boto3 session used to upload the template
 
         Returns:
-            (string) : The JSON formatted CloudFormation template
+            (dict) : Dictionary with either the TemplateBody or TemplateURL key
         """
-        return json.dumps({"AWSTemplateFormatVersion" : "2010-09-09",
-                           "Description" : description,
-                           "Parameters": self.parameters,
-                           "Resources": self.resources}, indent=indent)
+        template = self._create_template(template=self._nested_template(session)).encode()
+        if len(template) <= TEMPLATE_BODY_LIMIT:
+            return {'TemplateBody': template.decode()}
+
+        return {'TemplateURL': self._template_url(session, template)}
+
+    def _fingerprint(self):
+        """Compute a content hash of the template and arguments.
+
+        The hash is computed over a canonical (key sorted) encoding, so the same
+        template and arguments always have the same hash.
+
+        Returns:
+            (string) : SHA256 hex digest
+        """
+        data = json.dumps({"Parameters": self.parameters,
+                           "Resources": self.resources,
+                           "Arguments": self.arguments},
+                          sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _tags(self, commit):
+        return [
+            {"Key": "Commit", "Value": commit},
+            {"Key": FINGERPRINT_TAG, "Value": self._fingerprint()},
+        ]
+
+    def _deployed_fingerprint(self, client):
+        """Get the template hash the stack was last created / updated with
+
+        Returns:
+            (string|None) : Hash or None if the stack wasn't tagged with one
+        """
+        response = client.describe_stacks(StackName=self.stack_name)
+        for stack in response['Stacks']:
+            for tag in stack.get('Tags', []):
+                if tag['Key'] == FINGERPRINT_TAG:
+                    return tag['Value']
+        return None
 
     def generate(self):
         """Generate the CloudFormation template and arguments files """
         cur_dir = os.path.dirname(os.path.realpath(__file__))
         folder = os.path.realpath(os.path.join(cur_dir, '..', 'cloud_formation', 'templates'))
+        os.makedirs(folder, exist_ok=True)
 
         with open(os.path.join(folder, self.stack_name + ".template"), "w") as fh:
             fh.write(self._create_template(indent=4))
@@ -433,20 +589,117 @@ class CloudFormationConfiguration:
         with open(os.path.join(folder, self.stack_name + ".arguments"), "w") as fh:
             json.dump(self.arguments, fh, indent=4)
 
-    def _poll(self, client, name, action, process):
-        get_status = lambda r: r['Stacks'][0]['StackStatus']
+    def _last_event(self, client, name):
+        """Get the newest stack event, so that only the events of an action
+        started afterwards are waited on
+
+        Args:
+            client (Client) : Boto3 CloudFormation client
+            name (string) : Name of the stack
+
+        Returns:
+            (string|None) : EventId of the newest event or None if the stack
+                            doesn't exist
+        """
+        try:
+            response = client.describe_stack_events(StackName=name)
+        except ClientError:
+            return None
+
+        events = response['StackEvents']
+        return events[0]['EventId'] if len(events) > 0 else None
+
+    def _new_events(self, client, stack_id, last, process):
+        """Get the stack events that happened after the given event
+
+        Events are returned newest first by CloudFormation, so pages are only
+        requested until the last seen event is located.
+
+        Args:
+            client (Client) : Boto3 CloudFormation client
+            stack_id (string) : Id of the stack
+            last (string|None) : EventId of the last seen event or None to get
+                                 the events since the stack last entered the
+                                 process status
+            process (string) : In progress stack status of the current action
+
+        Returns:
+            (list) : List of new events, oldest first
+        """
+        events = []
+        paginator = client.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=stack_id):
+            for event in page['StackEvents']:
+                if event['EventId'] == last:
+                    return events[::-1]
+
+                events.append(event)
+
+                if last is None and \
+                   event['PhysicalResourceId'] == stack_id and \
+                   event['ResourceStatus'] == process:
+                    return events[::-1]
+
+        # The event starting the action hasn't been recorded yet
+        return [] if last is None else events[::-1]
+
+    def _poll(self, client, name, action, process, last = None):
+        """Wait for the stack to leave the given status, printing the status of
+        each resource as it changes.
+
+        Stack events are tailed incrementally. The delay between requests grows
+        while no new events are recorded and resets when one is.
+
+        Args:
+            client (Client) : Boto3 CloudFormation client
+            name (string) : Name of the stack
+            action (string) : Description of the action being waited on
+            process (string) : In progress stack status to wait on
+            last (string|None) : EventId from _last_event() taken before the
+                                 action was started. If None, the events since
+                                 the stack last entered the process status are
+                                 used, which may belong to a previous action if
+                                 the new action hasn't recorded an event yet
+
+        Returns:
+            (string|None) : Final stack status or None if the stack doesn't exist
+        """
         response = client.describe_stacks(StackName=name)
         if len(response['Stacks']) == 0:
             return None
-        else:
-            print("Waiting for {} ".format(action), end="", flush=True)
-            while get_status(response) == process:
-                time.sleep(5)
-                print(".", end="", flush=True)
-                response = client.describe_stacks(StackName=name)
-            print(" done")
 
-            return get_status(response)
+        stack_id = response['Stacks'][0]['StackId']
+        fmt = "{:%H:%M:%S}  {:<45}{:<45}{}"
+
+        print("Waiting for {}".format(action))
+        failure = None
+        delay = POLL_MIN_DELAY
+        while True:
+            events = self._new_events(client, stack_id, last, process)
+            for event in events:
+                status = event['ResourceStatus']
+                print(fmt.format(event['Timestamp'],
+                                 event['LogicalResourceId'],
+                                 status,
+                                 event.get('ResourceStatusReason', '')), flush=True)
+
+                if failure is None and status.endswith('_FAILED'):
+                    failure = event
+                    print("First failure: {} - {}".format(event['LogicalResourceId'],
+                                                          event.get('ResourceStatusReason', '')),
+                          flush=True)
+
+                if event['PhysicalResourceId'] == stack_id and status != process:
+                    print("Finished {}".format(action))
+                    return status
+
+            if len(events) > 0:
+                last = events[-1]['EventId']
+                delay = POLL_MIN_DELAY
+            else:
+                delay = min(delay * 2, POLL_MAX_DELAY)
+
+            time.sleep(delay)
 
     def create(self, session, wait = True):
         """Launch the template this object represents in CloudFormation.
@@ -465,18 +718,17 @@ class CloudFormationConfiguration:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
         client = session.client('cloudformation')
+        last = self._last_event(client, self.stack_name)
         response = client.create_stack(
             StackName = self.stack_name,
-            TemplateBody = self._create_template(),
+            **self._template_args(session),
             Parameters = self.arguments,
-            Tags = [
-                {"Key": "Commit", "Value": utils.get_commit()}
-            ]
+            Tags = self._tags(utils.get_commit())
         )
 
         rtn = None
         if wait:
-            status = self._poll(client, self.stack_name, 'create', 'CREATE_IN_PROGRESS')
+            status = self._poll(client, self.stack_name, 'create', 'CREATE_IN_PROGRESS', last)
 
             if status is None:
                 print("Problem launching stack")
@@ -486,11 +738,17 @@ class CloudFormationConfiguration:
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        aws.lookup_cache.invalidate(session)
         return rtn
 
     def update(self, session, wait = True):
         """Update the template this object represents in CloudFormation.
 
+        If the template and arguments hash to the same value as the stack's
+        TemplateHash tag the update is skipped, unless the FORCE_UPDATE
+        environment variable is true.
+
         Args:
             session (Session) : Boto3 session used to launch the configuration
             wait (bool) : If True, wait for the stack to be updated, printing
@@ -506,33 +764,37 @@ class CloudFormationConfiguration:
 
         client = session.client('cloudformation')
 
+        force = str(os.environ.get("FORCE_UPDATE")).lower() in ('yes', 'true', 'y', 't')
+        if not force and self._deployed_fingerprint(client) == self._fingerprint():
+            print("No changes to stack '{}', skipping update".format(self.stack_name))
+            return True
+
         disable_preview = str(os.environ.get("DISABLE_PREVIEW"))
         disable_preview = disable_preview.lower() in ('yes', 'true', 'y', 't')
         if disable_preview:
+            last = self._last_event(client, self.stack_name)
             response = client.update_stack(
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
+                **self._template_args(session),
                 Parameters = self.arguments,
-                Tags = [
-                    {"Key": "Commit", "Value": utils.get_commit()}
-                ]
+                Tags = self._tags(utils.get_commit())
             )
         else:
             commit = utils.get_commit()
             response = client.create_change_set(
                 ChangeSetName = 'h' + commit,
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
+                **self._template_args(session),
                 Parameters = self.arguments,
-                Tags = [
-                    {"Key": "Commit", "Value": commit}
-                ]
+                Tags = self._tags(commit)
             )
 
             try:
+                delay = POLL_MIN_DELAY
                 response = {'Status': 'CREATE_PENDING'}
                 while response['Status'] in ('CREATE_PENDING', 'CREATE_IN_PROGRESS'):
-                    time.sleep(5)
+                    time.sleep(delay)
+                    delay = min(delay * 2, POLL_MAX_DELAY)
                     response = client.describe_change_set(
                         ChangeSetName = 'h' + commit,
                         StackName = self.stack_name
@@ -543,32 +805,35 @@ class CloudFormationConfiguration:
                     print("Reason: {}".format(response['StatusReason']))
                     raise Exception()
 
-                fmt = "{:<10}{:<30}{:<50}{:<45}{:<14}{}"
-                print(fmt.format(
-                    "Action",
-                    "Logical ID",
-                    "Physical ID",
-                    "Resource Type",
-                    "Replacement",
-                    "Scope"
-                ))
-                for change in response['Changes']:
-                    if change['Type'] == 'Resource':
-                        change = change['ResourceChange']
-                        limit = lambda s: s[:42] + "..." if len(s) > 45 else s
-                        print(fmt.format(
-                            change['Action'],
-                            change['LogicalResourceId'],
-                            limit(change.get('PhysicalResourceId', '')),
-                            change['ResourceType'],
-                            change.get('Replacement', ''),
-                            ", ".join(change['Scope'])
-                        ))
-
-                resp = input("Apply Update? [N/y] ")
+                # Keep the change set and prompt together when configs run concurrently
+                with utils.console_lock:
+                    fmt = "{:<10}{:<30}{:<50}{:<45}{:<14}{}"
+                    print(fmt.format(
+                        "Action",
+                        "Logical ID",
+                        "Physical ID",
+                        "Resource Type",
+                        "Replacement",
+                        "Scope"
+                    ))
+                    for change in response['Changes']:
+                        if change['Type'] == 'Resource':
+                            change = change['ResourceChange']
+                            limit = lambda s: s[:42] + "..." if len(s) > 45 else s
+                            print(fmt.format(
+                                change['Action'],
+                                change['LogicalResourceId'],
+                                limit(change.get('PhysicalResourceId', '')),
+                                change['ResourceType'],
+                                change.get('Replacement', ''),
+                                ", ".join(change['Scope'])
+                            ))
+
+                    resp = input("Apply Update? [N/y] ")
                 if len(resp) == 0 or resp[0] not in ('y', 'Y'):
                     raise Exception()
                 else:
+                    last = self._last_event(client, self.stack_name)
                     response = client.execute_change_set(
                         ChangeSetName = 'h' + commit,
                         StackName = self.stack_name
@@ -583,7 +848,7 @@ class CloudFormationConfiguration:
 
         rtn = None
         if wait:
-            status = self._poll(client, self.stack_name, 'update', 'UPDATE_IN_PROGRESS')
+            status = self._poll(client, self.stack_name, 'update', 'UPDATE_IN_PROGRESS', last)
 
             if status is None:
                 print("Problem launching stack")
@@ -597,8 +862,44 @@ class CloudFormationConfiguration:
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        aws.lookup_cache.invalidate(session)
         return rtn
 
+    def diff(self, session):
+        """Compare the template this object represents with the deployed stack.
+
+        The diff is computed locally, without creating a change set. Each
+        modified resource is classified as being replaced or updated in place
+        using template_diff.REPLACEMENT_RULES.
+
+        For templates split into nested stacks the changes are reported per
+        child stack.
+
+        Args:
+            session (Session) : Boto3 session used to get the deployed template
+
+        Returns:
+            (list) : List of changes, as returned by template_diff.diff_templates
+        """
+        client = session.client('cloudformation')
+        deployed = client.get_template(StackName = self.stack_name)['TemplateBody']
+        if isinstance(deployed, str): # JSON templates are already decoded by Boto3
+            deployed = json.loads(deployed)
+
+        response = client.describe_stacks(StackName = self.stack_name)
+        parameters = template_diff.changed_parameters(response['Stacks'][0].get('Parameters', []),
+                                                      self.arguments)
+
+        local = self._nested_template(session, upload = False)
+        changes = template_diff.diff_templates(deployed, local, parameters)
+
+        if len(changes) == 0:
+            print("No changes to stack '{}'".format(self.stack_name))
+        else:
+            print(template_diff.format_changes(changes))
+        return changes
+
     def delete(self, session, wait = True):
         """Deletes the given stack from CloudFormation.
 
@@ -617,12 +918,13 @@ class CloudFormationConfiguration:
         """
 
         client = session.client("cloudformation")
+        last = self._last_event(client, self.stack_name)
         client.delete_stack(StackName = self.stack_name)
 
         rtn = None
         if wait:
             try:
-                status = self._poll(client, self.stack_name, 'delete', 'DELETE_IN_PROGRESS')
+                status = self._poll(client, self.stack_name, 'delete', 'DELETE_IN_PROGRESS', last)
 
                 if status is None:
                     print("Problem deleting stack")
@@ -636,6 +938,8 @@ class CloudFormationConfiguration:
                 # Stack doesn't exist anymore
                 print(" done")
                 rtn = True
+
+        aws.lookup_cache.invalidate(session)
         return rtn
 
     def add_arg(self, arg):
@@ -1591,7 +1895,7 @@ class CloudFormationConfiguration:
         }
 
 
-    def add_lambda(self, key, name, role, file=None, handler=None, s3=None, description="", memory=128, timeout=3, security_groups=None, subnets=None, depends_on=None, runtime="python2.7"):
+    def add_lambda(self, key, name, role, file=None, handler=None, s3=None, description="", memory=128, timeout=3, security_groups=None, subnets=None, depends_on=None, runtime="python2.7", environment=None):
         """Create a Python Lambda
 
         Args:
@@ -1611,6 +1915,7 @@ class CloudFormationConfiguration:
             depends_on (None|string|list) : A unique name or list of unique names of resources within the
                                             configuration and is used to determine the launch order of resources
             runtime (optional[string]) : Lambda runtime to use.  Defaults to "python2.7".
+            environment (None|dict) : Dictionary of environment variables to set for the lambda
         """
 
         if file is not None:
@@ -1662,6 +1967,11 @@ class CloudFormationConfiguration:
         elif security_groups is not None or subnets is not None:
             raise Exception("security_groups and subnets should both be specified")
 
+        if environment is not None:
+            self.resources[key]["Properties"]["Environment"] = {
+                "Variables": environment
+            }
+
         if depends_on is not None:
             self.resources[key]["DependsOn"] = depends_on
 
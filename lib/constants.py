@@ -48,13 +48,18 @@ def repo_path(*args):
 
 
 LAMBDA_SUBNETS = 16
+
+# File lib/aws.py lookups are saved in between runs
+LOOKUP_CACHE_FILE = repo_path('vault', 'private', 'lookup_cache.json')
+
 ########################
 # Lambda Files
 LAMBDA_DIR = repo_path('cloud_formation', 'lambda')
 DNS_LAMBDA = LAMBDA_DIR + '/updateRoute53/index.py'
 VAULT_LAMBDA = LAMBDA_DIR + '/monitors/chk_vault.py'
 CONSUL_LAMBDA = LAMBDA_DIR + '/monitors/chk_consul.py'
-INGEST_LAMBDA = LAMBDA_DIR + '/ingest_populate/ingest_queue_upload.py'
+INGEST_LAMBDA_DIR = LAMBDA_DIR + '/ingest_populate'
+INGEST_SHARD_COUNT = 4 # Number of parallel IngestUpload lambdas in populate_upload_queue.hsd
 
 
 ########################
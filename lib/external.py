@@ -13,16 +13,21 @@
 # limitations under the License.
 
 import time
+import threading
+from http.client import HTTPException
 from urllib.request import urlopen, HTTPError
 from contextlib import contextmanager
 
 from . import exceptions
 from . import aws
 from .utils import keypair_to_file
-from .ssh import SSHConnection, vault_tunnel
-from .vault import Vault
+from .ssh import SSHConnection, create_tunnel_aplnis
+from .vault import Vault, VaultCluster
 
 
+STATUS_CHECK_INTERVAL = 5 # seconds between status checks
+VAULT_PROXY_PORT = 3128 # Port of the bastion's proxy, used to connect to Vault
+
 def gen_timeout(total, step):
     """Break the total timeout value into steps
     that are a specific size.
@@ -44,7 +49,14 @@ def gen_timeout(total, step):
 class ExternalCalls:
     """Class that helps with forming connections from the local machine to machines
     within a VPC through the VPC's bastion machine.
+
+    Tunnels are pooled, keyed by (bastion, target, port), and kept open for the
+    life of the process, so repeated tunnels to the same target are reused.
     """
+
+    tunnels = {} # (bastion ip, target, port) -> (ssh.Forward, target ip)
+    tunnel_locks = {} # (bastion ip, target, port) -> threading.Lock
+    tunnels_lock = threading.Lock() # Guards the two dictionaries above
     def __init__(self, session, keypair, domain):
         """ExternalCalls constructor
 
@@ -66,10 +78,63 @@ class ExternalCalls:
         self.vault_hostname = "vault." + domain
         ips = aws.machine_lookup_all(session, self.vault_hostname, public_ip=False)
         self.vaults = [Vault(self.vault_hostname, ip) for ip in ips]
+        self.cluster = VaultCluster(self.vaults)
 
         # keep track of previous connections to limit the need for looking up IP addresses
         self.connections = {}
 
+    def _tunnel(self, target, port, lookup, local_port=None):
+        """Get the local port of a pooled tunnel, opening the tunnel if it
+        doesn't exist or reopening it if it is no longer healthy or the
+        target now resolves to a different IP address.
+
+        Only callers for the same pool key wait on each other, so a slow
+        lookup or tunnel to one host doesn't block tunnels to other hosts.
+
+        Args:
+            target (string) : Name of the target, used as part of the pool key
+            port (int) : Port on the target to connect to
+            lookup (function) : Function that returns the target's IP address
+            local_port (None|int) : Local port to use, or None to locate a port
+
+        Returns:
+            (int) : Local port of the tunnel
+        """
+        key = (self.bastion_ip, target, port)
+        with self.tunnels_lock:
+            lock = self.tunnel_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            ip = lookup()
+            with self.tunnels_lock:
+                tunnel, tunnel_ip = self.tunnels.get(key, (None, None))
+
+            if tunnel is not None:
+                if tunnel_ip == ip and tunnel.alive():
+                    return tunnel.local_port
+
+                if tunnel_ip != ip:
+                    print("Reconnecting tunnel to {}:{}, now at {}".format(target, port, ip))
+                else:
+                    print("Reconnecting tunnel to {}:{}".format(target, port))
+                tunnel.terminate()
+                with self.tunnels_lock:
+                    del self.tunnels[key]
+
+            tunnel = create_tunnel_aplnis(self.keypair_file,
+                                          local_port,
+                                          ip,
+                                          port,
+                                          self.bastion_ip)
+            with self.tunnels_lock:
+                self.tunnels[key] = (tunnel, ip)
+            return tunnel.local_port
+
+    def _vault_proxy(self):
+        """Make sure the tunnel to the bastion's proxy, used by the Vault
+        objects, is open"""
+        self._tunnel("localhost", VAULT_PROXY_PORT, lambda: "localhost", VAULT_PROXY_PORT)
+
     @contextmanager
     def vault(self):
         class ContextVault(object):
@@ -79,19 +144,38 @@ class ExternalCalls:
 
                 Lookup all vault IPs for the VPC, initialize and configure the first server
                 and then unseal any other servers.
+
+                Raises:
+                    Exception : If any of the servers is still sealed
                 """
                 self.vaults[0].initialize()
-                for vault in self.vaults[1:]:
-                    vault.unseal()
+                results = VaultCluster(self.vaults[:1]).health() + \
+                          VaultCluster(self.vaults[1:]).unseal()
+                print(VaultCluster.format_status(results))
+                VaultCluster.check(results)
 
             @staticmethod
             def unseal():
                 """Unseal all of the vault servers.
 
-                Lookup all vault IPs for the VPC and unseal each server.
+                Lookup all vault IPs for the VPC and unseal the servers concurrently.
+
+                Raises:
+                    Exception : If any of the servers is still sealed
                 """
-                for vault in self.vaults:
-                    vault.unseal()
+                results = self.cluster.unseal()
+                print(VaultCluster.format_status(results))
+                VaultCluster.check(results)
+
+            @staticmethod
+            def seal():
+                """Seal all of the vault servers concurrently."""
+                print(VaultCluster.format_status(self.cluster.seal()))
+
+            @staticmethod
+            def status():
+                """Print the status of all of the vault servers."""
+                print(VaultCluster.format_status(self.cluster.health()))
 
             @staticmethod
             def read(path):
@@ -106,8 +190,8 @@ class ExternalCalls:
             provision = self.vaults[0].provision
             revoke = self.vaults[0].revoke
 
-        with vault_tunnel(self.keypair_file, self.bastion_ip):
-            yield ContextVault()
+        self._vault_proxy()
+        yield ContextVault()
 
     def ssh(self, target):
         """Open a SSH connection to the target machine (AWS instance name) and return a method
@@ -122,40 +206,42 @@ class ExternalCalls:
 
         return self.connections[target].cmds()
 
+    @contextmanager
     def tunnel(self, target, port, type_='ec2'):
         """Open a SSH connectio to the target machine (AWS instance name) / port and return the local
         port of the tunnel to connect to.
+
+        The tunnel is pooled and left open for later calls.
         """
-        key = (target, port)
-        if key not in self.connections:
-            hostname = target
-            if not hostname.endswith("." + self.domain):
-                hostname += "." + self.domain
+        hostname = target
+        if not hostname.endswith("." + self.domain):
+            hostname += "." + self.domain
+
+        def lookup():
             if type_ == 'ec2':
-                target_ip = aws.machine_lookup(self.session, hostname, public_ip=False)
+                return aws.machine_lookup(self.session, hostname, public_ip=False)
             elif type_ == 'rds':
-                target_ip = aws.rds_lookup(self.session, hostname.replace('.', '-'))
+                return aws.rds_lookup(self.session, hostname.replace('.', '-'))
             else:
                 raise Exception("Unsupported: tunnelling to machine type {}".format(type_))
-            self.connections[key] = SSHConnection(self.keypair_file, (target_ip, port), self.bastion_ip)
 
-        return self.connections[key].tunnel()
+        yield self._tunnel(hostname, port, lookup)
 
 
     def check_vault(self, timeout, exception=True):
         """Vault status check to see if Vault is accessible
         """
-        with vault_tunnel(self.keypair_file, self.bastion_ip):
-            for sleep in gen_timeout(timeout, 15): # 15 second sleep
-                if self.vaults[0].status_check():
-                    return True
-                time.sleep(sleep)
+        for sleep in gen_timeout(timeout, STATUS_CHECK_INTERVAL):
+            self._vault_proxy()
+            if self.vaults[0].status_check():
+                return True
+            time.sleep(sleep)
 
-            if exception:
-                msg = "Cannot connect to Vault after {} seconds".format(timeout)
-                raise exceptions.StatusCheckError(msg, self.vault_hostname)
-            else:
-                return False
+        if exception:
+            msg = "Cannot connect to Vault after {} seconds".format(timeout)
+            raise exceptions.StatusCheckError(msg, self.vault_hostname)
+        else:
+            return False
 
     def check_keycloak(self, timeout, exception=True):
         """Keycloak status check to see if Keycloak is accessible
@@ -163,31 +249,29 @@ class ExternalCalls:
         # DP ???: use the actual login url so the actual API is checked..
         #         (and parse response for 403 unauthorized vs any other error..)
 
-        # SH Manually waiting 30 secs before opening the ssh tunnel
-        #    Have seen tunnel timeout a few times now before the URL returns OK.
-        time.sleep(30)
+        for sleep in gen_timeout(timeout, STATUS_CHECK_INTERVAL):
+            # Get the tunnel each time, so it is reopened if it has died
+            with self.tunnel("auth", 8080) as port:
+                # Could move to connecting through the ELB, but then KC will have to be healthy
+                URL = "http://localhost:{}/auth/".format(port)
 
-        with self.tunnel("auth", 8080) as port:
-            # Could move to connecting through the ELB, but then KC will have to be healthy
-            URL = "http://localhost:{}/auth/".format(port)
-
-            for sleep in gen_timeout(timeout, 15): # 15 second sleep
+                # The tunnel closes the connection if Keycloak isn't listening yet
                 try:
                     res = urlopen(URL)
                     if res.getcode() == 200:
                         return True
-                except HTTPError:
+                except (OSError, HTTPException):
                     pass
-                time.sleep(sleep)
+            time.sleep(sleep)
 
-            if exception:
-                msg = "Cannot connect to Keycloak after {} seconds".format(timeout)
-                raise exceptions.StatusCheckError(msg, "auth." + self.domain)
-            else:
-                return False
+        if exception:
+            msg = "Cannot connect to Keycloak after {} seconds".format(timeout)
+            raise exceptions.StatusCheckError(msg, "auth." + self.domain)
+        else:
+            return False
 
     def check_url(self, url, timeout, exception=True):
-        for sleep in gen_timeout(timeout, 15): # 15 second sleep
+        for sleep in gen_timeout(timeout, STATUS_CHECK_INTERVAL):
             try:
                 res = urlopen(url)
                 if res.getcode() == 200:
@@ -14,12 +14,134 @@
 
 import json
 import ssl
-from urllib.request import Request, urlopen
-from urllib.parse import urlencode
-from urllib.error import HTTPError
+import time
+import queue
+import base64
+import http.client
+from urllib.parse import urlencode, urlsplit, unquote
+from urllib.request import getproxies, proxy_bypass
 
 from . import exceptions
 
+POOL_SIZE = 4 # Number of idle connections kept open to the Keycloak server
+TOKEN_REFRESH_MARGIN = 30 # seconds before the access token expires that it is refreshed
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP(S) connections to a single server.
+
+    Requests made on an idle connection that the server has since closed are
+    retried once on a new connection.
+
+    Like urlopen, the proxy for the server's scheme is read from the
+    environment (http_proxy / https_proxy / no_proxy). HTTPS requests are
+    tunneled through the proxy with CONNECT.
+    """
+
+    def __init__(self, url_base, size=POOL_SIZE, context=None):
+        """ConnectionPool constructor
+
+        Args:
+            url_base (string) : Base URL of the server, including any path prefix
+            size (int) : Maximum number of idle connections to keep open
+            context (None|SSLContext) : SSL context for HTTPS connections
+        """
+        url = urlsplit(url_base)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.context = context
+        self.idle = queue.LifoQueue(maxsize=size)
+
+        self.proxy = None
+        self.proxy_headers = {}
+        proxy = getproxies().get(url.scheme)
+        if proxy and not proxy_bypass(url.netloc):
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            self.proxy = urlsplit(proxy)
+            if self.proxy.username is not None:
+                credentials = "{}:{}".format(unquote(self.proxy.username),
+                                             unquote(self.proxy.password or ""))
+                credentials = base64.b64encode(credentials.encode()).decode()
+                self.proxy_headers["Proxy-Authorization"] = "Basic " + credentials
+
+    def _connection(self):
+        """Get an idle connection, or a new connection if there are none
+
+        Returns:
+            (tuple) : (HTTPConnection, bool if the connection was reused)
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            if self.proxy is None:
+                host, port = self.host, self.port
+            else:
+                host, port = self.proxy.hostname, self.proxy.port
+
+            if self.https:
+                conn = http.client.HTTPSConnection(host, port, context=self.context)
+                if self.proxy is not None:
+                    conn.set_tunnel(self.host, self.port, headers=self.proxy_headers)
+            else:
+                conn = http.client.HTTPConnection(host, port)
+            return conn, False
+
+    def _release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, url, body=None, headers={}):
+        """Make a request using a pooled connection.
+
+        Args:
+            method (string) : HTTP method
+            url (string) : URL, appended to the URL path of url_base
+            body (None|bytes) : Request body
+            headers (dict) : Dictionary of HTTP headers
+
+        Returns:
+            (tuple) : (status code, reason, response body as bytes)
+        """
+        url = self.prefix + url
+        if self.proxy is not None and not self.https:
+            # Plain HTTP proxies take the full URL of the request
+            netloc = self.host if self.port is None else "{}:{}".format(self.host, self.port)
+            url = "http://" + netloc + url
+            headers = dict(headers, **self.proxy_headers)
+
+        while True:
+            conn, reused = self._connection()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused: # The server closed the idle connection, retry
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return response.status, response.reason, data
+
+    def close(self):
+        """Close all of the idle connections"""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
 class KeyCloakClient:
     """Client for connecting to Keycloak and using the REST API.
 
@@ -34,16 +156,21 @@ class KeyCloakClient:
 
     with KeyCloakClient(url, username, password) as kc:
         kc.method(arguments)
+
+    Note: Redirects are not followed, a redirect response raises a KeyCloakError
     """
-    def __init__(self, url_base, username=None, password=None, client_id='admin-cli', verify_ssl=True):
+    def __init__(self, url_base, username=None, password=None, client_id='admin-cli', verify_ssl=True, pool_size=POOL_SIZE):
         """KeyCloakClient constructor
 
         Args:
             url_base (string) : The base URL to prepend to all request URLs
             verify_ssl (bool) : Whether or not to verify HTTPS certs
+            pool_size (int) : Number of idle connections to keep open
         """
         self.url_base = url_base
         self.token = None
+        self.token_expires = None
+        self.token_client_id = client_id
         self.username = username
         self.password = password
         self.client_id = client_id
@@ -55,6 +182,8 @@ class KeyCloakClient:
         else:
             self.ctx = None
 
+        self.pool = ConnectionPool(url_base, pool_size, self.ctx)
+
     def request(self, url, params=None, headers={}, convert=urlencode, method=None):
         """Make a request to the Keycloak server.
 
@@ -71,24 +200,62 @@ class KeyCloakClient:
         Returns:
             (None) : If there is an exception raised
             (dict) : Dictionary containing JSON encoded response
+
+        Raises:
+            KeyCloakError : If the response is an error or a redirect
         """
-        request = Request(
-            self.url_base + url,
-            data=None if params is None else convert(params).encode("utf-8"),
-            headers=headers,
-            method=method
-        )
+        data = None if params is None else convert(params).encode("utf-8")
+        if method is None:
+            method = "GET" if data is None else "POST"
 
         # DP TODO: rewrite or merge using the boss-tools/bossutils KeycloakClient
-        try:
-            response = urlopen(request, context=self.ctx).read().decode("utf-8")
-            if len(response) > 0:
-                response = json.loads(response)
-            else:
-                response = {}
-            return response
-        except HTTPError as e:
-            raise exceptions.KeyCloakError(e.code, e.reason)
+        status, reason, response = self.pool.request(method, url, data, headers)
+        if status >= 300:
+            raise exceptions.KeyCloakError(status, reason)
+
+        response = response.decode("utf-8")
+        if len(response) > 0:
+            response = json.loads(response)
+        else:
+            response = {}
+        return response
+
+    def _token_request(self, params):
+        """Request a new token and record when it expires"""
+        requested = time.time()
+        self.token = self.request(
+            "/auth/realms/master/protocol/openid-connect/token",
+            params=params,
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+            }
+        )
+        if self.token is not None and "expires_in" in self.token:
+            self.token_expires = requested + self.token["expires_in"]
+        else:
+            self.token_expires = None
+
+    def access_token(self):
+        """Get the bearer access token, refreshing it if it is about to expire.
+
+        If the token cannot be refreshed the user is logged in again, using
+        the credentials from the constructor or the last call to login().
+
+            Note: User must be logged into Keycloak first
+
+        Returns:
+            (string) : Access token
+        """
+        if self.token_expires is not None and time.time() + TOKEN_REFRESH_MARGIN > self.token_expires:
+            try:
+                self._token_request({
+                    "refresh_token": self.token["refresh_token"],
+                    "grant_type": "refresh_token",
+                    "client_id": self.token_client_id,
+                })
+            except exceptions.KeyCloakError:
+                self.login()
+        return self.token["access_token"]
 
     def login(self, username=None, password=None, client_id=None):
         """Login to the Keycloak master realm and retrieve an access token.
@@ -98,7 +265,9 @@ class KeyCloakClient:
 
         Note: A user must be logged in before any other method calls will work
 
-        The bearer access token is saved as self.token["access_token"]
+        The bearer access token is saved as self.token["access_token"] and the
+        credentials are saved, so access_token() can login again if the token
+        cannot be refreshed
 
         An error will be printed if login failed
 
@@ -122,23 +291,22 @@ class KeyCloakClient:
         if client_id is None:
             raise Exception("No client_id set")
 
-        self.token = self.request(
-            "/auth/realms/master/protocol/openid-connect/token",
-            params={
-                "username": username,
-                "password": password,
-                "grant_type": "password",
-                "client_id": client_id,
-            },
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-            }
-        )
+        self._token_request({
+            "username": username,
+            "password": password,
+            "grant_type": "password",
+            "client_id": client_id,
+        })
+        self.token_client_id = client_id
 
         if self.token is None:
             #print("Could not authenticate to KeyCloak Server")
             raise exceptions.KeyCloakLoginError(self.url_base, username)
 
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+
         return self # DP NOTE: So context manager works correctly
 
     def logout(self):
@@ -162,6 +330,7 @@ class KeyCloakClient:
         )
 
         self.token = None
+        self.token_expires = None
 
     def __enter__(self):
         """The start of the context manager, which handles automatically calling logout."""
@@ -176,6 +345,7 @@ class KeyCloakClient:
             self.logout()
         except:
             print("Error logging out of Keycloak")
+        self.pool.close()
 
         if exc_type is None:
             return None
@@ -194,37 +364,47 @@ class KeyCloakClient:
             "/auth/admin/realms",
             params=realm,
             headers={
-                "Authorization": "Bearer " + self.token["access_token"],
+                "Authorization": "Bearer " + self.access_token(),
                 "Content-Type": "application/json",
             },
             convert=json.dumps
         )
 
-    def get_client(self, realm_name, client_id):
-        """Get the realm's client configuration.
+    def get_clients(self, realm_name):
+        """Get the configuration of all of the realm's clients.
 
             Note: User must be logged into Keycloak first
 
         Args:
-            realm_name (string) : Name of the realm to look in for the client
-            client_id (string) : Client ID of client configuration to retrieve
+            realm_name (string) : Name of the realm to look in for the clients
 
         Returns:
-            (None|dict) : None if the client couldn't be located or the JSON
-                          dictionary configuration of the client
+            (list) : List of JSON dictionary client configurations
         """
         resp = self.request(
             "/auth/admin/realms/{}/clients".format(realm_name),
             headers={
-                "Authorization": "Bearer " + self.token["access_token"],
+                "Authorization": "Bearer " + self.access_token(),
                 "Content-Type": "application/x-www-form-urlencoded",
             }
         )
 
-        if resp is None:
-            return None
+        return [] if resp is None else resp
+
+    def get_client(self, realm_name, client_id):
+        """Get the realm's client configuration.
+
+            Note: User must be logged into Keycloak first
+
+        Args:
+            realm_name (string) : Name of the realm to look in for the client
+            client_id (string) : Client ID of client configuration to retrieve
 
-        for client in resp:
+        Returns:
+            (None|dict) : None if the client couldn't be located or the JSON
+                          dictionary configuration of the client
+        """
+        for client in self.get_clients(realm_name):
             if client['clientId'] == client_id:
                 return client
         return None
@@ -242,13 +422,65 @@ class KeyCloakClient:
             "/auth/admin/realms/{}/clients/{}".format(realm_name, client['id']),
             params=client,
             headers={
-                "Authorization": "Bearer " + self.token["access_token"],
+                "Authorization": "Bearer " + self.access_token(),
                 "Content-Type": "application/json",
             },
             convert=json.dumps,
             method="PUT"
         )
 
+    def reconcile_clients(self, realm_name, desired):
+        """Bring the realm's clients to the desired configuration.
+
+        The realm's clients are retrieved once and only the clients whose
+        configuration differs from the desired configuration are updated, with
+        one update per client.
+
+        List properties (like redirectUris and webOrigins) are merged, adding
+        the desired values missing from the client's list, so that values
+        added by other configs are kept. All other properties are replaced
+        with the desired value.
+
+            Note: User must be logged into Keycloak first
+
+        Args:
+            realm_name (string) : Name of the realm
+            desired (dict) : Dictionary of Client ID to a dictionary of the
+                             client's desired properties
+
+        Returns:
+            (list) : Client IDs of the clients that were updated
+
+        Raises:
+            KeyCloakError : If a client in desired doesn't exist in the realm
+        """
+        clients = {c['clientId']: c for c in self.get_clients(realm_name)}
+
+        missing = [client_id for client_id in desired if client_id not in clients]
+        if len(missing) > 0:
+            raise exceptions.KeyCloakError(404, "Clients {} not found in realm {}".format(", ".join(missing), realm_name))
+
+        updated = []
+        for client_id, properties in desired.items():
+            client = clients[client_id]
+            changed = False
+            for key, value in properties.items():
+                if isinstance(value, list):
+                    current = client.setdefault(key, [])
+                    for item in value:
+                        if item not in current:
+                            current.append(item)
+                            changed = True
+                elif client.get(key) != value:
+                    client[key] = value
+                    changed = True
+
+            if changed:
+                self.update_client(realm_name, client)
+                updated.append(client_id)
+
+        return updated
+
     def append_list_properties(self, realm_name, client_id, additions):
         """Append a set of key values to a realm's client configuration.
 
@@ -265,15 +497,8 @@ class KeyCloakClient:
                                correspond to a client key and that entry's (singular)
                                value will be appended to the client's property.
         """
-        client = self.get_client(realm_name, client_id)
-
-        for key, value in additions.items():
-            if key not in client:
-                client[key] = []
-            if value not in client[key]:
-                client[key].append(value)
-
-        self.update_client(realm_name, client)
+        properties = {key: [value] for key, value in additions.items()}
+        self.reconcile_clients(realm_name, {client_id: properties})
 
     def add_redirect_uri(self, realm_name, client_id, uri):
         """Add the given uri as a valid redirectUri to a realm's client configuration.
@@ -304,6 +529,6 @@ class KeyCloakClient:
         client = self.get_client(realm_name, client_id)
         installation_endpoint = "{}/auth/admin/realms/{}/clients/{}/installation/providers/keycloak-oidc-keycloak-json"\
             .format(self.url_base, realm_name, client["id"])
-        auth_header = "Authorization: Bearer {}".format(self.token["access_token"])
+        auth_header = "Authorization: Bearer {}".format(self.access_token())
         return {"url": installation_endpoint, "headers": auth_header}
 
@@ -93,6 +93,10 @@ class AWSNames(object):
         'ingest_queue_populate': 'Ingest.Populate',
         'ingest_queue_upload': 'Ingest.Upload',
         'ingest_lambda': 'IngestUpload',
+        'ingest_split_lambda': 'IngestSplit',
+        'ingest_count_lambda': 'IngestCount',
+        'ingest_checkpoint': 'ingestCheckpoint',
+        'populate_upload_queue': 'Populate.Upload.Queue',
         'dynamo_lambda': 'dynamoLambda',
         'trigger_dynamo_autoscale': 'triggerDynamoAutoscale'
     }
@@ -108,11 +112,12 @@ class AWSNames(object):
         fq_hostname = hostname + self.base_dot
 
         if name in ['multi_lambda', 'write_lock', 'vault_monitor', 'consul_monitor', 'vault_consul_check',
-                    'delete_lambda', 'ingest_lambda', 'dynamo_lambda']:
+                    'delete_lambda', 'ingest_lambda', 'ingest_split_lambda', 'ingest_count_lambda',
+                    'dynamo_lambda']:
             fq_hostname = fq_hostname.replace('.','-')
 
         if name in ['s3flush_queue', 'deadletter_queue', 'delete_cuboid', 'query_deletes',
-                    'ingest_queue_populate', 'ingest_queue_upload', 'resolution_hierarchy',
+                    'ingest_queue_populate', 'ingest_queue_upload', 'populate_upload_queue', 'resolution_hierarchy',
                     'downsample_volume', 'delete_experiment', 'delete_collection', 'delete_coord_frame']:
             fq_hostname = "".join(map(lambda x: x.capitalize(), fq_hostname.split('.')))
 
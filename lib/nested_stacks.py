@@ -0,0 +1,390 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for splitting a large CloudFormation template into nested stacks.
+
+Resources are grouped by their Ref / Fn::GetAtt / Fn::Sub / DependsOn connectivity, so
+that resources referencing each other are placed in the same child stack
+whenever possible. When a group is larger than a child stack it is split in
+dependency order, so child stacks only reference the child stacks before
+them.
+
+References between child stacks are wired through child stack Outputs and
+Parameters, and references to the parent's parameters are passed through as
+child stack Parameters. Outputs can only be strings, so list valued
+attributes are joined into a comma delimited string and passed into a
+CommaDelimitedList Parameter, which Ref turns back into a list.
+
+Moving a resource from one child stack to another replaces it, so the
+resources in each child stack are saved in the parent template's Metadata.
+When a stack is updated the previous layout is kept: existing resources stay
+in their child stack and only new resources are placed, next to the resources
+they are connected to.
+"""
+
+import re
+import copy
+
+from .template_diff import references, sub_variables
+
+STACK_RESOURCE_LIMIT = 200 # Maximum number of resources in a CloudFormation stack
+NESTED_STACK_SIZE = 150 # Maximum number of resources to put in each child stack
+LAYOUT_KEY = 'NestedStacks' # Parent template Metadata key holding the layout
+
+# (resource type, attribute) of the Fn::GetAtt values that are lists
+LIST_ATTRIBUTES = {
+    ('AWS::EC2::VPC', 'CidrBlockAssociations'),
+    ('AWS::EC2::VPC', 'Ipv6CidrBlocks'),
+    ('AWS::EC2::Subnet', 'Ipv6CidrBlocks'),
+    ('AWS::EC2::NetworkInterface', 'SecondaryPrivateIpAddresses'),
+    ('AWS::EC2::VPCEndpoint', 'DnsEntries'),
+    ('AWS::EC2::VPCEndpoint', 'NetworkInterfaceIds'),
+    ('AWS::ElasticLoadBalancingV2::LoadBalancer', 'SecurityGroups'),
+    ('AWS::Route53::HostedZone', 'NameServers'),
+}
+
+def dependencies(resource):
+    """Get the names of the parameters and resources a resource depends upon
+
+    Args:
+        resource (dict) : Template resource
+
+    Returns:
+        (set) : Set of names
+    """
+    return references({k: resource[k] for k in ('Properties', 'DependsOn') if k in resource})
+
+def _components(resources):
+    """Group resources into connected components, ignoring edge direction
+
+    Returns:
+        (list) : List of lists of resource names, in sorted order
+    """
+    parent = {k: k for k in resources}
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for key in sorted(resources):
+        for dep in dependencies(resources[key]):
+            if dep in resources:
+                a, b = find(key), find(dep)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+    groups = {}
+    for key in sorted(resources):
+        groups.setdefault(find(key), []).append(key)
+    return [groups[k] for k in sorted(groups)]
+
+def _topological(resources, keys):
+    """Order the given resources so that dependencies come first"""
+    keys = set(keys)
+    deps = {k: set(d for d in dependencies(resources[k]) if d in keys) for k in keys}
+
+    ordered = []
+    ready = sorted(k for k in keys if len(deps[k]) == 0)
+    while len(ready) > 0:
+        key = ready.pop(0)
+        ordered.append(key)
+        for k in sorted(keys):
+            if key in deps[k]:
+                deps[k].remove(key)
+                if len(deps[k]) == 0:
+                    ready.append(k)
+
+    # Circular dependencies are invalid anyways, keep the remaining order stable
+    ordered.extend(sorted(keys - set(ordered)))
+    return ordered
+
+def _pack(resources, size):
+    """Pack the connected components of resources into groups of at most
+    size resources"""
+    groups = []
+    current = []
+    for component in _components(resources):
+        if len(current) + len(component) > size and len(current) > 0:
+            groups.append(current)
+            current = []
+
+        for key in _topological(resources, component):
+            if len(current) == size:
+                groups.append(current)
+                current = []
+            current.append(key)
+
+    if len(current) > 0:
+        groups.append(current)
+    return groups
+
+def _place(resources, size, previous):
+    """Keep the resources in their previous groups, adding new resources to a
+    group with the resources they are connected to"""
+    groups = [[k for k in group if k in resources] for group in previous]
+    placed = {k: i for i, group in enumerate(groups) for k in group}
+
+    connected = {k: set(d for d in dependencies(resources[k]) if d in resources)
+                 for k in resources}
+    for key in resources:
+        for dep in connected[key]:
+            connected[dep].add(key)
+
+    for key in _topological(resources, resources):
+        if key in placed:
+            continue
+
+        candidates = sorted(set(placed[k] for k in connected[key] if k in placed))
+        if len(candidates) == 0: # Not connected, any group with room
+            candidates = range(len(groups))
+
+        choice = next((i for i in candidates if len(groups[i]) < size), None)
+        if choice is None:
+            groups.append([])
+            choice = len(groups) - 1
+
+        groups[choice].append(key)
+        placed[key] = choice
+
+    return groups
+
+def _check_order(resources, groups):
+    """Verify that the groups don't depend on each other in a cycle
+
+    Raises:
+        Exception : If there is a cycle between groups
+    """
+    location = {k: i for i, group in enumerate(groups) for k in group}
+    deps = {i: set() for i in range(len(groups))}
+    for key, i in location.items():
+        deps[i].update(location[d] for d in dependencies(resources[key])
+                       if d in location and location[d] != i)
+
+    done = set()
+    while len(done) < len(deps):
+        ready = [i for i in deps if i not in done and deps[i] <= done]
+        if len(ready) == 0:
+            cycle = sorted(i for i in deps if i not in done)
+            raise Exception("Nested stacks {} would depend on each other, the stack needs to be split again"
+                            .format(", ".join("Nested{}".format(i) for i in cycle)))
+        done.update(ready)
+
+def partition(resources, size = NESTED_STACK_SIZE, previous = None):
+    """Partition resources into groups of at most size resources
+
+    Args:
+        resources (dict) : Template resources
+        size (int) : Maximum number of resources in each group
+        previous (None|list) : Groups returned by layout() for the deployed
+                               stack. Resources that still exist are kept in
+                               their group, so they are not replaced.
+
+    Returns:
+        (list) : List of lists of resource names, empty if all of the group's
+                 resources were removed
+
+    Raises:
+        Exception : If the new resources cannot be placed without the groups
+                    depending on each other in a cycle
+    """
+    if previous is None:
+        return _pack(resources, size)
+
+    groups = _place(resources, size, previous)
+    _check_order(resources, groups)
+    return groups
+
+def layout(template):
+    """Get the groups of resources a deployed parent template was split into
+
+    Args:
+        template (dict) : Deployed template
+
+    Returns:
+        (list|None) : List of lists of resource names, or None if the template
+                      was not split into nested stacks
+    """
+    stacks = template.get('Metadata', {}).get(LAYOUT_KEY)
+    if stacks is None:
+        return None
+
+    groups = []
+    for name, keys in stacks.items():
+        i = int(name[len("Nested"):])
+        groups.extend([] for _ in range(i + 1 - len(groups)))
+        groups[i] = list(keys)
+    return groups
+
+def _output_name(name, attribute = None):
+    """Name of the output used to export a Ref or Fn::GetAtt value"""
+    if attribute is None:
+        return name
+    return name + re.sub('[^A-Za-z0-9]', '', attribute)
+
+def _rewrite(value, local, imports):
+    """Replace Fn::GetAtt of resources in other child stacks with a Ref of the
+    child stack parameter the value is passed in with, and ${Name.Attribute}
+    in Fn::Sub strings with ${Parameter}.
+
+    Args:
+        value (object) : Template value
+        local (set) : Names of the resources in the child stack
+        imports (set) : Set of (name, attribute or None) that is updated with
+                        the values imported from other child stacks / parent
+
+    Returns:
+        (object) : Rewritten value
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and 'Ref' in value:
+            if value['Ref'] not in local and not value['Ref'].startswith('AWS::'):
+                imports.add((value['Ref'], None))
+            return value
+
+        if len(value) == 1 and 'Fn::GetAtt' in value:
+            att = value['Fn::GetAtt']
+            name, attribute = att if isinstance(att, list) else att.split('.', 1)
+            if name not in local:
+                imports.add((name, attribute))
+                return {'Ref': _output_name(name, attribute)}
+            return value
+
+        if len(value) == 1 and 'Fn::Sub' in value:
+            sub = value['Fn::Sub']
+            string = sub[0] if isinstance(sub, list) else sub
+            for name, attribute in sub_variables(sub):
+                if name in local or name.startswith('AWS::'):
+                    continue
+                imports.add((name, attribute))
+                if attribute is not None:
+                    variable = '${' + name + '.' + attribute + '}'
+                    string = string.replace(variable, '${' + _output_name(name, attribute) + '}')
+
+            if isinstance(sub, list):
+                return {'Fn::Sub': [string] + [_rewrite(v, local, imports) for v in sub[1:]]}
+            return {'Fn::Sub': string}
+
+        return {k: _rewrite(v, local, imports) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_rewrite(v, local, imports) for v in value]
+    else:
+        return value
+
+def split_template(template, template_url, size = NESTED_STACK_SIZE, previous = None):
+    """Split a template into a parent template of nested child stacks
+
+    Args:
+        template (dict) : Template to split
+        template_url (function) : Function that takes a child template (dict)
+                                  and returns the URL it can be loaded from
+        size (int) : Maximum number of resources in each child stack
+        previous (None|list) : Layout of the deployed stack, from layout()
+
+    Returns:
+        (dict) : Parent template
+    """
+    resources = template.get('Resources', {})
+    parameters = template.get('Parameters', {})
+
+    # Child stacks are named by their index, so names stay the same between
+    # updates. Child stacks whose resources were all removed are deleted.
+    groups = [(i, group) for i, group in enumerate(partition(resources, size, previous))
+              if len(group) > 0]
+    names = ["Nested{}".format(i) for i, _ in groups]
+    groups = [group for _, group in groups]
+    location = {k: name for name, group in zip(names, groups) for k in group}
+
+    children = {}
+    outputs = {name: {} for name in names}
+    for name, group in zip(names, groups):
+        local = set(group)
+        imports = set()
+        depends_on = set()
+        child_resources = {}
+        for key in group:
+            resource = copy.deepcopy(resources[key])
+            if 'Properties' in resource:
+                resource['Properties'] = _rewrite(resource['Properties'], local, imports)
+
+            after = resource.get('DependsOn')
+            if after is not None:
+                if isinstance(after, str):
+                    after = [after]
+                depends_on.update(location[d] for d in after if d not in local and d in location)
+                after = [d for d in after if d in local]
+                if len(after) > 0:
+                    resource['DependsOn'] = after
+                else:
+                    del resource['DependsOn']
+
+            child_resources[key] = resource
+
+        child_parameters = {}
+        stack_parameters = {}
+        for ref, attribute in sorted(imports, key = lambda i: (i[0], i[1] or '')):
+            if ref in parameters:
+                child_parameters[ref] = copy.deepcopy(parameters[ref])
+                stack_parameters[ref] = {'Ref': ref}
+            elif ref in location:
+                source = location[ref]
+                depends_on.add(source)
+
+                output = _output_name(ref, attribute)
+                type_ = 'String'
+                if attribute is None:
+                    value = {'Ref': ref}
+                else:
+                    value = {'Fn::GetAtt': [ref, attribute]}
+                    if (resources[ref].get('Type'), attribute) in LIST_ATTRIBUTES:
+                        value = {'Fn::Join': [',', value]}
+                        type_ = 'CommaDelimitedList'
+                outputs[source][output] = {'Value': value}
+                child_parameters[output] = {'Type': type_}
+                stack_parameters[output] = {'Fn::GetAtt': [source, 'Outputs.' + output]}
+
+        children[name] = {
+            'Resources': child_resources,
+            'Parameters': child_parameters,
+            'StackParameters': stack_parameters,
+            'DependsOn': sorted(depends_on),
+        }
+
+    parent_resources = {}
+    for name in names:
+        child = children[name]
+        body = {
+            "AWSTemplateFormatVersion": "2010-09-09",
+            "Parameters": child['Parameters'],
+            "Resources": child['Resources'],
+        }
+        if len(outputs[name]) > 0:
+            body["Outputs"] = outputs[name]
+
+        resource = {
+            "Type": "AWS::CloudFormation::Stack",
+            "Properties": {
+                "TemplateURL": template_url(body),
+                "Parameters": child['StackParameters'],
+            },
+        }
+        if len(child['DependsOn']) > 0:
+            resource["DependsOn"] = child['DependsOn']
+        parent_resources[name] = resource
+
+    parent = {k: v for k, v in template.items() if k != 'Resources'}
+    parent['Resources'] = parent_resources
+    parent['Metadata'] = dict(template.get('Metadata', {}))
+    parent['Metadata'][LAYOUT_KEY] = dict(zip(names, groups))
+    return parent
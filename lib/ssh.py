@@ -18,26 +18,69 @@ import os
 import signal
 import sys
 import time
-import random
+import atexit
+import socket
+import shutil
+import tempfile
+import threading
 
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from .exceptions import SSHError, SSHTunnelError
 
 # Needed to prevent ssh from asking about the fingerprint from new machines
 SSH_OPTIONS = "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -q"
-TUNNEL_SLEEP = 10 # seconds
+TUNNEL_TIMEOUT = 30 # seconds to wait for a SSH connection / tunnel to be ready
+TUNNEL_POLL = 0.1 # seconds between readiness checks
+FORWARD_ATTEMPTS = 3 # Number of free local ports to try when forwarding a port
+FLEET_WORKERS = 10 # Maximum number of machines run_all executes a command on at once
 
 def locate_port():
-    """Locate a local port to attach a SSH tunnel to.
+    """Locate an unused local port to attach a SSH tunnel to.
 
-    Instead of trying to figure out if a port is in use, assume that it will
-    not be in use.
+    The OS selects a free ephemeral port, which is released so that SSH can
+    bind to it. Another process could take the port before SSH binds to it,
+    so ControlMaster.forward() retries with another port if the bind fails.
 
     Returns:
         (int) : Local port to use
     """
-    return random.randint(10000,60000)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, proc = None, timeout = TUNNEL_TIMEOUT):
+    """Wait for a local port to accept connections.
+
+    Args:
+        port (int) : Local port to probe
+        proc (None|Popen) : Process that should be listening on the port. If it
+                            exits an error is raised instead of waiting for the
+                            timeout
+        timeout (int|float) : Number of seconds to wait
+
+    Raises:
+        SSHError : If proc exits because the SSH connection failed
+        SSHTunnelError : If proc exits with another error or the port is not
+                         ready before the timeout
+    """
+    end = time.time() + timeout
+    while True:
+        if proc is not None:
+            ret = proc.poll()
+            if ret == 255:
+                raise SSHError("Error establishing a SSH tunnel")
+            elif ret is not None:
+                raise SSHTunnelError("SSH tunnel exited with error code {}".format(ret))
+
+        try:
+            with socket.create_connection(("localhost", port), timeout = TUNNEL_POLL):
+                return
+        except OSError:
+            if time.time() > end:
+                raise SSHTunnelError("Local port {} was not ready after {} seconds".format(port, timeout))
+            time.sleep(TUNNEL_POLL)
 
 def become_tty_fg():
     """Force a subprocess call to become the foreground process.
@@ -61,25 +104,203 @@ def check_ssh(ret):
     if ret == 255:
         raise SSHError("Error establishing a SSH connection")
 
-class ProcWrapper(list):
-    """Wrapper that holds multiple Popen objects and can call
-    terminate and wait on all contained objects.
+class ControlMaster(object):
+    """A SSH ControlMaster connection to a bastion, that tunnels are
+    multiplexed over instead of each tunnel creating its own SSH connection.
+    """
+
+    def __init__(self, key, bastion_ip, bastion_user, bastion_port, control_path):
+        """Start the master connection and wait for it to be ready
+
+        Args:
+            key (string) : Path to a SSH private key, protected as required by SSH
+            bastion_ip : IP of the machine to connect to
+            bastion_user : The user account of the bastion_ip machine to use
+            bastion_port : Port on the bastion_ip to connect to
+            control_path (string) : Path of the control socket to create
+        """
+        self.key = key
+        self.bastion_ip = bastion_ip
+        self.bastion_user = bastion_user
+        self.bastion_port = bastion_port
+        self.control_path = control_path
+
+        cmd = self._command("-M", "-N", "-n", "-o", "ControlPersist=no", "-o", "ExitOnForwardFailure=yes")
+        self.proc = subprocess.Popen(cmd, stdin = subprocess.DEVNULL)
+
+        end = time.time() + TUNNEL_TIMEOUT
+        while not self.alive():
+            ret = self.proc.poll()
+            if ret == 255:
+                raise SSHError("Error establishing a SSH connection")
+            elif ret is not None:
+                raise SSHTunnelError("SSH connection exited with error code {}".format(ret))
+            elif time.time() > end:
+                self.close()
+                raise SSHTunnelError("SSH connection to {} was not ready after {} seconds"
+                                        .format(bastion_ip, TUNNEL_TIMEOUT))
+            time.sleep(TUNNEL_POLL)
+
+    def _command(self, *args):
+        cmd = ["ssh", "-i", self.key]
+        cmd.extend(shlex.split(SSH_OPTIONS))
+        cmd.extend(["-S", self.control_path, "-p", str(self.bastion_port)])
+        cmd.extend(args)
+        cmd.append("{}@{}".format(self.bastion_user, self.bastion_ip))
+        return cmd
+
+    def _control(self, *args):
+        """Send a control command to the master, returning the exit code
+        or None if the master didn't respond within TUNNEL_TIMEOUT seconds"""
+        try:
+            return subprocess.call(self._command(*args),
+                                   stdin = subprocess.DEVNULL,
+                                   stdout = subprocess.DEVNULL,
+                                   stderr = subprocess.DEVNULL,
+                                   timeout = TUNNEL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def alive(self):
+        """If the master connection is running and accepting requests"""
+        return self.proc.poll() is None and self._control("-O", "check") == 0
+
+    def forward(self, local_port, remote_ip, remote_port):
+        """Forward a local port over the master connection.
+
+        Args:
+            local_port (None|int) : Port on the local machine to attach the local end of the tunnel to
+                                    If None, a free port is located and another is
+                                    tried if the port is taken before SSH binds to it
+            remote_ip : IP of the machine the tunnel remote end should point at
+            remote_port : Port of on the remote_ip that the tunnel should point at
+
+        Returns:
+            (Forward) : Popen like object that removes the forward when terminated
+        """
+        attempts = FORWARD_ATTEMPTS if local_port is None else 1
+        for attempt in range(attempts):
+            port = locate_port() if local_port is None else local_port
+            spec = "{}:{}:{}".format(port, remote_ip, remote_port)
+            if self._control("-O", "forward", "-L", spec) == 0:
+                wait_for_port(port, self.proc)
+                return Forward(self, port, spec)
+
+        raise SSHTunnelError("Could not forward local port {} to {}:{}"
+                                .format(port, remote_ip, remote_port))
+
+    def close(self):
+        """Close the master connection, and all of the tunnels using it"""
+        if self.proc.poll() is None:
+            self._control("-O", "exit")
+            try:
+                self.proc.wait(TUNNEL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.proc.terminate()
+                self.proc.wait()
+
+class Forward(object):
+    """A port forwarded over a ControlMaster, with the terminate / wait interface
+    of the Popen objects used by the SSHConnection tunnels.
     """
-    def prepend(self, item):
-        self.insert(0, item)
+
+    def __init__(self, master, local_port, spec):
+        self.master = master
+        self.local_port = local_port
+        self.spec = spec
+        self.open = True
+
     def terminate(self):
-        [item.terminate() for item in self]
+        if self.open and self.master.proc.poll() is None:
+            self.master._control("-O", "cancel", "-L", self.spec)
+        self.open = False
+
     def wait(self):
-        [item.wait() for item in self]
+        pass
+
+    def alive(self):
+        """If the forward is open and the master connection is still running"""
+        return self.open and self.master.alive()
+
+class TunnelManager(object):
+    """Reuses one ControlMaster connection per bastion for the life of the
+    process, restarting it if it has died.
+    """
+
+    def __init__(self):
+        self.masters = {}
+        self.hops = {}
+        self.control_dir = None
+        self.lock = threading.Lock()
+
+    def master(self, key, bastion_ip, bastion_user="ec2-user", bastion_port=22):
+        """Get the master connection for the bastion, starting it if needed
+
+        Returns:
+            (ControlMaster) : Running master connection
+        """
+        target = (key, bastion_ip, bastion_user, bastion_port)
+        with self.lock:
+            master = self.masters.get(target)
+            if master is not None and master.alive():
+                return master
+
+            if self.control_dir is None:
+                # Control sockets have a short maximum path length
+                self.control_dir = tempfile.mkdtemp(prefix="boss-ssh-")
+            control_path = os.path.join(self.control_dir, str(len(self.masters)))
+
+            if master is not None:
+                master.close()
+            master = ControlMaster(key, bastion_ip, bastion_user, bastion_port, control_path)
+            self.masters[target] = master
+            return master
+
+    def hop(self, key, remote_ip, bastion_ip, bastion_user="ec2-user", bastion_port=22):
+        """Get the local port of a tunnel to remote_ip:22 through the bastion,
+        that is kept open so other SSH connections can be made through it
+
+        Returns:
+            (int) : Local port of the tunnel
+        """
+        target = (key, remote_ip, bastion_ip, bastion_user, bastion_port)
+        master = self.master(key, bastion_ip, bastion_user, bastion_port)
+        with self.lock:
+            hop = self.hops.get(target)
+            if hop is not None and hop.master is master and hop.open:
+                return hop.local_port
+
+        hop = master.forward(None, remote_ip, 22)
+        with self.lock:
+            self.hops[target] = hop
+        return hop.local_port
+
+    def close(self):
+        """Close all of the master connections"""
+        with self.lock:
+            for master in self.masters.values():
+                master.close()
+            self.masters.clear()
+            self.hops.clear()
+
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors = True)
+                self.control_dir = None
+
+tunnels = TunnelManager()
+atexit.register(tunnels.close)
 
 def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user="ec2-user", bastion_port=22):
     """Create a SSH tunnel.
 
     Creates a SSH tunnel from localhost:local_port to remote_ip:remote_port through bastion_ip.
+    The tunnel is multiplexed over the bastion's ControlMaster connection and
+    is ready to use when returned.
 
     Args:
         key (string) : Path to a SSH private key, protected as required by SSH
-        local_port : Port on the local machine to attach the local end of the tunnel to
+        local_port (None|int) : Port on the local machine to attach the local end of the tunnel to
+                                If None, a free port is located (see Forward.local_port)
         remote_ip : IP of the machine the tunnel remote end should point at
         remote_port : Port of on the remote_ip that the tunnel should point at
         bastion_ip : IP of the machine to form the SSH tunnel through
@@ -87,30 +308,10 @@ def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_u
         bastion_port : Port on the bastion_ip to connect to when creating the tunnel
 
     Returns:
-        (Popen) : Popen process object of the SSH tunnel
+        (Forward) : Popen like object of the SSH tunnel
     """
-    fwd_cmd_fmt = "ssh -i {} {} -N -L {}:{}:{} -p {} {}@{}"
-    fwd_cmd = fwd_cmd_fmt.format(key,
-                                 SSH_OPTIONS,
-                                 local_port,
-                                 remote_ip,
-                                 remote_port,
-                                 bastion_port,
-                                 bastion_user,
-                                 bastion_ip)
-
-    proc = subprocess.Popen(shlex.split(fwd_cmd))
-
-    try:
-        r = proc.wait(TUNNEL_SLEEP)
-        if r == 255:
-            raise SSHError("Error establishing a SSH tunnel")
-        else:
-            raise SSHTunnelError("SSH tunnel exited with error code {}".format(ret))
-    except subprocess.TimeoutExpired:
-        pass # process is still running, tunnel is up
-
-    return proc
+    master = tunnels.master(key, bastion_ip, bastion_user, bastion_port)
+    return master.forward(local_port, remote_ip, remote_port)
 
 def create_tunnel_aplnis(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user="ec2-user"):
     """Create a SSH tunnel, possibly though an extra bastion defined by environmental variables.
@@ -131,8 +332,7 @@ def create_tunnel_aplnis(key, local_port, remote_ip, remote_port, bastion_ip, ba
         bastion_user : The user account of the bastion_ip machine to use when creating the tunnel
 
     Returns:
-        (Popen) : Popen process object of the SSH tunnel
-        (ProcWrapper) : ProcWrapper that contains multiple Popen objects, one for each tunnel
+        (Forward) : Popen like object of the SSH tunnel
     """
     apl_bastion_ip = os.environ.get("BASTION_IP")
     apl_bastion_key = os.environ.get("BASTION_KEY")
@@ -148,28 +348,18 @@ def create_tunnel_aplnis(key, local_port, remote_ip, remote_port, bastion_ip, ba
         # traffic
         # localhost -> apl_bastion -> bastion -> remote
         #print("Using Bastion host at {}".format(apl_bastion_ip))
-        wrapper = ProcWrapper()
-        port = locate_port()
 
         # Used http://superuser.com/questions/96489/ssh-tunnel-via-multiple-hops mssh.pl
         # to figure out the multiple tunnels
 
         # Open up a SSH tunnel to bastion_ip:22 through apl_bastion_ip
-        # (to allow the second tunnel to be created)
-        proc = create_tunnel(apl_bastion_key, port, bastion_ip, 22, apl_bastion_ip, apl_bastion_user)
-        wrapper.prepend(proc)
+        # (to allow the second tunnel to be created). The tunnel is reused, so
+        # that the master connection to bastion_ip through it is also reused
+        port = tunnels.hop(apl_bastion_key, bastion_ip, apl_bastion_ip, apl_bastion_user)
 
-        try:
-            # Create our normal tunnel, but connect to localhost:port to use the
-            # first tunnel that we create
-            proc = create_tunnel(key, local_port, remote_ip, remote_port, "localhost", bastion_user, port)
-            wrapper.prepend(proc)
-            return wrapper
-        except:
-            # close the initial tunnel
-            wrapper.terminate()
-            wrapper.wait()
-            raise # raise initial exception
+        # Create our normal tunnel, but connect to localhost:port to use the
+        # first tunnel that we create
+        return create_tunnel(key, local_port, remote_ip, remote_port, "localhost", bastion_user, port)
 
 def create_tunnel_bastion(local_port, remote_ip, remote_port):
     """Create a SSH tunnel through the bastion machine defined by environmental variables.
@@ -182,7 +372,7 @@ def create_tunnel_bastion(local_port, remote_ip, remote_port):
         remote_port : Port of on the remote_ip that the tunnel should point at
 
     Returns:
-        (Popen) : Popen process object of the SSH tunnel
+        (Forward|None) : Popen like object of the SSH tunnel or None if no bastion is defined
     """
     apl_bastion_ip = os.environ.get("BASTION_IP")
     apl_bastion_key = os.environ.get("BASTION_KEY")
@@ -209,7 +399,7 @@ class SSHConnection(object):
         self.key = key
         self.remote_ip, self.remote_port, self.remote_user = unpack(target, 22, "ubuntu")
         self.bastion_ip, self.bastion_port, self.bastion_user = unpack(bastion, 22, "ec2-user")
-        self.local_port = local_port if local_port else random.randint(10000,60000)
+        self.local_port = local_port # None to locate a free port for each tunnel
 
     @contextmanager
     def _connect(self):
@@ -242,7 +432,7 @@ class SSHConnection(object):
                                          self.remote_port)
 
         if proc:
-            args = ("localhost", self.local_port)
+            args = ("localhost", proc.local_port)
         else:
             args = (self.remote_ip, self.remote_port)
 
@@ -364,6 +554,68 @@ class SSHConnection(object):
 
             yield cmd
 
+    def stream(self, command, timeout = None, prefix = "", lock = None):
+        """Create SSH tunnel(s) through bastion machine(s) and execute a command over
+        SSH, printing each line of output with the given prefix as it is received.
+
+        Args:
+            command (string) : Command to execute on remote_ip
+            timeout (None|int|float) : Number of seconds, including the time to
+                                       create the SSH tunnel(s), before the
+                                       command is killed
+            prefix (string) : Prefix for each line of output
+            lock (None|Lock) : Lock held while printing, so the output of
+                               multiple connections doesn't interleave
+
+        Returns:
+            (int|None) : Exit code of the command or None if it timed out
+        """
+        if lock is None:
+            lock = threading.Lock()
+
+        timed_out = threading.Event()
+        proc = None
+        def kill():
+            timed_out.set()
+            if proc is not None:
+                proc.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        try:
+            with self._connect() as host_port:
+                if timed_out.is_set():
+                    return None
+
+                host, port = host_port
+                ssh_cmd_str = "ssh -i {} {} -p {} {}@{} '{}'" \
+                                    .format(self.key, SSH_OPTIONS, port, self.remote_user, host, command)
+
+                proc = subprocess.Popen(shlex.split(ssh_cmd_str),
+                                        stdin = subprocess.DEVNULL,
+                                        stdout = subprocess.PIPE,
+                                        stderr = subprocess.STDOUT)
+                if timed_out.is_set(): # Timer fired while starting the process
+                    proc.kill()
+
+                for line in proc.stdout:
+                    line = line.decode(errors = "replace").rstrip("\n")
+                    with lock:
+                        print(prefix + line, flush = True)
+                ret = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if timed_out.is_set():
+            return None
+
+        check_ssh(ret)
+        return ret
+
     def cmd(self, command = None):
         """Create SSH tunnel(s) through bastion machine(s) and execute a command over
         SSH.
@@ -390,9 +642,9 @@ class SSHConnection(object):
         """Create SSH tunnel(s) through bastion machine(s), setup a SSH tunnel,
         and return the local port to connect to.
         """
-        with self._connect():
+        with self._connect() as host_port:
             # DP NOTE: assume that the caller already configured a bastion machine
-            yield self.local_port
+            yield host_port[1]
 
     def external_tunnel(self, port = None, local_port = None):
         """Create SSH tunnel(s) through bastion machine(s) and setup a SSH tunnel.
@@ -430,6 +682,63 @@ class SSHConnection(object):
                         .format(self.local_port, self.remote_ip, self.remote_port))
             input("Waiting to close tunnel...")
 
+def run_all(key, targets, bastion, command, workers = FLEET_WORKERS, timeout = None):
+    """Execute a command on multiple machines concurrently, printing the output
+    of each machine, prefixed with its address, as it is received.
+
+    Args:
+        key (string) : Path to a SSH private key, protected as required by SSH
+        targets (list) : List of targets, in the SSHConnection target format
+        bastion : Bastion, in the SSHConnection bastion format
+        command (string) : Command to execute
+        workers (int) : Maximum number of machines to execute the command on at once
+        timeout (None|int|float) : Number of seconds before the command is killed
+                                   on a machine, including connecting to it
+
+    Returns:
+        (dict) : Dictionary of target address to the command's exit code,
+                 None if it timed out, or the exception raised
+    """
+    lock = threading.Lock()
+    width = max([len(unpack(target)[0]) for target in targets] + [0])
+
+    def run(target):
+        ssh = SSHConnection(key, target, bastion)
+        prefix = "[{:<{}}] ".format(ssh.remote_ip, width)
+        try:
+            return ssh.stream(command, timeout, prefix, lock)
+        except Exception as ex: # Record the error, so other machines' results aren't lost
+            return ex
+
+    with ThreadPoolExecutor(max_workers = max(1, min(workers, len(targets)))) as executor:
+        results = executor.map(run, targets)
+        return {unpack(target)[0]: result for target, result in zip(targets, results)}
+
+def format_results(results):
+    """Format the results of run_all as a summary table.
+
+    Args:
+        results (dict) : Results returned by run_all
+
+    Returns:
+        (string) : Table of results
+    """
+    fmt = "{:<20}{}"
+    lines = [fmt.format("Host", "Result")]
+    for host in sorted(results):
+        result = results[host]
+        if result is None:
+            result = "timed out"
+        elif isinstance(result, Exception):
+            result = "error: {}".format(result)
+        else:
+            result = "exit code {}".format(result)
+        lines.append(fmt.format(host, result))
+
+    ok = len([r for r in results.values() if r == 0])
+    lines.append("{} of {} succeeded".format(ok, len(results)))
+    return "\n".join(lines)
+
 def vault_tunnel(key, bastion):
     ssh = SSHConnection(key, ("localhost", 3128), bastion, local_port=3128)
     return ssh.tunnel()
@@ -35,7 +35,50 @@ class BossStateMachine(heaviside.StateMachine):
             return self.__translate(type_, "{}-{}".format(function, self.domain))
         self._translate = _translate
 
-def create(session, name, domain, sfn_file, role):
+def expand_branches(source, branches):
+    """Repeat the parallel branches that contain a placeholder.
+
+    Heaviside parallel states have a fixed number of branches, so a branch
+    containing '{name}' is repeated branches[name] times, with '{name}'
+    replaced by the index of the branch.
+
+    Args:
+        source (string) : Heaviside source
+        branches (dict) : Dictionary of placeholder name and number of branches
+
+    Returns:
+        (string) : Heaviside source with the branches repeated
+    """
+    lines = source.splitlines(keepends=True)
+    expanded = []
+    i = 0
+    while i < len(lines):
+        end = i + 1
+        if lines[i].startswith('parallel:'):
+            # The branch ends at the next line that isn't indented
+            while end < len(lines) and (lines[end].strip() == '' or lines[end][0].isspace()):
+                end += 1
+
+        block = ''.join(lines[i:end])
+        for name, count in branches.items():
+            placeholder = '{' + name + '}'
+            if lines[i].startswith('parallel:') and placeholder in block:
+                block = ''.join(block.replace(placeholder, str(n)) for n in range(count))
+        expanded.append(block)
+        i = end
+    return ''.join(expanded)
+
+def create(session, name, domain, sfn_file, role, branches=None):
+    """Create the step function, if it doesn't exist
+
+    Args:
+        session (Session) : Boto3 session
+        name (string) : Name of the step function
+        domain (string) : Domain the step function's lambdas / activities are in
+        sfn_file (string) : Heaviside file in cloud_formation/stepfunctions/
+        role (string) : IAM role the step function executes under
+        branches (None|dict) : Parallel branches to repeat, see expand_branches()
+    """
     filepath = repo_path('cloud_formation', 'stepfunctions', sfn_file)
     filepath = Path(filepath)
 
@@ -44,7 +87,10 @@ def create(session, name, domain, sfn_file, role):
     if machine.arn is not None:
         print("StepFunction '{}' already exists, not creating".format(name))
     else:
-        machine.create(filepath, role)
+        source = filepath
+        if branches is not None:
+            source = expand_branches(filepath.read_text(), branches)
+        machine.create(source, role)
 
 def delete(session, name):
     machine = BossStateMachine(name, None, session)
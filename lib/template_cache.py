@@ -0,0 +1,173 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for skipping the regeneration of up to date CloudFormation templates.
+
+When a config's template is generated the inputs are saved next to the
+template in templates/.cache/. The inputs are:
+    * The hash of the config module and lib/ source code
+    * The hash of the files named by lib/constants and the config module,
+      like the lambda sources, DynamoDB schemas, and Keycloak realm
+    * The SCENARIO, AMI_VERSION, and SSH_KEY environment variables
+    * The result of every lib/aws lookup the config made
+
+A template is up to date if the source, files, and environment are unchanged
+and repeating the lookups returns the same results. Lookups are only repeated
+once their lib/aws TTL has expired since the template was generated.
+
+Only lib/aws lookups decorated with @cached or @recorded are tracked, so
+configs that read other external state (like Vault) when generating should
+set GENERATE_CACHE = False to always be regenerated.
+"""
+
+import os
+import time
+import json
+import glob
+import hashlib
+
+from . import aws
+from . import constants as const
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+TEMPLATE_DIR = os.path.realpath(os.path.join(CUR_DIR, '..', 'cloud_formation', 'templates'))
+CACHE_DIR = os.path.join(TEMPLATE_DIR, '.cache')
+
+def _normalize(value):
+    """Convert a value into the form it has after being saved as Json"""
+    return json.loads(json.dumps(value))
+
+def input_files(module):
+    """Find the files a config may read while generating its template
+
+    Every string attribute of lib/constants and the config module that is the
+    path of a file is included, as these name the files that get inlined into
+    templates (lambda sources, DynamoDB schemas, Keycloak realm, etc).
+
+    Args:
+        module (module) : Config module
+
+    Returns:
+        (list) : Sorted list of file paths
+    """
+    files = set()
+    for source in (const, module):
+        for value in vars(source).values():
+            if isinstance(value, str) and os.path.isabs(value) and os.path.isfile(value):
+                files.add(os.path.realpath(value))
+    files.discard(os.path.realpath(const.LOOKUP_CACHE_FILE))
+    return sorted(files)
+
+def source_hash(module):
+    """Hash the source code of the config module, the lib/ modules it uses,
+    and the files it reads
+
+    Args:
+        module (module) : Config module
+
+    Returns:
+        (string) : SHA256 hex digest
+    """
+    sha = hashlib.sha256()
+    for path in [module.__file__] + sorted(glob.glob(os.path.join(CUR_DIR, '*.py'))):
+        with open(path, 'rb') as fh:
+            sha.update(fh.read())
+    for path in input_files(module):
+        sha.update(path.encode())
+        with open(path, 'rb') as fh:
+            sha.update(hashlib.sha256(fh.read()).digest())
+    return sha.hexdigest()
+
+def cache_key(config, domain, module):
+    """Create the key describing the non-lookup inputs of a config's template
+
+    Args:
+        config (string) : Name of the config
+        domain (string) : Domain the config is generated for
+        module (module) : Config module
+
+    Returns:
+        (dict) : Cache key
+    """
+    return {
+        'config': config,
+        'domain': domain,
+        'source': source_hash(module),
+        'scenario': os.environ.get('SCENARIO'),
+        'ami_version': os.environ.get('AMI_VERSION'),
+        'ssh_key': os.environ.get('SSH_KEY'), # Used by aws.keypair_lookup()
+    }
+
+def _cache_path(config, domain):
+    return os.path.join(CACHE_DIR, "{}.{}.json".format(config, domain))
+
+def is_fresh(session, config, domain, key, outputs):
+    """Determine if a config's generated template is up to date
+
+    Args:
+        session (Session) : Boto3 session used to repeat the lookups
+        config (string) : Name of the config
+        domain (string) : Domain the config is generated for
+        key (dict) : Cache key from cache_key()
+        outputs (list) : Paths of the files the config generates
+
+    Returns:
+        (bool) : If the template doesn't need to be generated again
+    """
+    try:
+        with open(_cache_path(config, domain), 'r') as fh:
+            entry = json.load(fh)
+    except (OSError, ValueError):
+        return False
+
+    if entry.get('key') != _normalize(key):
+        return False
+
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+
+    age = time.time() - entry.get('time', 0)
+    for name, args, kwargs, value in entry.get('lookups', []):
+        if name == 'keypair_lookup' and os.environ.get('SSH_KEY') is None:
+            return False # Would prompt for the keypair to use
+
+        lookup = getattr(aws, name, None)
+        if getattr(lookup, 'cached', False) and age < aws.LOOKUP_TTLS.get(name, aws.LOOKUP_CACHE_TTL):
+            continue # The cached result cannot have expired yet
+
+        try:
+            if lookup is None or _normalize(lookup(session, *args, **kwargs)) != value:
+                return False
+        except Exception: # Like a resource that no longer exists
+            return False
+
+    return True
+
+def save(config, domain, key, lookups):
+    """Save the inputs used to generate a config's template
+
+    Args:
+        config (string) : Name of the config
+        domain (string) : Domain the config is generated for
+        key (dict) : Cache key from cache_key()
+        lookups (list) : Lookups recorded by aws.lookup_cache while generating
+    """
+    # Only keep one copy of lookups that were made multiple times
+    unique = {}
+    for name, args, kwargs, value in lookups:
+        unique[json.dumps([name, args, kwargs], sort_keys=True)] = [name, args, kwargs, value]
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_cache_path(config, domain), 'w') as fh:
+        json.dump({'key': key, 'time': time.time(), 'lookups': list(unique.values())}, fh, indent=4)
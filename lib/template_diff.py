@@ -0,0 +1,279 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for comparing CloudFormation templates offline.
+
+Computes a resource / property level diff between a deployed template and a
+locally generated template and classifies each modification as requiring
+replacement of the resource or being applied in place, using a rule table
+of the properties that require replacement for each resource type.
+
+The results use the same Action / Replacement values as a CloudFormation
+change set, so they can be reviewed before creating one.
+"""
+
+import re
+
+ALL = '*' # Any property change requires replacement
+
+# Properties that, when changed, cause CloudFormation to replace the resource
+# Based on the "Update requires: Replacement" notes in the CloudFormation
+# resource reference, for the resource types used by the configs
+REPLACEMENT_RULES = {
+    "AWS::AutoScaling::AutoScalingGroup": {"AutoScalingGroupName", "InstanceId"},
+    "AWS::AutoScaling::LaunchConfiguration": ALL,
+    "AWS::AutoScaling::ScalingPolicy": set(),
+    "AWS::CloudWatch::Alarm": {"AlarmName"},
+    "AWS::DynamoDB::Table": {"TableName", "KeySchema", "LocalSecondaryIndexes"},
+    "AWS::EC2::EIP": {"Domain"},
+    "AWS::EC2::Instance": {"AvailabilityZone", "ImageId", "KeyName", "NetworkInterfaces",
+                           "PlacementGroupName", "PrivateIpAddress", "SecurityGroups",
+                           "SubnetId", "Tenancy"},
+    "AWS::EC2::InternetGateway": set(),
+    "AWS::EC2::NatGateway": {"AllocationId", "SubnetId"},
+    "AWS::EC2::Route": {"DestinationCidrBlock", "RouteTableId"},
+    "AWS::EC2::RouteTable": {"VpcId"},
+    "AWS::EC2::SecurityGroup": {"GroupDescription", "GroupName", "VpcId"},
+    "AWS::EC2::Subnet": {"AvailabilityZone", "CidrBlock", "Ipv6CidrBlock", "VpcId"},
+    "AWS::EC2::SubnetRouteTableAssociation": {"SubnetId"},
+    "AWS::EC2::VPC": {"CidrBlock", "InstanceTenancy"},
+    "AWS::EC2::VPCEndpoint": {"ServiceName", "VpcId"},
+    "AWS::EC2::VPCGatewayAttachment": set(),
+    "AWS::EC2::VPCPeeringConnection": {"PeerOwnerId", "PeerRoleArn", "PeerVpcId", "VpcId"},
+    "AWS::ElastiCache::CacheCluster": {"AZMode", "CacheNodeType", "CacheSubnetGroupName",
+                                       "ClusterName", "Engine", "Port",
+                                       "PreferredAvailabilityZone", "PreferredAvailabilityZones",
+                                       "SnapshotArns", "SnapshotName"},
+    "AWS::ElastiCache::ParameterGroup": {"CacheParameterGroupFamily", "Description"},
+    "AWS::ElastiCache::ReplicationGroup": {"CacheSubnetGroupName", "Engine", "NodeGroupConfiguration",
+                                           "Port", "PreferredCacheClusterAZs",
+                                           "ReplicationGroupId", "SnapshotArns", "SnapshotName"},
+    "AWS::ElastiCache::SubnetGroup": {"CacheSubnetGroupName"},
+    "AWS::ElasticLoadBalancing::LoadBalancer": {"LoadBalancerName", "Scheme"},
+    "AWS::Events::Rule": {"Name"},
+    "AWS::Lambda::Function": {"FunctionName"},
+    "AWS::Lambda::Permission": ALL,
+    "AWS::RDS::DBInstance": {"AvailabilityZone", "CharacterSetName", "DBInstanceIdentifier",
+                             "DBName", "DBSnapshotIdentifier", "DBSubnetGroupName", "KmsKeyId",
+                             "MasterUsername", "SourceDBInstanceIdentifier", "StorageEncrypted"},
+    "AWS::RDS::DBSubnetGroup": {"DBSubnetGroupName"},
+    "AWS::Route53::HostedZone": {"Name"},
+    "AWS::Route53::RecordSet": {"HostedZoneId", "HostedZoneName", "Name"},
+    "AWS::S3::Bucket": {"BucketName"},
+    "AWS::SNS::Topic": {"TopicName"},
+    "AWS::SQS::Queue": {"FifoQueue", "QueueName"},
+}
+
+# Resource attributes that are updated without touching the resource
+ATTRIBUTES = ("Condition", "CreationPolicy", "DeletionPolicy", "DependsOn", "Metadata", "UpdatePolicy")
+
+# Order of Replacement values, from least to most severe
+SEVERITY = ["", "False", "Conditional", "True"]
+
+# ${Name} or ${Name.Attribute} in a Fn::Sub string, ${!Literal} is not a variable
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+def sub_variables(value):
+    """Find the variables used by a Fn::Sub value.
+
+    Args:
+        value (string|list) : Fn::Sub string or [string, {name: value}] list
+
+    Returns:
+        (list) : List of (name, attribute or None) tuples, excluding the
+                 names defined by the Fn::Sub's variable map
+    """
+    string, local = (value[0], value[1]) if isinstance(value, list) else (value, {})
+
+    variables = []
+    for match in SUB_VARIABLE.finditer(string):
+        name, _, attribute = match.group(1).strip().partition('.')
+        if name not in local and (name, attribute or None) not in variables:
+            variables.append((name, attribute or None))
+    return variables
+
+def references(value):
+    """Find the names of the parameters and resources referenced by Ref,
+    Fn::GetAtt, Fn::Sub, and DependsOn in a template value.
+
+    Args:
+        value (object) : Template value
+
+    Returns:
+        (set) : Set of referenced names
+    """
+    refs = set()
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k == 'Ref':
+                refs.add(v)
+            elif k == 'Fn::GetAtt':
+                refs.add(v[0] if isinstance(v, list) else v.split('.')[0])
+            elif k == 'Fn::Sub':
+                refs.update(name for name, _ in sub_variables(v))
+                if isinstance(v, list) and len(v) > 1:
+                    refs |= references(v[1])
+            elif k == 'DependsOn':
+                refs.update([v] if isinstance(v, str) else v)
+            else:
+                refs |= references(v)
+    elif isinstance(value, list):
+        for v in value:
+            refs |= references(v)
+    return refs
+
+def requires_replacement(type_, properties):
+    """Determine if changing the given properties replaces the resource.
+
+    Args:
+        type_ (string) : CloudFormation resource type
+        properties (list) : Names of the changed properties
+
+    Returns:
+        (string) : 'True', 'False', or 'Conditional' if the resource type is
+                   not in REPLACEMENT_RULES
+    """
+    if len(properties) == 0:
+        return "False"
+
+    rule = REPLACEMENT_RULES.get(type_)
+    if rule is None:
+        return "Conditional"
+    elif rule == ALL or len(rule & set(properties)) > 0:
+        return "True"
+    else:
+        return "False"
+
+def changed_parameters(deployed, arguments):
+    """Find the template parameters whose values will change.
+
+    Args:
+        deployed (list) : Stack parameters, as returned by describe_stacks
+        arguments (list) : CloudFormationConfiguration.arguments
+
+    Returns:
+        (set) : Set of parameter names
+    """
+    current = {p['ParameterKey']: p.get('ParameterValue') for p in deployed}
+
+    changed = set()
+    for argument in arguments:
+        key = argument['ParameterKey']
+        value = argument.get('ParameterValue')
+        if argument.get('UsePreviousValue') or value is None:
+            continue
+        if current.get(key) == '****': # NoEcho values are not returned
+            continue
+        if current.get(key) != value:
+            changed.add(key)
+    return changed
+
+def diff_templates(deployed, local, parameters=()):
+    """Compute the resource level changes between two templates.
+
+    Changed parameters and replaced resources are propagated to the resources
+    that reference them, as the referenced value will change.
+
+    Args:
+        deployed (dict) : Currently deployed template
+        local (dict) : Template that will be deployed
+        parameters (set) : Names of the parameters whose values will change
+
+    Returns:
+        (list) : List of dictionaries, sorted by LogicalResourceId, with the keys
+                 Action ('Add', 'Remove', 'Modify'), LogicalResourceId,
+                 ResourceType, Replacement ('True', 'False', 'Conditional',
+                 or '' for Add / Remove) and Details (list of changed
+                 properties / attributes)
+    """
+    old = deployed.get('Resources', {})
+    new = local.get('Resources', {})
+
+    changes = {}
+    def change(action, key, type_, replacement, details):
+        changes[key] = {
+            'Action': action,
+            'LogicalResourceId': key,
+            'ResourceType': type_,
+            'Replacement': replacement,
+            'Details': details,
+        }
+
+    for key in new.keys() - old.keys():
+        change('Add', key, new[key].get('Type'), '', [])
+
+    for key in old.keys() - new.keys():
+        change('Remove', key, old[key].get('Type'), '', [])
+
+    for key in old.keys() & new.keys():
+        o, n = old[key], new[key]
+        type_ = n.get('Type')
+        if o.get('Type') != type_:
+            change('Modify', key, type_, 'True', ['Type'])
+            continue
+
+        op, np = o.get('Properties', {}), n.get('Properties', {})
+        properties = sorted(p for p in op.keys() | np.keys() if op.get(p) != np.get(p))
+        attributes = [a for a in ATTRIBUTES if o.get(a) != n.get(a)]
+        if len(properties) > 0 or len(attributes) > 0:
+            change('Modify', key, type_, requires_replacement(type_, properties), properties + attributes)
+
+    # Propagate value changes to the resources that reference them
+    queue = list(parameters)
+    queue.extend(k for k, c in changes.items() if c['Action'] == 'Modify' and c['Replacement'] == 'True')
+    seen = set(queue)
+    while len(queue) > 0:
+        name = queue.pop()
+        for key in old.keys() & new.keys():
+            if key in changes and changes[key]['Action'] != 'Modify':
+                continue
+
+            type_ = new[key].get('Type')
+            properties = [p for p, v in new[key].get('Properties', {}).items() if name in references(v)]
+            if len(properties) == 0:
+                continue
+
+            if key not in changes:
+                change('Modify', key, type_, 'False', [])
+
+            c = changes[key]
+            c['Details'] = sorted(set(c['Details']) | set(properties))
+            replacement = requires_replacement(type_, properties)
+            if SEVERITY.index(replacement) > SEVERITY.index(c['Replacement']):
+                c['Replacement'] = replacement
+
+            if c['Replacement'] == 'True' and key not in seen:
+                seen.add(key)
+                queue.append(key)
+
+    return [changes[k] for k in sorted(changes)]
+
+def format_changes(changes):
+    """Format the changes returned by diff_templates as a table.
+
+    Args:
+        changes (list) : Changes returned by diff_templates
+
+    Returns:
+        (string) : Table of changes
+    """
+    fmt = "{:<10}{:<40}{:<45}{:<14}{}"
+    lines = [fmt.format("Action", "Logical ID", "Resource Type", "Replacement", "Details")]
+    for c in changes:
+        lines.append(fmt.format(c['Action'],
+                                c['LogicalResourceId'],
+                                c['ResourceType'],
+                                c['Replacement'],
+                                ", ".join(c['Details'])))
+    return "\n".join(lines)
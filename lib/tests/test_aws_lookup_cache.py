@@ -0,0 +1,300 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from botocore.exceptions import ClientError
+
+from lib import aws
+
+
+def make_session(access_key='AKIA1', region='us-east-1'):
+    session = mock.MagicMock()
+    session.get_credentials.return_value.access_key = access_key
+    session.region_name = region
+    client = session.client.return_value
+    client.can_paginate.return_value = False
+    client.describe_vpcs.return_value = {'Vpcs': [{'VpcId': 'vpc-1'}]}
+    return session, client
+
+
+class TestLookupCache(unittest.TestCase):
+    def setUp(self):
+        aws.lookup_cache.invalidate()
+        aws.lookup_cache.counts.clear()
+
+    def test_repeated_lookup_calls_aws_once(self):
+        session, client = make_session()
+
+        self.assertEqual('vpc-1', aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertEqual('vpc-1', aws.vpc_id_lookup(session, 'test.boss'))
+
+        self.assertEqual(1, client.describe_vpcs.call_count)
+        self.assertEqual(1, aws.lookup_cache.hits)
+        self.assertEqual(1, aws.lookup_cache.misses)
+
+    def test_keyed_by_session_and_arguments(self):
+        session, client = make_session()
+        other, other_client = make_session(region='us-west-2')
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.vpc_id_lookup(session, 'other.boss')
+        aws.vpc_id_lookup(other, 'test.boss')
+
+        self.assertEqual(2, client.describe_vpcs.call_count)
+        self.assertEqual(1, other_client.describe_vpcs.call_count)
+
+    def test_invalidate(self):
+        session, client = make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.lookup_cache.invalidate(session)
+        aws.vpc_id_lookup(session, 'test.boss')
+
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_ttl_expires(self):
+        session, client = make_session()
+
+        with mock.patch.dict(aws.LOOKUP_TTLS, {'vpc_id_lookup': 0}):
+            aws.vpc_id_lookup(session, 'test.boss')
+            aws.vpc_id_lookup(session, 'test.boss')
+
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_saved_entries_shared_between_runs(self):
+        session, client = make_session()
+        client.describe_subnets.return_value = {'Subnets': []}
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.subnet_id_lookup(session, 'a.test.boss') # None is not saved
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'private', 'lookup_cache.json')
+            aws.lookup_cache.save(path)
+            aws.lookup_cache.invalidate()
+            aws.lookup_cache.load(path)
+
+        self.assertEqual('vpc-1', aws.vpc_id_lookup(session, 'test.boss'))
+        aws.subnet_id_lookup(session, 'a.test.boss')
+
+        self.assertEqual(1, client.describe_vpcs.call_count)
+        self.assertEqual(2, client.describe_subnets.call_count)
+
+    def save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'private', 'lookup_cache.json')
+            aws.lookup_cache.save(path)
+            aws.lookup_cache.invalidate()
+            aws.lookup_cache.load(path)
+
+    def test_saved_entries_keep_types(self):
+        session, client = make_session()
+        client.describe_security_groups.return_value = {
+            'SecurityGroups': [{'GroupId': 'sg-1', 'Tags': [{'Key': 'Name', 'Value': 'ssh'}]}]
+        }
+        client.describe_availability_zones.return_value = {'AvailabilityZones': []}
+
+        aws.sg_lookup_all(session, 'vpc-1')
+        aws.azs_lookup(session) # [] is not saved
+        self.save_and_load()
+
+        sgs = aws.sg_lookup_all(session, 'vpc-1')
+        self.assertIsInstance(sgs, aws.NoneDict)
+        self.assertIsNone(sgs['missing'])
+        aws.azs_lookup(session)
+
+        self.assertEqual(1, client.describe_security_groups.call_count)
+        self.assertEqual(2, client.describe_availability_zones.call_count)
+
+    def test_ami_lookup_not_saved(self):
+        session, client = make_session()
+        client.describe_images.return_value = {'Images': [
+            {'ImageId': 'ami-1', 'Name': 'auth.boss-h1234', 'CreationDate': '2016',
+             'Tags': [{'Key': 'Commit', 'Value': 'abc'}]},
+        ]}
+
+        self.assertEqual(('ami-1', 'abc'), aws.ami_lookup(session, 'auth.boss', version = 'latest'))
+        self.save_and_load()
+        aws.ami_lookup(session, 'auth.boss', version = 'latest')
+
+        self.assertEqual(2, client.describe_images.call_count)
+
+    def test_uncached_lookups_recorded(self):
+        session, client = make_session()
+        client.get_queue_url.return_value = {'QueueUrl': 'https://queue.amazonaws.com/1/queue'}
+
+        aws.lookup_cache.recording = []
+        try:
+            aws.vpc_id_lookup(session, 'test.boss')
+            aws.sqs_lookup_url(session, 'queue')
+            recording = aws.lookup_cache.recording
+        finally:
+            aws.lookup_cache.recording = None
+
+        self.assertEqual([('vpc_id_lookup', ['test.boss'], {}, 'vpc-1'),
+                          ('sqs_lookup_url', ['queue'], {}, 'https://queue.amazonaws.com/1/queue')],
+                         recording)
+
+    def test_cached_values_are_copies(self):
+        session, client = make_session()
+        client.describe_security_groups.return_value = {
+            'SecurityGroups': [{'GroupId': 'sg-1', 'Tags': [{'Key': 'Name', 'Value': 'ssh'}]}]
+        }
+
+        sgs = aws.sg_lookup_all(session, 'vpc-1')
+        sgs['ssh'] = 'sg-changed'
+
+        self.assertEqual('sg-1', aws.sg_lookup_all(session, 'vpc-1')['ssh'])
+
+
+class TestImport(unittest.TestCase):
+    def test_constants_import_first(self):
+        # lib.constants -> lib.cloudformation -> lib.aws -> lib.constants
+        subprocess.check_call([sys.executable, '-c', 'import lib.constants'],
+                              cwd = parent_dir)
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        aws.lookup_cache.invalidate()
+
+    def make_inventory_session(self):
+        session, client = make_session()
+        client.describe_instances.return_value = {'Reservations': [{'Instances': [
+            {'InstanceId': 'i-2', 'State': {'Name': 'running'}, 'PrivateIpAddress': '10.0.0.2',
+             'Tags': [{'Key': 'Name', 'Value': 'auth.test.boss'}]},
+            {'InstanceId': 'i-1', 'State': {'Name': 'running'}, 'PrivateIpAddress': '10.0.0.1',
+             'Tags': [{'Key': 'Name', 'Value': 'auth.test.boss'}]},
+        ]}]}
+        client.describe_subnets.return_value = {'Subnets': [
+            {'SubnetId': 'subnet-1', 'Tags': [{'Key': 'Name', 'Value': 'a-internal.test.boss'}]},
+        ]}
+        client.describe_security_groups.return_value = {'SecurityGroups': [
+            {'GroupId': 'sg-1', 'VpcId': 'vpc-1', 'Tags': [{'Key': 'Name', 'Value': 'ssh'}]},
+        ]}
+        client.describe_route_tables.return_value = {'RouteTables': []}
+        client.describe_load_balancers.return_value = {'LoadBalancerDescriptions': [
+            {'LoadBalancerName': 'auth-test-boss'},
+        ]}
+        client.list_queues.return_value = {'QueueUrls': ['https://queue.amazonaws.com/1/test-queue']}
+        client.list_topics.return_value = {'Topics': [{'TopicArn': 'arn:aws:sns:us-east-1:1:topic'}]}
+        return session, client
+
+    def test_lookups_use_snapshot(self):
+        session, client = self.make_inventory_session()
+        aws.load_inventory(session, 'test.boss')
+        client.reset_mock()
+
+        self.assertEqual('10.0.0.2', aws.machine_lookup(session, '1.auth.test.boss', public_ip=False))
+        self.assertEqual(['10.0.0.1', '10.0.0.2'], aws.machine_lookup_all(session, 'auth.test.boss', public_ip=False))
+        self.assertEqual('i-1', aws.instanceid_lookup(session, 'auth.test.boss'))
+        self.assertEqual('subnet-1', aws.subnet_id_lookup(session, 'a-internal.test.boss'))
+        self.assertEqual('sg-1', aws.sg_lookup(session, 'vpc-1', 'ssh'))
+        self.assertEqual({'ssh': 'sg-1'}, aws.sg_lookup_all(session, 'vpc-1'))
+        self.assertTrue(aws.lb_lookup(session, 'auth.test.boss'))
+        self.assertEqual('https://queue.amazonaws.com/1/test-queue', aws.sqs_lookup_url(session, 'test-queue'))
+        self.assertEqual('arn:aws:sns:us-east-1:1:topic', aws.sns_topic_lookup(session, 'topic'))
+
+        self.assertEqual([], client.method_calls)
+
+    def test_duplicate_names_keep_first(self):
+        session, client = self.make_inventory_session()
+        client.describe_subnets.return_value = {'Subnets': [
+            {'SubnetId': 'subnet-1', 'Tags': [{'Key': 'Name', 'Value': 'a-internal.test.boss'}]},
+            {'SubnetId': 'subnet-2', 'Tags': [{'Key': 'Name', 'Value': 'a-internal.test.boss'}]},
+        ]}
+        client.describe_route_tables.return_value = {'RouteTables': [
+            {'RouteTableId': 'rtb-1', 'VpcId': 'vpc-1', 'Tags': [{'Key': 'Name', 'Value': 'internal'}]},
+            {'RouteTableId': 'rtb-2', 'VpcId': 'vpc-1', 'Tags': [{'Key': 'Name', 'Value': 'internal'}]},
+        ]}
+        aws.load_inventory(session, 'test.boss')
+
+        self.assertEqual('subnet-1', aws.subnet_id_lookup(session, 'a-internal.test.boss'))
+        self.assertEqual('rtb-1', aws.rt_lookup(session, 'vpc-1', 'internal'))
+
+    def test_missing_names_query_aws(self):
+        session, client = self.make_inventory_session()
+        aws.load_inventory(session, 'test.boss')
+        client.describe_subnets.return_value = {'Subnets': [{'SubnetId': 'subnet-2'}]}
+
+        self.assertEqual('subnet-2', aws.subnet_id_lookup(session, 'b-internal.test.boss'))
+
+    def test_lazy_load_on_first_use(self):
+        session, client = self.make_inventory_session()
+        aws.load_inventory(session, 'test.boss', lazy = True)
+
+        self.assertEqual(0, client.describe_instances.call_count)
+        self.assertEqual('10.0.0.2', aws.machine_lookup(session, '1.auth.test.boss', public_ip=False))
+        self.assertEqual('i-1', aws.instanceid_lookup(session, 'auth.test.boss'))
+        self.assertEqual(1, client.describe_instances.call_count)
+
+    def test_denied_request_looked_up_individually(self):
+        session, client = self.make_inventory_session()
+        client.describe_subnets.side_effect = [
+            ClientError({'Error': {'Code': 'UnauthorizedOperation'}}, 'DescribeSubnets'),
+            {'Subnets': [{'SubnetId': 'subnet-1'}]},
+        ]
+
+        aws.load_inventory(session, 'test.boss')
+
+        self.assertEqual('subnet-1', aws.subnet_id_lookup(session, 'a-internal.test.boss'))
+        self.assertEqual('sg-1', aws.sg_lookup(session, 'vpc-1', 'ssh'))
+        self.assertEqual(2, client.describe_subnets.call_count)
+        self.assertEqual(1, client.describe_security_groups.call_count)
+
+    def test_invalidate_discards_snapshot(self):
+        session, client = self.make_inventory_session()
+        aws.load_inventory(session, 'test.boss')
+        aws.lookup_cache.invalidate(session)
+
+        self.assertIsNone(aws.lookup_cache.get_inventory(session))
+
+
+class TestIterators(unittest.TestCase):
+    def setUp(self):
+        aws.lookup_cache.invalidate()
+
+    def test_machine_lookup_all_reads_every_page_and_instance(self):
+        session, client = make_session()
+        client.can_paginate.return_value = True
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Reservations': [{'Instances': [{'PrivateIpAddress': '10.0.0.1'},
+                                             {'PrivateIpAddress': '10.0.0.2'}]}]},
+            {'Reservations': [{'Instances': [{'PrivateIpAddress': '10.0.0.3'}]}]},
+        ]
+
+        addresses = aws.machine_lookup_all(session, 'endpoint.test.boss', public_ip=False)
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'], addresses)
+
+    def test_hosted_zone_must_match_name(self):
+        session, client = make_session()
+        client.list_hosted_zones_by_name.side_effect = [
+            {'HostedZones': [{'Name': 'test.io.', 'Id': '/hostedzone/Z2'}]},
+            {'HostedZones': [{'Name': 'other.io.', 'Id': '/hostedzone/Z1'}]},
+        ]
+
+        self.assertEqual('Z2', aws.get_hosted_zone_id(session, 'test.io'))
+        self.assertIsNone(aws.get_hosted_zone_id(session, 'missing.io'))
+        client.list_hosted_zones_by_name.assert_called_with(DNSName='missing.io', MaxItems='1')
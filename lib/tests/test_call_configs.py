@@ -0,0 +1,152 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import threading
+import unittest
+import importlib.util
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, 'bin'))
+
+from lib import aws
+
+# bin/cloudformation.py would shadow lib.cloudformation, so load it under another name
+spec = importlib.util.spec_from_file_location('cloudformation_cli',
+                                              os.path.join(parent_dir, 'bin', 'cloudformation.py'))
+cloudformation_cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cloudformation_cli)
+
+
+class TestCallConfigs(unittest.TestCase):
+    # c depends on a and b, d depends on c
+    GRAPH = {'a': set(), 'b': set(), 'c': {'a', 'b'}, 'd': {'c'}}
+
+    def setUp(self):
+        self.events = []
+        self.events_lock = threading.Lock()
+        self.results = {}
+
+        def call_config(session, domain, config, func_name):
+            with self.events_lock:
+                self.events.append(('start', config))
+            result = self.results.get(config, True)
+            if isinstance(result, Exception):
+                raise result
+            time.sleep(0.01)
+            with self.events_lock:
+                self.events.append(('end', config))
+            return result
+
+        patches = [
+            mock.patch.object(cloudformation_cli, 'load_dependencies',
+                              side_effect = lambda configs: {c: set(self.GRAPH[c]) for c in configs}),
+            mock.patch.object(cloudformation_cli, 'call_config', side_effect = call_config),
+            mock.patch.object(cloudformation_cli.aws, 'create_session'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def call(self, func_name = 'create', configs = ('a', 'b', 'c', 'd')):
+        return cloudformation_cli.call_configs({}, 'test.boss', list(configs), func_name, 4)
+
+    def started(self):
+        return [config for event, config in self.events if event == 'start']
+
+    def assertAfter(self, config, dependency):
+        self.assertLess(self.events.index(('end', dependency)), self.events.index(('start', config)))
+
+    def test_dependency_order(self):
+        self.assertTrue(self.call())
+
+        self.assertEqual({'a', 'b', 'c', 'd'}, set(self.started()))
+        self.assertAfter('c', 'a')
+        self.assertAfter('c', 'b')
+        self.assertAfter('d', 'c')
+
+    def test_independent_configs_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout = 5)
+        def call_config(session, domain, config, func_name):
+            barrier.wait() # Raises BrokenBarrierError if a and b run one at a time
+            return True
+        cloudformation_cli.call_config.side_effect = call_config
+
+        self.assertTrue(self.call(configs = ('a', 'b')))
+
+    def test_delete_reverses_order(self):
+        self.assertTrue(self.call('delete'))
+
+        self.assertAfter('c', 'd')
+        self.assertAfter('a', 'c')
+        self.assertAfter('b', 'c')
+
+    def test_failure_skips_dependents(self):
+        self.results['a'] = False
+
+        self.assertFalse(self.call())
+
+        self.assertEqual({'a', 'b'}, set(self.started()))
+
+    def test_exception_raised_after_running_configs_finish(self):
+        error = Exception("Stack failed to launch")
+        self.results['c'] = error
+        self.GRAPH = dict(self.GRAPH, e = set())
+
+        with self.assertRaises(Exception) as ctx:
+            self.call(configs = ('a', 'b', 'c', 'd', 'e'))
+
+        self.assertIs(error, ctx.exception)
+        self.assertNotIn('d', self.started())
+        self.assertIn(('end', 'e'), self.events)
+
+    def test_circular_dependency(self):
+        self.GRAPH = {'a': {'b'}, 'b': {'a'}}
+
+        with self.assertRaisesRegex(Exception, "Circular dependency"):
+            self.call(configs = ('a', 'b'))
+
+        self.assertEqual([], self.events)
+
+    def test_prompts_not_interleaved(self):
+        session = mock.MagicMock()
+        session.get_credentials.return_value.access_key = 'AKIA1'
+        session.region_name = 'us-east-1'
+
+        prompting = []
+        overlapped = []
+        def input_(prompt):
+            prompting.append(prompt)
+            overlapped.append(len(prompting) > 1)
+            time.sleep(0.05)
+            prompting.remove(prompt)
+            return '1'
+
+        def call_config(session_, domain, config, func_name):
+            return aws.keypair_lookup(session) == 'key-1'
+        cloudformation_cli.call_config.side_effect = call_config
+
+        with mock.patch.dict(os.environ), \
+             mock.patch.object(aws, 'keypair_names', return_value = ['key-0', 'key-1']), \
+             mock.patch('builtins.input', side_effect = input_):
+            os.environ.pop('SSH_KEY', None)
+            self.assertTrue(self.call(configs = ('a', 'b')))
+
+        self.assertEqual([False, False], overlapped)
@@ -0,0 +1,89 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import datetime
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import cloudformation
+from lib.cloudformation import CloudFormationConfiguration
+
+STACK_ID = 'arn:aws:cloudformation:us-east-1:123:stack/Test/1'
+
+def event(id, status, resource = None):
+    return {'EventId': id,
+            'StackId': STACK_ID,
+            'LogicalResourceId': resource or 'Test',
+            'PhysicalResourceId': STACK_ID if resource is None else resource + '-1',
+            'ResourceStatus': status,
+            'Timestamp': datetime.datetime(2016, 1, 1)}
+
+# Events from the previous update, newest first
+PREVIOUS = [event('e3', 'UPDATE_COMPLETE'),
+            event('e2', 'UPDATE_COMPLETE', 'Instance'),
+            event('e1', 'UPDATE_IN_PROGRESS')]
+
+def make_client(*responses):
+    """Client whose describe_stack_events pages are the given lists of events"""
+    client = mock.MagicMock()
+    client.describe_stacks.return_value = {'Stacks': [{'StackId': STACK_ID}]}
+    client.describe_stack_events.return_value = {'StackEvents': responses[0]}
+    client.get_paginator.return_value.paginate.side_effect = [[{'StackEvents': r}] for r in responses]
+    return client
+
+
+class TestStackEvents(unittest.TestCase):
+    def setUp(self):
+        # The methods under test don't use the stack's configuration
+        self.config = CloudFormationConfiguration.__new__(CloudFormationConfiguration)
+
+    def test_last_event(self):
+        client = make_client(PREVIOUS)
+        self.assertEqual('e3', self.config._last_event(client, 'Test'))
+
+    def test_new_events_after_last(self):
+        new = [event('e5', 'UPDATE_IN_PROGRESS', 'Instance'), event('e4', 'UPDATE_IN_PROGRESS')]
+        client = make_client(new + PREVIOUS)
+
+        events = self.config._new_events(client, STACK_ID, 'e3', 'UPDATE_IN_PROGRESS')
+        self.assertEqual(['e4', 'e5'], [e['EventId'] for e in events])
+
+    def test_new_events_not_recorded_yet(self):
+        client = make_client(PREVIOUS, PREVIOUS)
+
+        self.assertEqual([], self.config._new_events(client, STACK_ID, 'e3', 'UPDATE_IN_PROGRESS'))
+
+        # Without the last event the previous update's events are returned
+        events = self.config._new_events(client, STACK_ID, None, 'UPDATE_IN_PROGRESS')
+        self.assertEqual(['e1', 'e2', 'e3'], [e['EventId'] for e in events])
+
+    @mock.patch.object(cloudformation.time, 'sleep')
+    def test_poll_ignores_previous_action(self, sleep):
+        new = [event('e6', 'UPDATE_ROLLBACK_COMPLETE'),
+               event('e5', 'UPDATE_FAILED', 'Instance'),
+               event('e4', 'UPDATE_IN_PROGRESS')]
+        client = make_client(PREVIOUS, PREVIOUS, new + PREVIOUS)
+
+        last = self.config._last_event(client, 'Test')
+        status = self.config._poll(client, 'Test', 'update', 'UPDATE_IN_PROGRESS', last)
+
+        self.assertEqual('UPDATE_ROLLBACK_COMPLETE', status)
+        self.assertEqual(2, sleep.call_count)
@@ -0,0 +1,151 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import time
+import threading
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import aws
+from lib import external
+from lib.external import ExternalCalls
+
+
+class FakeForward(object):
+    """Minimal ssh.Forward"""
+    def __init__(self, local_port):
+        self.local_port = local_port
+        self.up = True
+        self.terminated = False
+
+    def alive(self):
+        return self.up
+
+    def terminate(self):
+        self.terminated = True
+
+
+def make_calls(bastion_ip = '52.0.0.1'):
+    calls = ExternalCalls.__new__(ExternalCalls)
+    calls.keypair_file = 'key.pem'
+    calls.bastion_ip = bastion_ip
+    return calls
+
+
+class TestTunnelPool(unittest.TestCase):
+    def setUp(self):
+        ports = iter(range(20000, 20100))
+        self.forwards = []
+        def create(key, local_port, remote_ip, remote_port, bastion_ip):
+            self.forwards.append(FakeForward(local_port or next(ports)))
+            return self.forwards[-1]
+
+        patches = [
+            mock.patch.dict(ExternalCalls.tunnels, clear = True),
+            mock.patch.dict(ExternalCalls.tunnel_locks, clear = True),
+            mock.patch.object(external, 'create_tunnel_aplnis', side_effect = create),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.create = external.create_tunnel_aplnis
+
+    def test_reuse(self):
+        calls = make_calls()
+
+        port = calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+        self.assertEqual(port, calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1'))
+        self.assertEqual(port, make_calls()._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1'))
+
+        self.assertEqual(1, self.create.call_count)
+        self.create.assert_called_with('key.pem', None, '10.0.0.1', 8080, '52.0.0.1')
+
+    def test_keyed_by_bastion_and_port(self):
+        make_calls()._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+        make_calls()._tunnel('auth.test.boss', 443, lambda: '10.0.0.1')
+        make_calls('52.0.0.2')._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+
+        self.assertEqual(3, self.create.call_count)
+
+    def test_reconnect_dead_tunnel(self):
+        calls = make_calls()
+
+        port = calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+        self.forwards[0].up = False
+        new_port = calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+
+        self.assertNotEqual(port, new_port)
+        self.assertTrue(self.forwards[0].terminated)
+        self.assertEqual(2, self.create.call_count)
+
+    def test_reconnect_moved_target(self):
+        calls = make_calls()
+
+        calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.1')
+        new_port = calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.2')
+
+        self.assertTrue(self.forwards[0].terminated)
+        self.create.assert_called_with('key.pem', None, '10.0.0.2', 8080, '52.0.0.1')
+        self.assertEqual(new_port, calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.2'))
+
+    def test_rds_lookup_cached(self):
+        aws.lookup_cache.invalidate()
+        self.addCleanup(aws.lookup_cache.invalidate)
+        calls = make_calls()
+        calls.domain = 'test.boss'
+        calls.session = mock.MagicMock()
+        calls.session.get_credentials.return_value.access_key = 'AKIA1'
+        calls.session.region_name = 'us-east-1'
+        client = calls.session.client.return_value
+        client.describe_db_instances.return_value = {
+            'DBInstances': [{'Endpoint': {'Address': 'endpoint.rds.amazonaws.com'}}]
+        }
+
+        for i in range(3):
+            with calls.tunnel('endpoint-db', 3306, 'rds') as port:
+                self.assertEqual(20000, port)
+
+        client.describe_db_instances.assert_called_once_with(DBInstanceIdentifier = 'endpoint-db-test-boss')
+        self.assertEqual(1, self.create.call_count)
+
+    def test_slow_lookup_only_blocks_same_key(self):
+        calls = make_calls()
+        started = threading.Event()
+        release = threading.Event()
+        def slow_lookup():
+            started.set()
+            release.wait(5)
+            return '10.0.0.1'
+
+        thread = threading.Thread(target = calls._tunnel,
+                                  args = ('slow.test.boss', 8080, slow_lookup))
+        thread.start()
+        try:
+            started.wait(5)
+            start = time.time()
+            calls._tunnel('auth.test.boss', 8080, lambda: '10.0.0.2')
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(2, self.create.call_count)
@@ -0,0 +1,350 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import hashlib
+import threading
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the ingest lambda
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+lambda_dir = os.path.normpath(os.path.join(cur_dir, '..', '..', 'cloud_formation', 'lambda', 'ingest_populate'))
+sys.path.append(lambda_dir)
+
+import ingest_queue_upload
+import ingest_queue_plan
+
+
+def make_args(**kwargs):
+    args = {
+        'job_id': 7,
+        'upload_queue': 'https://queue.amazonaws.com/123456789012/upload',
+        'ingest_queue': 'https://queue.amazonaws.com/123456789012/ingest',
+        'resolution': 0,
+        'project_info': ['1', '2', '3'],
+        't_start': 0, 't_stop': 2, 't_tile_size': 1,
+        'x_start': 0, 'x_stop': 2048, 'x_tile_size': 512,
+        'y_start': 0, 'y_stop': 1024, 'y_tile_size': 512,
+        'z_start': 0, 'z_stop': 40, 'z_tile_size': 16,
+        'final_z_stop': 40,
+    }
+    args.update(kwargs)
+    return args
+
+
+def encode_key(*fields):
+    # Same format as BossBackend.encode_chunk_key / encode_tile_key
+    base = '&'.join(map(str, fields))
+    return hashlib.md5(base.encode()).hexdigest() + '&' + base
+
+
+class TestCreateMessages(unittest.TestCase):
+    def test_messages_match_backend_keys(self):
+        args = make_args(z_start=8, z_stop=40)
+        msgs = list(ingest_queue_upload.create_messages(args))
+
+        expected = []
+        for t in range(0, 2):
+            for z in range(8, 40, 16):
+                for y in range(0, 1024, 512):
+                    for x in range(0, 2048, 512):
+                        num_of_tiles = min(16, 40 - z)
+                        chunk_key = encode_key(num_of_tiles, '1', '2', '3', 0,
+                                               x // 512, y // 512, z // 16, t)
+                        for tile in range(z, z + num_of_tiles):
+                            tile_key = encode_key('1', '2', '3', 0,
+                                                  x // 512, y // 512, tile, t)
+                            expected.append(json.dumps({
+                                'job_id': 7,
+                                'upload_queue_arn': args['upload_queue'],
+                                'ingest_queue_arn': args['ingest_queue'],
+                                'chunk_key': chunk_key,
+                                'tile_key': tile_key,
+                            }))
+
+        self.assertEqual(expected, msgs)
+
+    def test_resume_from_cursor(self):
+        args = make_args()
+        msgs = list(ingest_queue_upload.iter_messages(args))
+
+        for i in (0, 1, 17, 300, len(msgs) - 1):
+            cursor = msgs[i][0]
+            resumed = list(ingest_queue_upload.iter_messages(args, list(cursor)))
+            self.assertEqual(msgs[i:], resumed)
+
+    def test_compact_messages_contain_all_keys(self):
+        args = make_args()
+        expected = []
+        for msg in ingest_queue_upload.create_messages(args):
+            msg = json.loads(msg)
+            expected.append((msg['chunk_key'], msg['tile_key']))
+
+        actual = []
+        msgs = list(ingest_queue_upload.iter_compact_messages(args, max_bytes=2048))
+        for _, msg in msgs:
+            self.assertLessEqual(len(msg), 2048)
+
+            msg = json.loads(msg)
+            self.assertEqual(7, msg['j'])
+            for chunk_key, tile_keys in msg['k']:
+                actual.extend((chunk_key, tile_key) for tile_key in tile_keys)
+
+        self.assertGreater(len(msgs), 1)
+        self.assertEqual(expected, actual)
+
+
+class FakeSQS(object):
+    """Minimal SQS client, failing every message whose body is in fail"""
+    def __init__(self, fail = ()):
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.sent = []
+        self.calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            self.calls.append([e['MessageBody'] for e in Entries])
+            resp = {'Successful': [], 'Failed': []}
+            for entry in Entries:
+                if entry['MessageBody'] in self.fail:
+                    resp['Failed'].append({'Id': entry['Id']})
+                else:
+                    self.sent.append(entry['MessageBody'])
+                    resp['Successful'].append({'Id': entry['Id']})
+            return resp
+
+
+def make_msgs(count):
+    return [(i, 'msg{}'.format(i)) for i in range(count)]
+
+
+class TestSendBatch(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(ingest_queue_upload.time, 'sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def batch(self, count):
+        return next(ingest_queue_upload.create_batches(make_msgs(count)))[1]
+
+    def test_retry_failed_messages(self):
+        client = FakeSQS(fail = ['msg1'])
+        def send_message_batch(QueueUrl, Entries):
+            resp = FakeSQS.send_message_batch(client, QueueUrl, Entries)
+            client.fail.clear() # Succeed when retried
+            return resp
+        client.send_message_batch = send_message_batch
+        progress = ingest_queue_upload.Progress()
+
+        ingest_queue_upload.send_batch(client, 'url', self.batch(3), progress)
+
+        self.assertEqual([['msg0', 'msg1', 'msg2'], ['msg1']], client.calls)
+        self.assertEqual((3, 1, 1), (progress.sent, progress.failed, progress.retried))
+        self.assertEqual(1, self.sleep.call_count)
+
+    def test_backoff_exhausted(self):
+        client = FakeSQS(fail = ['msg0'])
+        progress = ingest_queue_upload.Progress()
+
+        with mock.patch.object(ingest_queue_upload.random, 'uniform', side_effect = lambda a, b: b), \
+             mock.patch.object(ingest_queue_upload, 'SQS_RETRY_BACKOFF_MAX', 0.75):
+            with self.assertRaises(ingest_queue_upload.FailedToSendMessages):
+                ingest_queue_upload.send_batch(client, 'url', self.batch(2), progress)
+
+        self.assertEqual(ingest_queue_upload.SQS_RETRY_COUNT, len(client.calls))
+        self.assertEqual([['msg0']] * (ingest_queue_upload.SQS_RETRY_COUNT - 1), client.calls[1:])
+        self.assertEqual([mock.call(0.5), mock.call(0.75)], self.sleep.call_args_list)
+
+
+class TestEnqueue(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(ingest_queue_upload.time, 'sleep')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_all_messages_sent(self):
+        client = FakeSQS()
+        checkpoint = mock.Mock()
+
+        progress = ingest_queue_upload.enqueue(client, 'url', iter(make_msgs(95)), 4, checkpoint)
+
+        self.assertEqual(95, progress.sent)
+        self.assertEqual(sorted(m for _, m in make_msgs(95)), sorted(client.sent))
+        self.assertEqual(10, len(client.calls))
+
+    def test_failure_commits_sent_batches(self):
+        client = FakeSQS(fail = ['msg25'])
+        checkpoint = mock.Mock()
+
+        with self.assertRaises(ingest_queue_upload.FailedToSendMessages):
+            ingest_queue_upload.enqueue(client, 'url', iter(make_msgs(50)), 4, checkpoint)
+
+        # The batch starting at msg20 failed, so only the batches before it are
+        # committed, but every message that was sent is counted
+        checkpoint.save.assert_called_with(20, len(client.sent))
+
+    def test_interrupt_not_committed(self):
+        def msgs():
+            yield from make_msgs(15)
+            raise KeyboardInterrupt()
+        checkpoint = mock.Mock()
+
+        with self.assertRaises(KeyboardInterrupt):
+            ingest_queue_upload.enqueue(FakeSQS(), 'url', msgs(), 4, checkpoint)
+
+        checkpoint.save.assert_not_called()
+
+    def test_saved_after_each_batch(self):
+        checkpoint = mock.Mock()
+
+        ingest_queue_upload.enqueue(FakeSQS(), 'url', iter(make_msgs(50)), 1, checkpoint)
+
+        # The last batch is committed by the handler clearing the checkpoint
+        self.assertEqual([mock.call(i, i) for i in range(10, 50, 10)], checkpoint.save.call_args_list)
+
+
+class FakeTable(object):
+    """Minimal DynamoDB table holding one checkpoint"""
+    def __init__(self):
+        self.item = None
+
+    def get_item(self, Key, ConsistentRead):
+        return {} if self.item is None else {'Item': self.item}
+
+    def put_item(self, Item):
+        self.item = Item
+
+    def delete_item(self, Key):
+        self.item = None
+
+
+class FakeContext(object):
+    """Lambda context that runs out of time after the given number of checks"""
+    def __init__(self, checks = None):
+        self.checks = checks
+
+    def get_remaining_time_in_millis(self):
+        if self.checks is None:
+            return 300000
+        self.checks -= 1
+        return 300000 if self.checks >= 0 else 0
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.sqs = FakeSQS()
+        self.table = FakeTable()
+        boto3 = mock.MagicMock()
+        boto3.client.return_value = self.sqs
+        boto3.resource.return_value.Table.return_value = self.table
+
+        patches = [
+            mock.patch.object(ingest_queue_upload, 'boto3', boto3),
+            mock.patch.object(ingest_queue_upload.time, 'sleep'),
+            mock.patch.dict(os.environ, {'CHECKPOINT_TABLE': 'checkpoint'}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.args = make_args(max_workers = 4)
+        self.expected = set(ingest_queue_upload.create_messages(self.args))
+
+    def test_timeout_then_resume(self):
+        with self.assertRaises(ingest_queue_upload.OutOfTime):
+            ingest_queue_upload.handler(self.args, FakeContext(checks = 20))
+        self.assertIsNotNone(self.table.item)
+        self.assertLess(len(self.sqs.sent), len(self.expected))
+
+        count = ingest_queue_upload.handler(self.args, FakeContext())
+
+        self.assertEqual(len(self.sqs.sent), count)
+        self.assertEqual(self.expected, set(self.sqs.sent))
+        self.assertIsNone(self.table.item)
+
+    def test_failure_then_resume(self):
+        failed = sorted(self.expected)[300]
+        self.sqs.fail.add(failed)
+        with self.assertRaises(ingest_queue_upload.FailedToSendMessages):
+            ingest_queue_upload.handler(self.args, FakeContext())
+
+        self.sqs.fail.clear()
+        count = ingest_queue_upload.handler(self.args, FakeContext())
+
+        # Messages sent after the failed batch are sent again and counted twice
+        self.assertEqual(len(self.sqs.sent), count)
+        self.assertEqual(self.expected, set(self.sqs.sent))
+
+
+class TestPartition(unittest.TestCase):
+    def assertShardsMatch(self, args, count):
+        expected = list(ingest_queue_upload.create_messages(args))
+
+        actual = []
+        for shard in ingest_queue_upload.partition(args, count):
+            actual.extend(ingest_queue_upload.create_messages(shard))
+
+        self.assertEqual(sorted(expected), sorted(actual))
+
+    def test_shards_cover_tile_space(self):
+        self.assertShardsMatch(make_args(), 3)
+
+    def test_more_shards_than_tiles(self):
+        args = make_args(x_stop=512, y_stop=512, t_stop=1, z_stop=16)
+        shards = ingest_queue_upload.partition(args, 4)
+
+        self.assertEqual(4, len(shards))
+        self.assertShardsMatch(args, 4)
+
+    def test_unaligned_start(self):
+        self.assertShardsMatch(make_args(z_start=8, z_stop=72, final_z_stop=72), 2)
+
+    def test_shard_count_from_environment(self):
+        with mock.patch.dict(os.environ, {'SHARD_COUNT': '3'}):
+            self.assertEqual(3, len(ingest_queue_upload.split_handler(make_args(), None)))
+
+    def test_counts_totaled(self):
+        args = dict(make_args(), counts=[10, 0, 5])
+        self.assertEqual({'arn': args['upload_queue'], 'count': 15},
+                         ingest_queue_upload.count_handler(args, None))
+
+
+class TestPlan(unittest.TestCase):
+    def assertPlanMatches(self, args):
+        keys = list(ingest_queue_upload.iter_keys(args))
+        plan = ingest_queue_plan.plan(args)
+
+        self.assertEqual(len(keys), plan['tiles'])
+        self.assertEqual(len(keys), plan['messages'])
+        self.assertEqual(len(set(k[1] for k in keys)), plan['chunks'])
+
+    def test_full_chunks(self):
+        self.assertPlanMatches(make_args(z_stop=48, final_z_stop=48))
+
+    def test_partial_chunk(self):
+        self.assertPlanMatches(make_args(z_start=8, z_stop=40, final_z_stop=37))
+
+    def test_past_final_z_stop(self):
+        self.assertPlanMatches(make_args(z_stop=80, final_z_stop=20))
+
+    def test_compact_upper_bound(self):
+        args = make_args(compact=True)
+        msgs = list(ingest_queue_upload.iter_compact_messages(args))
+        plan = ingest_queue_plan.plan(args)
+
+        self.assertGreaterEqual(plan['messages'], len(msgs))
@@ -0,0 +1,168 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import keycloak
+from lib import exceptions
+
+
+class FakeKeycloak(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        self.server.grants.append(params["grant_type"][0])
+        if params["grant_type"][0] == "refresh_token" and self.server.refresh_fails:
+            self.respond(400, {"error": "invalid_grant"})
+            return
+        n = len(self.server.grants)
+        self.respond(200, {"access_token": "token{}".format(n),
+                           "refresh_token": "refresh",
+                           "expires_in": self.server.expires_in})
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/auth")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.headers.get("Authorization") is None:
+            self.respond(401, {})
+        else:
+            self.server.tokens.append(self.headers["Authorization"])
+            self.respond(200, self.server.clients)
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.server.updates.append(json.loads(self.rfile.read(length).decode()))
+        self.send_response(204)
+        self.end_headers()
+
+
+class TestKeyCloakClient(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("localhost", 0), FakeKeycloak)
+        self.server.connections = 0
+        self.server.grants = []
+        self.server.tokens = []
+        self.server.expires_in = 300
+        self.server.refresh_fails = False
+        self.server.paths = []
+        self.server.clients = [{"clientId": "endpoint", "id": "1", "redirectUris": ["http://a/*"]},
+                               {"clientId": "other", "id": "2", "publicClient": True}]
+        self.server.updates = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://localhost:{}".format(self.server.server_address[1])
+
+        proxies = {k: "" for k in ("http_proxy", "https_proxy", "no_proxy",
+                                   "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY")}
+        patch = mock.patch.dict(os.environ, proxies)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        kc = keycloak.KeyCloakClient(self.url, "admin", "password").login()
+        for i in range(5):
+            self.assertEqual("1", kc.get_client("BOSS", "endpoint")["id"])
+        kc.pool.close()
+
+        self.assertEqual(1, self.server.connections)
+
+    def test_token_refreshed_near_expiry(self):
+        self.server.expires_in = keycloak.TOKEN_REFRESH_MARGIN - 1
+        kc = keycloak.KeyCloakClient(self.url, "admin", "password").login()
+        kc.get_client("BOSS", "endpoint")
+        kc.pool.close()
+
+        self.assertEqual(["password", "refresh_token"], self.server.grants)
+        self.assertEqual(["Bearer token2"], self.server.tokens)
+
+    def test_error_status(self):
+        kc = keycloak.KeyCloakClient(self.url)
+        with self.assertRaises(exceptions.KeyCloakError):
+            kc.request("/auth/admin/realms/BOSS/clients")
+        kc.pool.close()
+
+    def test_reconcile_updates_changed_clients_once(self):
+        kc = keycloak.KeyCloakClient(self.url, "admin", "password").login()
+        updated = kc.reconcile_clients("BOSS", {
+            "endpoint": {"redirectUris": ["http://a/*", "http://b/*"], "webOrigins": ["http://b"]},
+            "other": {"publicClient": True},
+        })
+        kc.pool.close()
+
+        self.assertEqual(["endpoint"], updated)
+        self.assertEqual(1, len(self.server.tokens)) # Clients retrieved once
+        self.assertEqual([{"clientId": "endpoint", "id": "1",
+                           "redirectUris": ["http://a/*", "http://b/*"],
+                           "webOrigins": ["http://b"]}], self.server.updates)
+
+    def test_login_again_when_refresh_fails(self):
+        self.server.expires_in = keycloak.TOKEN_REFRESH_MARGIN - 1
+        self.server.refresh_fails = True
+        kc = keycloak.KeyCloakClient(self.url).login("admin", "password")
+        kc.get_client("BOSS", "endpoint")
+        kc.pool.close()
+
+        self.assertEqual(["password", "refresh_token", "password"], self.server.grants)
+        self.assertEqual(["Bearer token3"], self.server.tokens)
+
+    def test_proxy_from_environment(self):
+        with mock.patch.dict(os.environ, {"http_proxy": self.url}):
+            kc = keycloak.KeyCloakClient("http://keycloak.invalid:8080").login("admin", "password")
+            kc.get_clients("BOSS")
+            kc.pool.close()
+
+        self.assertEqual(["http://keycloak.invalid:8080/auth/admin/realms/BOSS/clients"], self.server.paths)
+
+    def test_redirect_not_followed(self):
+        kc = keycloak.KeyCloakClient(self.url)
+        with self.assertRaises(exceptions.KeyCloakError) as cm:
+            kc.request("/redirect")
+        kc.pool.close()
+
+        self.assertEqual(302, cm.exception.status)
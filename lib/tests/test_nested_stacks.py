@@ -0,0 +1,221 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import hashlib
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import nested_stacks
+
+
+def make_template():
+    resources = {
+        "VPC": {"Type": "AWS::EC2::VPC",
+                "Properties": {"CidrBlock": {"Ref": "VPCSubnet"}}},
+        "Topic": {"Type": "AWS::SNS::Topic",
+                  "Properties": {"TopicName": "topic"}},
+    }
+    for i in range(5):
+        resources["Subnet{}".format(i)] = {
+            "Type": "AWS::EC2::Subnet",
+            "Properties": {"VpcId": {"Ref": "VPC"}},
+        }
+    resources["Instance"] = {
+        "Type": "AWS::EC2::Instance",
+        "DependsOn": "Subnet0",
+        "Properties": {"SubnetId": {"Ref": "Subnet4"},
+                       "Ip": {"Fn::GetAtt": ["VPC", "CidrBlock"]}},
+    }
+    return {
+        "AWSTemplateFormatVersion": "2010-09-09",
+        "Parameters": {"VPCSubnet": {"Type": "String"}},
+        "Resources": resources,
+    }
+
+def template_url(child):
+    data = json.dumps(child, sort_keys=True).encode()
+    return "https://s3.amazonaws.com/bucket/" + hashlib.sha256(data).hexdigest()
+
+
+class TestPartition(unittest.TestCase):
+    def test_connected_resources_grouped(self):
+        groups = nested_stacks.partition(make_template()["Resources"], 7)
+
+        self.assertEqual(2, len(groups))
+        self.assertEqual(7, len(groups[0]))
+        self.assertIn("Topic", groups[1])
+
+    def test_large_component_split_in_dependency_order(self):
+        resources = make_template()["Resources"]
+        groups = nested_stacks.partition(resources, 3)
+
+        self.assertEqual(sorted(resources), sorted(k for g in groups for k in g))
+        self.assertTrue(all(len(g) <= 3 for g in groups))
+
+        # Resources only depend on resources in the same or earlier groups
+        index = {k: i for i, g in enumerate(groups) for k in g}
+        for key, resource in resources.items():
+            for dep in nested_stacks.dependencies(resource):
+                if dep in resources:
+                    self.assertLessEqual(index[dep], index[key])
+
+    def test_previous_layout_kept(self):
+        resources = make_template()["Resources"]
+        previous = nested_stacks.partition(resources, 3)
+
+        resources["Subnet5"] = {"Type": "AWS::EC2::Subnet",
+                                "Properties": {"VpcId": {"Ref": "VPC"}}}
+        resources["Queue"] = {"Type": "AWS::SQS::Queue"}
+        del resources["Topic"]
+        groups = nested_stacks.partition(resources, 3, previous)
+
+        # Existing resources don't move and new ones are added after them
+        for before, after in zip(previous, groups):
+            self.assertEqual([k for k in before if k != "Topic"], after[:len(before) - ("Topic" in before)])
+        index = {k: i for i, g in enumerate(groups) for k in g}
+        self.assertEqual(sorted(resources), sorted(index))
+        self.assertTrue(all(len(g) <= 3 for g in groups))
+        self.assertLessEqual(index["VPC"], index["Subnet5"])
+
+    def test_previous_layout_cycle(self):
+        resources = {
+            "A": {"Type": "AWS::SNS::Topic", "DependsOn": "C"},
+            "B": {"Type": "AWS::SNS::Topic", "DependsOn": "A"},
+            "C": {"Type": "AWS::SNS::Topic", "DependsOn": "D"},
+            "D": {"Type": "AWS::SNS::Topic"},
+        }
+        previous = [["B", "D"], ["A"]]
+
+        # C is placed with A, so Nested0 -> Nested1 (B -> A) -> Nested0 (C -> D)
+        with self.assertRaisesRegex(Exception, "Nested0, Nested1"):
+            nested_stacks.partition(resources, 2, previous)
+
+
+class TestSplitTemplate(unittest.TestCase):
+    def split(self, template, size, previous = None):
+        children = {}
+        def url(child):
+            u = template_url(child)
+            children[u] = child
+            return u
+
+        parent = nested_stacks.split_template(template, url, size, previous)
+        return parent, {k: children[v["Properties"]["TemplateURL"]]
+                        for k, v in parent["Resources"].items()}
+
+    def test_references_wired(self):
+        parent, children = self.split(make_template(), 3)
+
+        self.assertEqual({"VPCSubnet": {"Type": "String"}}, parent["Parameters"])
+        for name, stack in parent["Resources"].items():
+            self.assertEqual("AWS::CloudFormation::Stack", stack["Type"])
+            child = children[name]
+
+            for key, value in stack["Properties"]["Parameters"].items():
+                self.assertIn(key, child["Parameters"])
+                if "Fn::GetAtt" in value:
+                    source, output = value["Fn::GetAtt"]
+                    self.assertIn(output[len("Outputs."):], children[source]["Outputs"])
+                    self.assertIn(source, stack["DependsOn"])
+
+        # The instance's references to other child stacks are replaced with parameters
+        instance = [c for c in children.values() if "Instance" in c["Resources"]][0]
+        properties = instance["Resources"]["Instance"]["Properties"]
+        self.assertEqual({"Ref": "VPCCidrBlock"}, properties["Ip"])
+        self.assertNotIn("DependsOn", instance["Resources"]["Instance"])
+
+    def test_list_attributes_passed_as_lists(self):
+        template = make_template()
+        template["Resources"]["Instance"]["Properties"]["Ipv6"] = {"Fn::GetAtt": ["VPC", "Ipv6CidrBlocks"]}
+        parent, children = self.split(template, 3)
+
+        instance = [n for n, c in children.items() if "Instance" in c["Resources"]][0]
+        vpc = [n for n, c in children.items() if "VPC" in c["Resources"]][0]
+        self.assertNotEqual(instance, vpc)
+
+        self.assertEqual({"Ref": "VPCIpv6CidrBlocks"},
+                         children[instance]["Resources"]["Instance"]["Properties"]["Ipv6"])
+        self.assertEqual({"Type": "CommaDelimitedList"}, children[instance]["Parameters"]["VPCIpv6CidrBlocks"])
+        self.assertEqual({"Type": "String"}, children[instance]["Parameters"]["VPCCidrBlock"])
+        self.assertEqual({"Value": {"Fn::Join": [",", {"Fn::GetAtt": ["VPC", "Ipv6CidrBlocks"]}]}},
+                         children[vpc]["Outputs"]["VPCIpv6CidrBlocks"])
+
+    def test_sub_and_depends_on_wired(self):
+        template = make_template()
+        template["Resources"]["Instance"]["Properties"]["UserData"] = {
+            "Fn::Sub": "${VPC.CidrBlock} ${VPCSubnet} ${AWS::Region} ${!Literal}"}
+        template["Resources"]["Record"] = {
+            "Type": "AWS::Route53::RecordSet",
+            "Properties": {"Name": {"Fn::Sub": ["${Local}.${Subnet4}", {"Local": "name"}]}}}
+        template["Resources"]["Waiter"] = {"Type": "AWS::CloudFormation::WaitCondition",
+                                           "DependsOn": "Topic"}
+
+        groups = nested_stacks.partition(template["Resources"], 100)
+        self.assertEqual(1, len(groups)) # Everything is connected
+
+        parent, children = self.split(template, 3)
+        instance = [c for c in children.values() if "Instance" in c["Resources"]][0]
+        self.assertNotIn("VPC", instance["Resources"])
+        self.assertEqual({"Fn::Sub": "${VPCCidrBlock} ${VPCSubnet} ${AWS::Region} ${!Literal}"},
+                         instance["Resources"]["Instance"]["Properties"]["UserData"])
+        self.assertIn("VPCCidrBlock", instance["Parameters"])
+        self.assertIn("VPCSubnet", instance["Parameters"])
+
+        for name, child in children.items():
+            if "Record" in child["Resources"] and "Subnet4" not in child["Resources"]:
+                self.assertIn("Subnet4", child["Parameters"])
+
+    def test_unchanged_children_keep_url(self):
+        template = make_template()
+        before, _ = self.split(template, 7)
+
+        template["Resources"]["Topic"]["Properties"]["TopicName"] = "other"
+        after, _ = self.split(template, 7)
+
+        self.assertEqual(before["Resources"]["Nested0"], after["Resources"]["Nested0"])
+        self.assertNotEqual(before["Resources"]["Nested1"], after["Resources"]["Nested1"])
+
+    def test_layout_saved_in_metadata(self):
+        template = make_template()
+        parent, children = self.split(template, 3)
+
+        groups = nested_stacks.layout(parent)
+        self.assertEqual(sorted(template["Resources"]), sorted(k for g in groups for k in g))
+        for i, group in enumerate(groups):
+            self.assertEqual(sorted(group), sorted(children["Nested{}".format(i)]["Resources"]))
+
+        self.assertIsNone(nested_stacks.layout(template))
+
+    def test_emptied_child_removed(self):
+        template = make_template()
+        before, _ = self.split(template, 7)
+        previous = nested_stacks.layout(before)
+
+        del template["Resources"]["Topic"]
+        after, _ = self.split(template, 7, previous)
+        self.assertEqual(["Nested0"], list(after["Resources"]))
+        self.assertEqual(before["Resources"]["Nested0"], after["Resources"]["Nested0"])
+
+        # Nested0 is full, so an unconnected resource is placed in Nested1
+        template["Resources"]["Queue"] = {"Type": "AWS::SQS::Queue"}
+        after, children = self.split(template, 7, previous)
+        self.assertEqual(["Nested0", "Nested1"], sorted(after["Resources"]))
+        self.assertEqual(["Queue"], list(children["Nested1"]["Resources"]))
@@ -0,0 +1,136 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import socket
+import unittest
+from unittest import mock
+from contextlib import contextmanager
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import ssh
+from lib.exceptions import SSHError, SSHTunnelError
+
+
+class TestReadiness(unittest.TestCase):
+    def test_locate_port_is_free(self):
+        port = ssh.locate_port()
+        with socket.socket() as sock:
+            sock.bind(("localhost", port))
+
+    def test_wait_for_listening_port(self):
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            sock.listen(1)
+            ssh.wait_for_port(sock.getsockname()[1], timeout = 1)
+
+    def test_wait_for_port_errors(self):
+        port = ssh.locate_port()
+        with self.assertRaises(SSHTunnelError):
+            ssh.wait_for_port(port, timeout = 0.2)
+
+        proc = mock.MagicMock()
+        proc.poll.return_value = 255
+        with self.assertRaises(SSHError):
+            ssh.wait_for_port(port, proc)
+
+
+class TestForward(unittest.TestCase):
+    def make_master(self, *codes):
+        master = ssh.ControlMaster.__new__(ssh.ControlMaster)
+        master.proc = mock.MagicMock()
+        master._control = mock.MagicMock(side_effect = codes)
+        return master
+
+    @mock.patch.object(ssh, 'wait_for_port')
+    @mock.patch.object(ssh, 'locate_port', side_effect = [20001, 20002])
+    def test_retry_taken_port(self, locate_port, wait_for_port):
+        master = self.make_master(255, 0)
+
+        forward = master.forward(None, '10.0.0.1', 22)
+
+        self.assertEqual(20002, forward.local_port)
+        master._control.assert_called_with("-O", "forward", "-L", "20002:10.0.0.1:22")
+        wait_for_port.assert_called_once_with(20002, master.proc)
+
+    @mock.patch.object(ssh, 'wait_for_port')
+    def test_given_port_not_retried(self, wait_for_port):
+        master = self.make_master(255, 0)
+
+        with self.assertRaises(SSHTunnelError):
+            master.forward(20001, '10.0.0.1', 22)
+        self.assertEqual(1, master._control.call_count)
+
+
+class TestTunnelManager(unittest.TestCase):
+    @mock.patch.object(ssh, 'ControlMaster')
+    def test_master_reused_until_dead(self, ControlMaster):
+        ControlMaster.side_effect = lambda *args: mock.MagicMock()
+        manager = ssh.TunnelManager()
+        try:
+            first = manager.master('key', '1.2.3.4')
+            self.assertIs(first, manager.master('key', '1.2.3.4'))
+            self.assertEqual(1, ControlMaster.call_count)
+
+            first.alive.return_value = False
+            self.assertIsNot(first, manager.master('key', '1.2.3.4'))
+            self.assertEqual(2, ControlMaster.call_count)
+            first.close.assert_called_once_with()
+        finally:
+            manager.close()
+
+
+class TestRunAll(unittest.TestCase):
+    def test_results_and_summary(self):
+        def stream(self, command, timeout, prefix, lock):
+            if self.remote_ip == '10.0.0.2':
+                return None
+            if self.remote_ip == '10.0.0.3':
+                raise SSHError("Error establishing a SSH connection")
+            if self.remote_ip == '10.0.0.4':
+                raise OSError("No such file or directory: 'ssh'")
+            return 0
+
+        with mock.patch.object(ssh.SSHConnection, 'stream', stream):
+            results = ssh.run_all('key', ['10.0.0.1', ('10.0.0.2', 22, 'ubuntu'), '10.0.0.3', '10.0.0.4'],
+                                  '1.2.3.4', 'uptime', workers = 2)
+
+        self.assertEqual(0, results['10.0.0.1'])
+        self.assertIsNone(results['10.0.0.2'])
+        self.assertIsInstance(results['10.0.0.3'], SSHError)
+        self.assertIsInstance(results['10.0.0.4'], OSError)
+
+        summary = ssh.format_results(results)
+        self.assertIn("timed out", summary)
+        self.assertIn("error: No such file", summary)
+        self.assertIn("1 of 4 succeeded", summary)
+
+    @mock.patch.object(ssh.subprocess, 'Popen')
+    def test_timeout_includes_connecting(self, Popen):
+        @contextmanager
+        def connect(self):
+            time.sleep(0.3) # Slow tunnel setup
+            yield ("localhost", 2222)
+
+        with mock.patch.object(ssh.SSHConnection, '_connect', connect):
+            conn = ssh.SSHConnection('key', '10.0.0.1', '1.2.3.4', local_port = 2222)
+            self.assertIsNone(conn.stream('uptime', timeout = 0.1))
+
+        Popen.assert_not_called()
@@ -0,0 +1,43 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import stepfunctions
+
+
+class TestExpandBranches(unittest.TestCase):
+    def test_branches_repeated(self):
+        path = os.path.join(parent_dir, 'cloud_formation', 'stepfunctions', 'populate_upload_queue.hsd')
+        with open(path, 'r') as fh:
+            source = stepfunctions.expand_branches(fh.read(), {'shard': 3})
+
+        self.assertEqual(3, source.count("parallel:"))
+        for i in range(3):
+            self.assertIn("input: '$.shards[{}]'".format(i), source)
+        self.assertNotIn("'$.shards[{shard}]'", source)
+        self.assertEqual(3, source.count("retry ['OutOfTime']"))
+        self.assertIn("transform:\n    result: '$.counts'", source)
+
+    def test_other_branches_unchanged(self):
+        source = "parallel:\n    Lambda('A')\nparallel:\n    Lambda('B{n}')\nPass()\n"
+        expected = "parallel:\n    Lambda('A')\nparallel:\n    Lambda('B0')\nparallel:\n    Lambda('B1')\nPass()\n"
+        self.assertEqual(expected, stepfunctions.expand_branches(source, {'n': 2}))
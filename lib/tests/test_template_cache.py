@@ -0,0 +1,135 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import template_cache
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(template_cache, 'CACHE_DIR', self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+        self.output = os.path.join(self.tmp.name, 'Stack.template')
+        open(self.output, 'w').close()
+
+        self.key = {'config': 'core', 'domain': 'test.boss', 'source': 'abc',
+                    'scenario': 'development', 'ami_version': 'latest'}
+        lookups = [('ami_lookup', ['vault.boss'], {}, ('ami-1', 'hash')),
+                   ('ami_lookup', ['vault.boss'], {}, ('ami-1', 'hash'))]
+        template_cache.save('core', 'test.boss', self.key, lookups)
+
+    def is_fresh(self, key=None, ami=('ami-1', 'hash'), age=86400):
+        now = template_cache.time.time() + age
+        with mock.patch.object(template_cache.aws, 'ami_lookup', return_value=ami) as lookup, \
+             mock.patch.object(template_cache.time, 'time', return_value=now):
+            fresh = template_cache.is_fresh(None, 'core', 'test.boss', key or self.key, [self.output])
+            self.calls = lookup.call_count
+        return fresh
+
+    def test_fresh(self):
+        self.assertTrue(self.is_fresh())
+        self.assertEqual(1, self.calls)
+
+    def test_unexpired_lookups_not_repeated(self):
+        self.assertTrue(self.is_fresh(ami=('ami-2', 'hash'), age=60))
+        self.assertEqual(0, self.calls)
+
+    def test_changed_key(self):
+        self.assertFalse(self.is_fresh(key=dict(self.key, source='def')))
+
+    def test_changed_lookup(self):
+        self.assertFalse(self.is_fresh(ami=('ami-2', 'hash')))
+
+    def test_missing_output(self):
+        os.remove(self.output)
+        self.assertFalse(self.is_fresh())
+
+
+class TestLookups(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(template_cache, 'CACHE_DIR', self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+        self.module = mock.Mock(spec=['__file__'])
+        self.module.__file__ = template_cache.__file__
+
+    def key(self, ssh_key):
+        with mock.patch.dict(os.environ, {'SSH_KEY': ssh_key}):
+            return template_cache.cache_key('core', 'test.boss', self.module)
+
+    def test_changed_ssh_key(self):
+        template_cache.save('core', 'test.boss', self.key('/keys/a.pem'), [])
+
+        self.assertTrue(template_cache.is_fresh(None, 'core', 'test.boss', self.key('/keys/a.pem'), []))
+        self.assertFalse(template_cache.is_fresh(None, 'core', 'test.boss', self.key('/keys/b.pem'), []))
+
+    def test_recorded_lookups_always_repeated(self):
+        key = self.key('/keys/a.pem')
+        template_cache.save('core', 'test.boss', key, [('sqs_lookup_url', ['queue'], {}, 'url1')])
+
+        lookup = mock.Mock(spec=[], return_value='url1')
+        with mock.patch.object(template_cache.aws, 'sqs_lookup_url', lookup):
+            self.assertTrue(template_cache.is_fresh(None, 'core', 'test.boss', key, []))
+            lookup.return_value = 'url2'
+            self.assertFalse(template_cache.is_fresh(None, 'core', 'test.boss', key, []))
+
+        lookup.side_effect = Exception("Queue does not exist")
+        with mock.patch.object(template_cache.aws, 'sqs_lookup_url', lookup):
+            self.assertFalse(template_cache.is_fresh(None, 'core', 'test.boss', key, []))
+
+    def test_keypair_prompt_not_repeated(self):
+        template_cache.save('core', 'test.boss', self.key('/keys/a.pem'), [('keypair_lookup', [], {}, 'a')])
+
+        with mock.patch.dict(os.environ), \
+             mock.patch.object(template_cache.aws, 'keypair_lookup') as lookup:
+            os.environ.pop('SSH_KEY', None)
+            key = template_cache.cache_key('core', 'test.boss', self.module)
+            key['ssh_key'] = '/keys/a.pem'
+            self.assertFalse(template_cache.is_fresh(None, 'core', 'test.boss', key, []))
+        lookup.assert_not_called()
+
+
+class TestSourceHash(unittest.TestCase):
+    def test_input_files_hashed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lambda_file = os.path.join(tmp, 'index.py')
+            with open(lambda_file, 'w') as fh:
+                fh.write('def handler(event, context): pass')
+
+            module = mock.Mock(spec=['__file__'])
+            module.__file__ = template_cache.__file__
+            with mock.patch.object(template_cache.const, 'TEST_LAMBDA', lambda_file, create=True):
+                self.assertIn(os.path.realpath(lambda_file), template_cache.input_files(module))
+                before = template_cache.source_hash(module)
+
+                with open(lambda_file, 'w') as fh:
+                    fh.write('def handler(event, context): return 1')
+                self.assertNotEqual(before, template_cache.source_hash(module))
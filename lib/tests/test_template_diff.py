@@ -0,0 +1,124 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import sys
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import template_diff
+
+
+TEMPLATE = {
+    "Resources": {
+        "VPC": {"Type": "AWS::EC2::VPC",
+                "Properties": {"CidrBlock": "10.0.0.0/16"}},
+        "Subnet": {"Type": "AWS::EC2::Subnet",
+                   "Properties": {"CidrBlock": "10.0.0.0/24", "VpcId": {"Ref": "VPC"}}},
+        "Instance": {"Type": "AWS::EC2::Instance",
+                     "Properties": {"ImageId": {"Ref": "AMI"},
+                                    "InstanceType": "t2.micro",
+                                    "SubnetId": {"Ref": "Subnet"}}},
+        "Queue": {"Type": "AWS::SQS::Queue",
+                  "Properties": {"VisibilityTimeout": 30}},
+    }
+}
+
+
+def by_id(changes):
+    return {c['LogicalResourceId']: c for c in changes}
+
+
+class TestReferences(unittest.TestCase):
+    def test_sub(self):
+        value = {"Fn::Sub": "arn:${AWS::Partition}:${Queue.Arn}/${Name}/${!Literal}"}
+        self.assertEqual({"AWS::Partition", "Queue", "Name"}, template_diff.references(value))
+
+    def test_sub_variable_map(self):
+        value = {"Fn::Sub": ["${Local}-${Other}", {"Local": {"Ref": "Queue"}}]}
+        self.assertEqual({"Other", "Queue"}, template_diff.references(value))
+        self.assertEqual([("Other", None)], template_diff.sub_variables(value["Fn::Sub"]))
+
+    def test_depends_on(self):
+        self.assertEqual({"VPC"}, template_diff.references({"DependsOn": "VPC", "Properties": {}}))
+        self.assertEqual({"VPC", "Subnet"}, template_diff.references({"DependsOn": ["VPC", "Subnet"]}))
+
+
+class TestDiffTemplates(unittest.TestCase):
+    def test_no_changes(self):
+        self.assertEqual([], template_diff.diff_templates(TEMPLATE, copy.deepcopy(TEMPLATE)))
+
+    def test_add_remove(self):
+        local = copy.deepcopy(TEMPLATE)
+        local['Resources']['Topic'] = {"Type": "AWS::SNS::Topic", "Properties": {}}
+        del local['Resources']['Queue']
+
+        changes = by_id(template_diff.diff_templates(TEMPLATE, local))
+        self.assertEqual('Add', changes['Topic']['Action'])
+        self.assertEqual('Remove', changes['Queue']['Action'])
+
+    def test_in_place_update(self):
+        local = copy.deepcopy(TEMPLATE)
+        local['Resources']['Instance']['Properties']['InstanceType'] = 't2.large'
+
+        changes = template_diff.diff_templates(TEMPLATE, local)
+        self.assertEqual(1, len(changes))
+        self.assertEqual('False', changes[0]['Replacement'])
+        self.assertEqual(['InstanceType'], changes[0]['Details'])
+
+    def test_replacement_propagates(self):
+        local = copy.deepcopy(TEMPLATE)
+        local['Resources']['VPC']['Properties']['CidrBlock'] = '10.1.0.0/16'
+
+        changes = by_id(template_diff.diff_templates(TEMPLATE, local))
+        self.assertEqual('True', changes['VPC']['Replacement'])
+        self.assertEqual('True', changes['Subnet']['Replacement'])
+        self.assertEqual('True', changes['Instance']['Replacement'])
+        self.assertNotIn('Queue', changes)
+
+    def test_replacement_propagates_through_sub(self):
+        deployed = copy.deepcopy(TEMPLATE)
+        deployed['Resources']['Alarm'] = {"Type": "AWS::CloudWatch::Alarm",
+                                          "Properties": {"AlarmName": {"Fn::Sub": "${Queue.QueueName}-alarm"}}}
+        local = copy.deepcopy(deployed)
+        local['Resources']['Queue']['Properties']['QueueName'] = 'queue'
+
+        changes = by_id(template_diff.diff_templates(deployed, local))
+        self.assertEqual('True', changes['Queue']['Replacement'])
+        self.assertEqual('True', changes['Alarm']['Replacement'])
+        self.assertEqual(['AlarmName'], changes['Alarm']['Details'])
+
+    def test_changed_parameter(self):
+        parameters = template_diff.changed_parameters(
+            [{'ParameterKey': 'AMI', 'ParameterValue': 'ami-1'},
+             {'ParameterKey': 'Password', 'ParameterValue': '****'}],
+            [{'ParameterKey': 'AMI', 'ParameterValue': 'ami-2', 'UsePreviousValue': False},
+             {'ParameterKey': 'Password', 'ParameterValue': 'secret', 'UsePreviousValue': False}])
+        self.assertEqual({'AMI'}, parameters)
+
+        changes = template_diff.diff_templates(TEMPLATE, TEMPLATE, parameters)
+        self.assertEqual(['Instance'], [c['LogicalResourceId'] for c in changes])
+        self.assertEqual('True', changes[0]['Replacement'])
+
+    def test_unknown_type_is_conditional(self):
+        deployed = {"Resources": {"Fn": {"Type": "Custom::Thing", "Properties": {"A": 1}}}}
+        local = {"Resources": {"Fn": {"Type": "Custom::Thing", "Properties": {"A": 2}}}}
+
+        changes = template_diff.diff_templates(deployed, local)
+        self.assertEqual('Conditional', changes[0]['Replacement'])
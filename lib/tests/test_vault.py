@@ -0,0 +1,140 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import glob
+import tempfile
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import vault as vault_lib
+from lib.vault import Vault, VaultCluster
+
+
+class FakeClient(object):
+    """Minimal hvac.Client for the seal / unseal calls"""
+    def __init__(self, sealed = True, error = None):
+        self.sealed = sealed
+        self.error = error
+
+    def is_sealed(self):
+        if self.error is not None:
+            raise self.error
+        return self.sealed
+
+    def unseal_multi(self, keys):
+        self.sealed = False
+
+    def is_initialized(self):
+        return True
+
+    @property
+    def seal_status(self):
+        return {'sealed': self.sealed, 'progress': 0, 't': 3}
+
+    @property
+    def ha_status(self):
+        return {'is_self': False}
+
+def make_cluster(*clients):
+    vaults = []
+    for i, client in enumerate(clients):
+        vault = Vault('vault.test.boss', '10.0.0.{}'.format(i + 1))
+        vault.clients[None] = client
+        vaults.append(vault)
+    return VaultCluster(vaults)
+
+
+class TestVaultCluster(unittest.TestCase):
+    def test_unseal_shares_keys(self):
+        cluster = make_cluster(FakeClient(), FakeClient(sealed = False), FakeClient())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'vault.test.boss'))
+            for i, key in enumerate(['k1', 'k2']):
+                with open(os.path.join(tmp, 'vault.test.boss', 'vault_key.{}'.format(i)), 'w') as fh:
+                    fh.write(key)
+
+            with mock.patch.object(vault_lib, 'PRIVATE_DIR', tmp), \
+                 mock.patch.object(vault_lib.glob, 'glob', wraps = glob.glob) as glob_:
+                results = cluster.unseal()
+
+        self.assertEqual(1, glob_.call_count)
+        self.assertEqual(cluster.vaults, [v for v, _ in results])
+        self.assertTrue(all(v.unseal_keys == ['k1', 'k2'] for v in cluster.vaults))
+        self.assertTrue(all(r['sealed'] is False for _, r in results))
+        VaultCluster.check(results)
+
+    def test_failures_returned_and_checked(self):
+        error = OSError("Connection refused")
+        cluster = make_cluster(FakeClient(sealed = False), FakeClient(error = error))
+
+        results = cluster.unseal()
+
+        self.assertIs(error, results[1][1])
+        self.assertIn("10.0.0.2", VaultCluster.format_status(results))
+        with self.assertRaisesRegex(Exception, "10.0.0.2"):
+            VaultCluster.check(results)
+
+    def test_check_seal_state(self):
+        results = make_cluster(FakeClient(sealed = False), FakeClient()).health()
+
+        with self.assertRaisesRegex(Exception, r"10\.0\.0\.2 \(sealed\)"):
+            VaultCluster.check(results)
+        with self.assertRaisesRegex(Exception, r"10\.0\.0\.1 \(unsealed\)"):
+            VaultCluster.check(results, sealed = True)
+
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patch = mock.patch.object(vault_lib, 'PRIVATE_DIR', tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.vault = Vault('vault.test.boss', '10.0.0.1')
+        self.write_token('token1')
+
+    def write_token(self, token):
+        with open(self.vault.path(vault_lib.VAULT_TOKEN), 'w') as fh:
+            fh.write(token)
+
+    def test_client_reused(self):
+        client = self.vault.connect(vault_lib.VAULT_TOKEN)
+
+        self.assertIs(client, self.vault.connect(vault_lib.VAULT_TOKEN))
+        self.assertEqual('token1', client.token)
+
+    def test_new_client_when_token_changes(self):
+        client = self.vault.connect(vault_lib.VAULT_TOKEN)
+        self.write_token('token2')
+
+        new_client = self.vault.connect(vault_lib.VAULT_TOKEN)
+
+        self.assertIsNot(client, new_client)
+        self.assertEqual('token2', new_client.token)
+
+    def test_invalid_token_not_cached(self):
+        with mock.patch.object(vault_lib.hvac.Client, 'is_authenticated', return_value = False):
+            with self.assertRaisesRegex(Exception, "not valid"):
+                self.vault.connect(vault_lib.VAULT_TOKEN)
+
+        self.assertNotIn(vault_lib.VAULT_TOKEN, self.vault.clients)
@@ -18,9 +18,14 @@ import subprocess
 import shlex
 import getpass
 import string
+import threading
 
 from contextlib import contextmanager
 
+# Held while prompting the user, so prompts from configs that are run
+# concurrently are not interleaved with each other
+console_lock = threading.RLock()
+
 @contextmanager
 def open_(filename, mode='r'):
     """Custom version of open that understands stdin/stdout"""
@@ -126,13 +131,14 @@ def password(what):
     Returns:
         (string) : Password
     """
-    while True:
-        pass_ = getpass.getpass("{} Password: ".format(what))
-        pass__ = getpass.getpass("Verify {} Password: ".format(what))
-        if pass_ == pass__:
-            return pass_
-        else:
-            print("Passwords didn't match, try again.")
+    with console_lock:
+        while True:
+            pass_ = getpass.getpass("{} Password: ".format(what))
+            pass__ = getpass.getpass("Verify {} Password: ".format(what))
+            if pass_ == pass__:
+                return pass_
+            else:
+                print("Passwords didn't match, try again.")
 
 
 def generate_password(length=16):
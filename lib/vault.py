@@ -18,6 +18,7 @@ import hvac
 import json
 from pprint import pprint
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 VAULT_TOKEN = "vault_token"
 VAULT_KEY = "vault_key."
@@ -26,6 +27,8 @@ VAULT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "vaul
 POLICY_DIR = os.path.join(VAULT_DIR, "policies")
 PRIVATE_DIR = os.path.join(VAULT_DIR, "private")
 
+EXPORT_WORKERS = 16 # Maximum number of concurrent requests when exporting / importing
+
 class Vault(object):
     def __init__(self, machine, ip = None, proxy = True):
         # If the machine is X.vault.vpc.boss remove the X.
@@ -50,6 +53,11 @@ class Vault(object):
         else:
             self.proxy = {} # DP XXX: {} or None???
 
+        # Clients are reused, so their HTTP connections are kept alive
+        self.clients = {} # read_token -> hvac.Client
+        self.tokens = {} # read_token -> token the cached client was created with
+        self.unseal_keys = None
+
     def path(self, filename):
         """Get the complete file path for given machine's private file.
         Args:
@@ -65,23 +73,107 @@ class Vault(object):
 
         return path
 
+    def _read_token(self, read_token):
+        """Read the contents of the given token file
+
+        Args:
+            read_token (string) : Name of the machine's private token file
+
+        Returns:
+            (string) : Vault token
+
+        Raises:
+            Exception : If the token file doesn't exist
+        """
+        token_file = self.path(read_token)
+        if not os.path.exists(token_file):
+            raise Exception("Token file '{}' doesn't exist".format(token_file))
+
+        with open(token_file, "r") as fh:
+            return fh.read()
+
     def connect(self, read_token = None):
+        """Get a hvac.Client, optionally authenticated using the given token
+        file. Clients are cached per token file and reused until the contents
+        of the token file change.
+
+        Args:
+            read_token (None|string) : Name of the machine's private token file
+
+        Returns:
+            (hvac.Client) : Vault client
+
+        Raises:
+            Exception : If the token file doesn't exist or the token is not valid
+        """
+        token = None if read_token is None else self._read_token(read_token)
+        if read_token in self.clients:
+            if self.tokens.get(read_token) == token:
+                return self.clients[read_token]
+            del self.clients[read_token] # Token was replaced since the client was created
+
         client = hvac.Client(url=self.url, proxies=self.proxy)
 
         if read_token is not None:
-            token_file = self.path(read_token)
-            if not os.path.exists(token_file):
-                raise Exception("Token file '{}' doesn't exist".format(token_file))
-
-            with open(token_file, "r") as fh:
-                client.token = fh.read()
-                try:
-                    if not client.is_authenticated():
-                        raise Exception("Vault token is not valid, cannot communicate with the Vault")
-                except:
-                    raise
+            client.token = token
+            if not client.is_authenticated():
+                raise Exception("Vault token is not valid, cannot communicate with the Vault")
+
+        self.clients[read_token] = client
+        self.tokens[read_token] = token
         return client
 
+    def keys(self):
+        """Read the unseal keys defined by VAULT_KEY. Once keys are found they
+        are not read from disk again.
+
+        Returns:
+            (list) : List of unseal keys
+        """
+        if self.unseal_keys is None:
+            key_file = self.path(VAULT_KEY)
+            keys = []
+            for f in sorted(glob.glob(key_file + "*")):
+                with open(f, "r") as fh:
+                    keys.append(fh.read())
+            if len(keys) == 0:
+                return keys
+            self.unseal_keys = keys
+        return self.unseal_keys
+
+    def _unseal(self, client):
+        """Unseal using the keys from keys()
+
+        Returns:
+            (dict) : Seal status after the keys were entered
+        """
+        keys = self.keys()
+        if len(keys) == 0:
+            raise Exception("Could not locate any key files, not unsealing")
+
+        return client.unseal_multi(keys)
+
+    def health(self):
+        """Get the initialization, seal, and HA status of the Vault.
+
+        Returns:
+            (dict) : Dictionary with the keys initialized, sealed, progress
+                     ("entered/needed" keys) and leader (bool or None if the
+                     Vault is sealed)
+        """
+        client = self.connect()
+        initialized = client.is_initialized()
+        status = client.seal_status
+        health = {
+            'initialized': initialized,
+            'sealed': status['sealed'],
+            'progress': "{}/{}".format(status['progress'], status['t']),
+            'leader': None,
+        }
+        if initialized and not status['sealed']:
+            health['leader'] = client.ha_status.get('is_self')
+        return health
+
     def status_check(self):
         """Check to see that Vault is up and available. Not checking the configuration
         status of Vault, just that it is ready to receive commands.
@@ -130,6 +222,7 @@ class Vault(object):
             key_file = self.path(VAULT_KEY)
             with open(token_file, "w") as fh:
                 fh.write(result["root_token"])
+            self.clients.clear() # Don't reuse clients holding a previous token
             for i in range(secrets):
                 with open(key_file + str(i+1), "w") as fh:
                     fh.write(result["keys"][i])
@@ -267,16 +360,7 @@ class Vault(object):
             print("Vault is already unsealed")
             return 0
 
-        key_file = self.path(VAULT_KEY)
-        keys = []
-        for f in glob.glob(key_file + "*"):
-            with open(f, "r") as fh:
-                keys.append(fh.read())
-
-        if len(keys) == 0:
-            raise Exception("Could not locate any key files, not unsealing")
-
-        res = client.unseal_multi(keys)
+        res = self._unseal(client)
         if res['sealed']:
             p = res['progress']
             t = res['t']
@@ -446,48 +530,220 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.delete(path)
 
-    def export(self, path):
-        """A generic method for reading all of the paths and keys from Vault.
+    def iter_export(self, path, workers = EXPORT_WORKERS):
+        """Read all of the paths and keys from Vault, breadth first.
+
+        The list and read requests are made concurrently and each path is only
+        read once, even if data is stored at a path and in paths under it.
 
         Args:
             path (string) : Vault path to dump data from
+            workers (int) : Maximum number of concurrent requests
+
+        Returns:
+            (generator) : Generator of (path, data) tuples, in the order the
+                          reads complete
         """
         if path[-1] != '/':
             path += '/'
 
-        rtn = {}
-
         # DP NOTE: not using self.read becuase of the different token needed
         client = self.connect(VAULT_TOKEN)
-        results =  client.read(path[:-1])
-        if results is not None:
-            rtn[path[:-1]] = results['data']
-
-        results = client.list(path)
-        for key in results['data']['keys']:
-            key = path + key
-            if key[-1] == '/':
-                data = self.export(key)
-                rtn.update(data)
-            else:
-                # DP NOTE: This will currently do a duplicate read if
-                #          data is stored at key and in paths under
-                #          key
-                #          To prevent this, check to see if (key + '/') is in keys
-                data = self.read(key)
-                rtn[key] = data['data']
 
-        return rtn
+        def read(key):
+            results = client.read(key)
+            return [] if results is None else [(key, results['data'])]
+
+        def list_(key):
+            results = client.list(key)
+            return [] if results is None else [key + k for k in results['data']['keys']]
+
+        seen = set()
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            pending = {}
+            def queue(func, key):
+                pending[executor.submit(func, key)] = func
+
+            def queue_read(key):
+                if key not in seen:
+                    seen.add(key)
+                    queue(read, key)
+
+            queue_read(path[:-1])
+            queue(list_, path)
+
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    func = pending.pop(future)
+                    if func is read:
+                        yield from future.result()
+                    else:
+                        for key in future.result():
+                            if key[-1] == '/':
+                                queue_read(key[:-1])
+                                queue(list_, key)
+                            else:
+                                queue_read(key)
+
+    def export(self, path):
+        """A generic method for reading all of the paths and keys from Vault.
 
-    def import_(self, exported, update=False):
+        Args:
+            path (string) : Vault path to dump data from
+
+        Returns:
+            (dict) : Dict of Vault path and dict of key / values stored at the path
+        """
+        return dict(self.iter_export(path))
+
+    def import_(self, exported, update=False, workers = EXPORT_WORKERS):
         """A generic method for writing / updating data in multiple paths in Vault.
 
+        The writes are made concurrently, with at most workers writes in flight.
+
         Args:
-            exported (dict): Dict of Vault path and dict of key / values to store at the path
+            exported (dict|iterable): Dict of Vault path and dict of key / values to store at the path
+                                      or iterable of (path, dict) tuples
             update (bool): If an Update should be done or if a Write should be done
+            workers (int) : Maximum number of concurrent requests
         """
-        for path in exported:
-            kv = exported[path]
-            fn = self.update if update else self.write
-            fn(path, **kv)
+        if isinstance(exported, dict):
+            exported = exported.items()
 
+        fn = self.update if update else self.write
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            pending = set()
+            try:
+                for path, kv in exported:
+                    if len(pending) >= workers:
+                        done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(fn, path, **kv))
+            finally:
+                done, _ = wait(pending)
+
+            for future in done:
+                future.result()
+
+class VaultCluster(object):
+    """Runs operations on all of the Vault servers in a cluster concurrently.
+
+    The unseal keys are read from disk once and shared by all of the servers.
+    """
+
+    def __init__(self, vaults):
+        """Constructor
+
+        Args:
+            vaults (list) : List of Vault objects, one for each server
+        """
+        self.vaults = vaults
+
+    def _map(self, func):
+        """Call func with each Vault concurrently
+
+        Returns:
+            (list) : List of (Vault, result) tuples, the result is the exception
+                     raised if func failed
+        """
+        def call(vault):
+            try:
+                return func(vault)
+            except Exception as ex:
+                return ex
+
+        if len(self.vaults) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers = len(self.vaults)) as executor:
+            return list(zip(self.vaults, executor.map(call, self.vaults)))
+
+    def unseal(self):
+        """Unseal all of the sealed servers
+
+        Returns:
+            (list) : List of (Vault, dict from health() or exception)
+        """
+        # All of the servers in a cluster use the same private files
+        keys = self.vaults[0].keys() if len(self.vaults) > 0 else []
+        for vault in self.vaults:
+            if vault.machine == self.vaults[0].machine and len(keys) > 0:
+                vault.unseal_keys = keys
+
+        def unseal(vault):
+            client = vault.connect()
+            if client.is_sealed():
+                vault._unseal(client)
+            return vault.health()
+        return self._map(unseal)
+
+    def seal(self):
+        """Seal all of the unsealed servers
+
+        Returns:
+            (list) : List of (Vault, dict from health() or exception)
+        """
+        def seal(vault):
+            client = vault.connect(VAULT_TOKEN)
+            if not client.is_sealed():
+                client.seal()
+            return vault.health()
+        return self._map(seal)
+
+    def health(self):
+        """Get the health of all of the servers
+
+        Returns:
+            (list) : List of (Vault, dict from health() or exception)
+        """
+        return self._map(lambda vault: vault.health())
+
+    @staticmethod
+    def check(results, sealed = False):
+        """Verify that a cluster operation succeeded on all of the servers
+
+        Args:
+            results (list) : Results returned by unseal(), seal(), or health()
+            sealed (bool) : If the servers are expected to be sealed
+
+        Raises:
+            Exception : If the operation failed on any server or any server is
+                        not in the expected seal state
+        """
+        failed = []
+        for vault, result in results:
+            name = vault.ip or vault.machine or "localhost"
+            if isinstance(result, Exception):
+                failed.append("{} ({})".format(name, result))
+            elif result['sealed'] != sealed:
+                failed.append("{} ({})".format(name, "sealed" if result['sealed'] else "unsealed"))
+
+        if len(failed) > 0:
+            raise Exception("Vault servers failed: {}".format(", ".join(failed)))
+
+    @staticmethod
+    def format_status(results):
+        """Format the results of a cluster operation as a table
+
+        Args:
+            results (list) : Results returned by unseal(), seal(), or health()
+
+        Returns:
+            (string) : Table of the status of each server
+        """
+        fmt = "{:<20}{:<13}{:<8}{:<10}{}"
+        lines = [fmt.format("Server", "Initialized", "Sealed", "Unseal", "Leader")]
+        for vault, result in results:
+            name = vault.ip or vault.machine or "localhost"
+            if isinstance(result, Exception):
+                lines.append("{:<20}error: {}".format(name, result))
+            else:
+                leader = "" if result['leader'] is None else result['leader']
+                lines.append(fmt.format(name,
+                                        str(result['initialized']),
+                                        str(result['sealed']),
+                                        result['progress'],
+                                        str(leader)))
+        return "\n".join(lines)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A script to benchmark the ingest upload queue populate lambda offline
+
+The lambda handler is run against an in process stand-in for SQS that
+simulates request latency, partially failed batches and throttling.
+
+For each volume size the messages / second, peak Python memory and retry
+amplification (messages sent to SQS / messages accepted by SQS) are reported.
+
+Example:
+    ./ingest_populate_benchmark.py --workers 16 --latency 0.02 --failure-rate 0.01 \\
+                                   4096x4096x64 16384x16384x64
+"""
+
+import argparse
+import os
+import sys
+import time
+import random
+import threading
+import tracemalloc
+
+import alter_path
+from lib import constants as const
+
+sys.path.append(const.INGEST_LAMBDA_DIR)
+import ingest_queue_upload
+from ingest_queue_plan import plan
+
+class FakeSQS(object):
+    """In process stand-in for the Boto3 SQS client"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, throttle=None):
+        """Constructor
+
+        Args:
+            latency (float): Seconds each send_message_batch call takes
+            failure_rate (float): Probability of each message in a batch failing
+            throttle (None|float): Maximum requests per second before requests
+                                   are delayed, like Boto3 retrying a throttled
+                                   request
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.throttle = throttle
+
+        self.lock = threading.Lock()
+        self.attempts = 0 # Messages sent to send_message_batch
+        self.successful = 0 # Messages accepted by send_message_batch
+        self.throttled = 0 # Requests delayed by throttling
+        self.next_slot = time.time()
+
+    def _wait_for_slot(self):
+        if self.throttle is None:
+            return
+
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / self.throttle
+            if slot > now:
+                self.throttled += 1
+
+        time.sleep(slot - now)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._wait_for_slot()
+        time.sleep(self.latency)
+
+        successful = []
+        failed = []
+        for entry in Entries:
+            if random.random() < self.failure_rate:
+                failed.append({'Id': entry['Id'],
+                               'SenderFault': False,
+                               'Code': 'InternalError'})
+            else:
+                successful.append({'Id': entry['Id']})
+
+        with self.lock:
+            self.attempts += len(Entries)
+            self.successful += len(successful)
+
+        resp = {'Successful': successful}
+        if len(failed) > 0:
+            resp['Failed'] = failed
+        return resp
+
+class FakeBoto3(object):
+    """Replaces the boto3 module used by ingest_queue_upload"""
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+
+    def client(self, service, **kwargs):
+        return self.sqs
+
+def create_args(size, compact=False, workers=ingest_queue_upload.SQS_MAX_WORKERS):
+    """Create the handler arguments for a volume of the given size
+
+    Args:
+        size (tuple): (x, y, z) extent of the volume, in pixels / slices
+    """
+    x, y, z = size
+    return {
+        'job_id': 1,
+        'upload_queue': 'https://queue.amazonaws.com/123456789012/upload',
+        'ingest_queue': 'https://queue.amazonaws.com/123456789012/ingest',
+        'resolution': 0,
+        'project_info': ['1', '1', '1'],
+        't_start': 0, 't_stop': 1, 't_tile_size': 1,
+        'x_start': 0, 'x_stop': x, 'x_tile_size': 1024,
+        'y_start': 0, 'y_stop': y, 'y_tile_size': 1024,
+        'z_start': 0, 'z_stop': z, 'z_tile_size': 16,
+        'final_z_stop': z,
+        'max_workers': workers,
+        'compact': compact,
+    }
+
+def benchmark(args, sqs):
+    """Run the handler against the fake SQS client
+
+    Returns:
+        dict: Benchmark results
+    """
+    ingest_queue_upload.boto3 = FakeBoto3(sqs)
+    os.environ.pop('CHECKPOINT_TABLE', None)
+
+    tracemalloc.start()
+    start = time.time()
+    sent = ingest_queue_upload.handler(args, None)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'messages': sent,
+        'expected': plan(args)['messages'],
+        'seconds': elapsed,
+        'rate': sent / elapsed if elapsed > 0 else 0.0,
+        'peak': peak / (1024 * 1024),
+        'amplification': sqs.attempts / max(sqs.successful, 1),
+        'throttled': sqs.throttled,
+    }
+
+def parse_size(size):
+    try:
+        x, y, z = map(int, size.split('x'))
+        return (x, y, z)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not in XxYxZ format".format(size))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the ingest upload queue populate lambda against a fake SQS")
+    parser.add_argument("--workers",
+                        metavar = "<count>",
+                        type = int,
+                        default = ingest_queue_upload.SQS_MAX_WORKERS,
+                        help = "Number of SQS batches in flight (default: {})".format(ingest_queue_upload.SQS_MAX_WORKERS))
+    parser.add_argument("--latency",
+                        metavar = "<seconds>",
+                        type = float,
+                        default = 0.02,
+                        help = "Latency of each SQS request (default: 0.02)")
+    parser.add_argument("--failure-rate",
+                        metavar = "<probability>",
+                        type = float,
+                        default = 0.0,
+                        help = "Probability of each message in a batch failing (default: 0)")
+    parser.add_argument("--throttle",
+                        metavar = "<requests/sec>",
+                        type = float,
+                        default = None,
+                        help = "Maximum SQS requests per second (default: unlimited)")
+    parser.add_argument("--compact",
+                        action = "store_true",
+                        help = "Use the compact message format")
+    parser.add_argument("--min-rate",
+                        metavar = "<messages/sec>",
+                        type = float,
+                        default = None,
+                        help = "Exit with an error if any run is slower than this rate")
+    parser.add_argument("sizes",
+                        metavar = "XxYxZ",
+                        type = parse_size,
+                        nargs = "+",
+                        help = "Volume sizes to benchmark")
+
+    args = parser.parse_args()
+
+    # Keep the retries from sleeping for the real backoff times
+    ingest_queue_upload.SQS_RETRY_BACKOFF = min(ingest_queue_upload.SQS_RETRY_BACKOFF, args.latency)
+    ingest_queue_upload.PROGRESS_INTERVAL = float('inf')
+
+    fmt = "{:<20}{:>12}{:>10}{:>14}{:>12}{:>10}{:>11}"
+    print(fmt.format("Volume", "Messages", "Seconds", "Messages/sec", "Peak MB", "Retry x", "Throttled"))
+
+    ret = 0
+    for size in args.sizes:
+        sqs = FakeSQS(args.latency, args.failure_rate, args.throttle)
+        results = benchmark(create_args(size, args.compact, args.workers), sqs)
+
+        print(fmt.format("x".join(map(str, size)),
+                         results['messages'],
+                         "{:.2f}".format(results['seconds']),
+                         "{:.0f}".format(results['rate']),
+                         "{:.1f}".format(results['peak']),
+                         "{:.3f}".format(results['amplification']),
+                         results['throttled']))
+
+        if not args.compact and results['messages'] != results['expected']:
+            print("Error: expected {} messages".format(results['expected']))
+            ret = 1
+
+        if args.min_rate is not None and results['rate'] < args.min_rate:
+            print("Error: rate is below {} messages/sec".format(args.min_rate))
+            ret = 1
+
+    sys.exit(ret)